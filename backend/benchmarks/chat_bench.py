@@ -0,0 +1,314 @@
+"""
+benchmarks/chat_bench.py
+
+Replays a transcript corpus against /api/chat in-process and reports
+latency percentiles and throughput per intent.
+
+Every upstream is replaced by a deterministic stand-in that sleeps for a
+configurable latency (with seeded jitter), so runs are repeatable offline:
+
+  Gemini     the SDK client under GeminiIntentClient answers with the intent
+             the corpus line gives for the transcript (CLARIFY if unknown),
+             so caching, hedging and parsing are still exercised
+  Stripe     PaymentIntent.create / Charge.retrieve
+  TrueLayer  get_accounts / get_balance
+  Twilio     the alert queue sink
+
+Each virtual user has its own session and replays the corpus in order
+(drafts are followed by their confirmations); --users of them run
+concurrently. The app runs in a temporary working directory, so CSVs,
+the alert outbox and traces never touch the real ones.
+
+Usage (from backend/):
+    python -m benchmarks.chat_bench --users 8 --rounds 3 --gemini-ms 600
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+from fastapi import Request
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CORPUS = os.path.join(BACKEND_DIR, "benchmarks", "chat_corpus.jsonl")
+
+_TRANSCRIPT_RE = re.compile(r'^transcript=(".*")$', re.MULTILINE)
+
+
+class Latency:
+    """Seeded latency source: base milliseconds ± jitter fraction."""
+
+    def __init__(self, base_ms: float, jitter: float, rng: random.Random) -> None:
+        self.base_s = base_ms / 1000
+        self.jitter = jitter
+        self.rng = rng
+
+    def sample(self) -> float:
+        return max(0.0, self.base_s * (1 + self.rng.uniform(-self.jitter, self.jitter)))
+
+
+def load_corpus(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+# ---------------------------------------------------------------------------
+# Provider stand-ins
+# ---------------------------------------------------------------------------
+
+class FakeGenAI:
+    """Stands in for google.genai.Client: .models and .aio.models.generate_content."""
+
+    def __init__(self, answers: dict[str, dict], latency: Latency) -> None:
+        self.answers = answers
+        self.latency = latency
+        self.calls = 0
+        self.models = SimpleNamespace(generate_content=self._generate)
+        self.aio = SimpleNamespace(models=SimpleNamespace(generate_content=self._agenerate))
+        self.caches = SimpleNamespace(create=self._no_cache)
+
+    def _no_cache(self, **kwargs):
+        raise RuntimeError("context caching is not simulated")
+
+    def _answer(self, contents: str) -> SimpleNamespace:
+        self.calls += 1
+        match = _TRANSCRIPT_RE.search(contents)
+        transcript = json.loads(match.group(1)) if match else ""
+        intent = self.answers.get(transcript, {"intent": "CLARIFY", "assistant_say": "Could you say that again?"})
+        return SimpleNamespace(
+            text=json.dumps(intent),
+            parsed=None,
+            usage_metadata=SimpleNamespace(prompt_token_count=len(contents) // 4, cached_content_token_count=0),
+        )
+
+    def _generate(self, model, contents, config=None):
+        time.sleep(self.latency.sample())
+        return self._answer(contents)
+
+    async def _agenerate(self, model, contents, config=None):
+        await asyncio.sleep(self.latency.sample())
+        return self._answer(contents)
+
+
+def install_stand_ins(args, answers: dict[str, dict]) -> dict:
+    """Patches every upstream the chat route can reach. Returns call counters."""
+    import stripe
+
+    from routes import chat
+    from services import alert_queue, balance_prefetch, gemini
+
+    rng = random.Random(args.seed)
+    counts = defaultdict(int)
+
+    gemini_latency = Latency(args.gemini_ms, args.jitter, rng)
+    fake_genai = FakeGenAI(answers, gemini_latency)
+    gemini.genai.Client = lambda api_key=None: fake_genai
+    chat._gemini_client = gemini.GeminiIntentClient()
+    if args.no_intent_cache:
+        chat._gemini_client.cache.max_bytes = 0
+
+    stripe_latency = Latency(args.stripe_ms, args.jitter, rng)
+
+    def payment_intent_create(**params):
+        time.sleep(stripe_latency.sample())
+        counts["stripe.payment_intent_create"] += 1
+        n = counts["stripe.payment_intent_create"]
+        return SimpleNamespace(
+            id=f"pi_bench_{n}",
+            client_secret=f"pi_bench_{n}_secret",
+            status="requires_payment_method",
+            latest_charge=f"ch_bench_{n}",
+        )
+
+    def charge_retrieve(charge_id):
+        time.sleep(stripe_latency.sample())
+        counts["stripe.charge_retrieve"] += 1
+        return SimpleNamespace(outcome=SimpleNamespace(risk_level="normal", risk_score=12), description=None)
+
+    stripe.PaymentIntent.create = payment_intent_create
+    stripe.Charge.retrieve = charge_retrieve
+
+    truelayer_latency = Latency(args.truelayer_ms, args.jitter, rng)
+
+    def get_accounts(access_token=None):
+        time.sleep(truelayer_latency.sample())
+        counts["truelayer.get_accounts"] += 1
+        return {"results": [{"account_id": "acc_bench"}]}
+
+    def get_balance(account_id, access_token=None):
+        time.sleep(truelayer_latency.sample())
+        counts["truelayer.get_balance"] += 1
+        return {"results": [{"available": 1250.0, "current": 1300.0, "currency": "EUR"}]}
+
+    balance_prefetch.get_accounts = get_accounts
+    balance_prefetch.get_balance = get_balance
+
+    twilio_latency = Latency(args.twilio_ms, args.jitter, rng)
+
+    def twilio_sink(carer_phone, message):
+        time.sleep(twilio_latency.sample())
+        counts["twilio.send"] += 1
+        return True
+
+    alert_queue.set_sink(twilio_sink)
+    counts["_gemini"] = fake_genai
+    return counts
+
+
+# ---------------------------------------------------------------------------
+# Replay
+# ---------------------------------------------------------------------------
+
+async def run_user(app, user_no: int, corpus: list[dict], rounds: int, results: list[dict]) -> None:
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await client.post("/__bench/session", json={"user_no": user_no})
+        for _ in range(rounds):
+            for line in corpus:
+                started = time.perf_counter()
+                resp = await client.post("/api/chat", json={"transcript": line["transcript"]})
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                body = resp.json() if resp.headers.get("content-type", "").startswith("application/json") else {}
+                results.append({
+                    "intent": body.get("intent", f"HTTP {resp.status_code}"),
+                    "path": (body.get("debug") or {}).get("path", "error"),
+                    "ms": elapsed_ms,
+                })
+
+
+def add_bench_session_route(app) -> None:
+    @app.post("/__bench/session")
+    async def bench_session(request: Request):
+        user_no = (await request.json())["user_no"]
+        request.session.update({
+            "user_id": f"cus_bench_{user_no}",
+            "stripe_customer_id": f"cus_bench_{user_no}",
+            "user_name": f"Bench User {user_no}",
+            "truelayer_access_token": f"tok_bench_{user_no}",
+            "carer_phone": "+353870000000",
+            "carer_name": "Bench Carer",
+        })
+        return {"ok": True}
+
+
+async def replay(app, args, corpus: list[dict]) -> tuple[list[dict], float]:
+    from services import alert_aggregator, alert_queue
+
+    alert_queue.start()
+    alert_aggregator.start()
+    results: list[dict] = []
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(app, n, corpus, args.rounds, results) for n in range(args.users)))
+    wall_s = time.perf_counter() - started
+    alert_aggregator.flush(force=True)
+    await alert_queue.drain(timeout=30)
+    return results, wall_s
+
+
+def summarise(results: list[dict], wall_s: float) -> dict:
+    by_intent: dict[str, list[dict]] = defaultdict(list)
+    for r in results:
+        by_intent[r["intent"]].append(r)
+
+    def row(rs: list[dict]) -> dict:
+        ms = [r["ms"] for r in rs]
+        paths = defaultdict(int)
+        for r in rs:
+            paths[r["path"]] += 1
+        return {
+            "turns": len(rs),
+            "turns_per_s": round(len(rs) / wall_s, 2),
+            "p50_ms": round(percentile(ms, 50), 1),
+            "p95_ms": round(percentile(ms, 95), 1),
+            "p99_ms": round(percentile(ms, 99), 1),
+            "max_ms": round(max(ms), 1),
+            "paths": dict(paths),
+        }
+
+    return {
+        "wall_s": round(wall_s, 3),
+        "overall": row(results),
+        "intents": {intent: row(rs) for intent, rs in sorted(by_intent.items())},
+    }
+
+
+def print_report(summary: dict, counts: dict) -> None:
+    header = f"{'intent':<16}{'turns':>7}{'turns/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}  paths"
+    print(header)
+    print("-" * len(header))
+    rows = list(summary["intents"].items()) + [("ALL", summary["overall"])]
+    for intent, r in rows:
+        paths = ", ".join(f"{k}={v}" for k, v in sorted(r["paths"].items()))
+        print(
+            f"{intent:<16}{r['turns']:>7}{r['turns_per_s']:>9}{r['p50_ms']:>9}"
+            f"{r['p95_ms']:>9}{r['p99_ms']:>9}{r['max_ms']:>9}  {paths}"
+        )
+    print(f"\nwall time {summary['wall_s']}s")
+    print("upstream calls: " + ", ".join(f"{k}={v}" for k, v in sorted(counts.items())))
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="JSONL of {transcript, intent}")
+    parser.add_argument("--users", type=int, default=4, help="concurrent virtual users")
+    parser.add_argument("--rounds", type=int, default=3, help="times each user replays the corpus")
+    parser.add_argument("--gemini-ms", type=float, default=600)
+    parser.add_argument("--stripe-ms", type=float, default=250)
+    parser.add_argument("--truelayer-ms", type=float, default=150)
+    parser.add_argument("--twilio-ms", type=float, default=300)
+    parser.add_argument("--jitter", type=float, default=0.3, help="± fraction applied to every latency")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-intent-cache", action="store_true", help="send every Gemini turn upstream")
+    parser.add_argument("--json", dest="json_out", help="also write the summary to this file")
+    args = parser.parse_args(argv)
+
+    corpus = load_corpus(os.path.abspath(args.corpus))
+    answers = {line["transcript"]: line["intent"] for line in corpus}
+
+    # Isolate every file the app writes, and keep providers from seeing real credentials
+    workdir = tempfile.mkdtemp(prefix="alma-bench-")
+    os.chdir(workdir)
+    os.environ["TRACE_EXPORT_PATH"] = ""
+    os.environ["GEMINI_API_KEY"] = "bench"
+    os.environ.pop("FORCE_RISK_LEVEL", None)
+    sys.path.insert(0, BACKEND_DIR)
+
+    from main import app
+
+    counts = install_stand_ins(args, answers)
+    fake_genai = counts.pop("_gemini")
+    add_bench_session_route(app)
+
+    results, wall_s = asyncio.run(replay(app, args, corpus))
+    counts["gemini.generate_content"] = fake_genai.calls
+    summary = summarise(results, wall_s)
+    summary["upstream_calls"] = dict(counts)
+    summary["config"] = {k: v for k, v in vars(args).items() if k != "json_out"}
+
+    print_report(summary, counts)
+    if args.json_out:
+        with open(args.json_out if os.path.isabs(args.json_out) else os.path.join(BACKEND_DIR, args.json_out), "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+benchmarks/ledger_bench.py
+
+Measures sustained transfer throughput and balance-query cost of
+services/ledger.py.
+
+--threads workers post random transfers between --users accounts for
+--seconds. Afterwards the report shows transfers per second, posting
+latency percentiles, the cost of a balance() call, that the books still
+balance, and how long a restart takes to restore state from the
+checkpoint plus journal tail. The ledger files live in a temporary
+directory.
+
+Usage (from backend/):
+    python -m benchmarks.ledger_bench --users 1000 --threads 4 --seconds 5
+    python -m benchmarks.ledger_bench --fsync      # durable journal writes
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.chat_bench import BACKEND_DIR, percentile
+
+
+def run(args) -> dict:
+    from services import ledger
+
+    user_ids = [f"bench_{n}" for n in range(args.users)]
+    for user_id in user_ids:
+        ledger.fund(user_id, args.opening, "EUR")
+
+    latencies: list[list[float]] = [[] for _ in range(args.threads)]
+    rejected = [0] * args.threads
+    stop_at = time.perf_counter() + args.seconds
+
+    def worker(n: int) -> None:
+        rng = random.Random(args.seed + n)
+        own = latencies[n]
+        while time.perf_counter() < stop_at:
+            sender, recipient = rng.sample(user_ids, 2)
+            amount = round(rng.uniform(0.01, args.max_amount), 2)
+            started = time.perf_counter()
+            try:
+                ledger.transfer(sender, recipient, amount, "EUR", "bench")
+            except ledger.InsufficientFunds:
+                rejected[n] += 1
+            own.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall_s = time.perf_counter() - started
+
+    all_ms = [s * 1000 for own in latencies for s in own]
+    queries = 100_000
+    q_started = time.perf_counter()
+    for n in range(queries):
+        ledger.balance(user_ids[n % len(user_ids)], "EUR")
+    balance_ns = (time.perf_counter() - q_started) / queries * 1e9
+
+    stats = ledger.stats()
+    total = sum(ledger.balance(u, "EUR") for u in user_ids)
+
+    reload_started = time.perf_counter()
+    ledger.load()
+    reload_ms = (time.perf_counter() - reload_started) * 1000
+    replayed = ledger.stats()["replayed"]
+
+    return {
+        "transfers": len(all_ms),
+        "rejected": sum(rejected),
+        "wall_s": round(wall_s, 3),
+        "transfers_per_s": round(len(all_ms) / wall_s, 1),
+        "post_p50_ms": round(percentile(all_ms, 50), 3),
+        "post_p99_ms": round(percentile(all_ms, 99), 3),
+        "balance_ns": round(balance_ns, 1),
+        "journal_entries": stats["seq"],
+        "imbalance": stats["imbalance"],
+        "users_total": round(total, 2),
+        "expected_total": round(args.users * (args.opening + ledger.LEDGER_OPENING_BALANCE), 2),
+        "reload_ms": round(reload_ms, 2),
+        "replayed_on_reload": replayed,
+    }
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--opening", type=float, default=100, help="extra funding per user before the run")
+    parser.add_argument("--max-amount", type=float, default=50)
+    parser.add_argument("--checkpoint-every", type=int, default=1000)
+    parser.add_argument("--fsync", action="store_true", help="fsync every journal write")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", dest="json_out", help="also write the summary to this file")
+    args = parser.parse_args(argv)
+
+    os.chdir(tempfile.mkdtemp(prefix="alma-ledger-bench-"))
+    os.environ["LEDGER_CHECKPOINT_EVERY"] = str(args.checkpoint_every)
+    os.environ["LEDGER_FSYNC"] = "1" if args.fsync else ""
+    sys.path.insert(0, BACKEND_DIR)
+
+    summary = run(args)
+    for key, value in summary.items():
+        print(f"{key:<20}{value}")
+    if args.json_out:
+        with open(args.json_out if os.path.isabs(args.json_out) else os.path.join(BACKEND_DIR, args.json_out), "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
 import os
+import time
 from dotenv import load_dotenv
 
 from routes.user import router as user_router
@@ -12,13 +13,42 @@ from routes.payments import router as payments_router
 from routes.issuing import router as issuing_router
 from routes.transactions import router as transactions_router
 from routes.chat import router as chat_router
+from routes.payees import router as payees_router
+from routes.overseer import router as overseer_router
+from routes.metrics import router as metrics_router
 from routes import truelayer
+from services import alert_queue, alert_aggregator, ledger, metrics, reconciliation, tracing, webhook_queue
 
 load_dotenv()
 
 # --- FastAPI app ---
 app = FastAPI(title="Alma API", version="1.0.0")
 
+# --- Request tracing ---
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """
+    Gives every request a trace ID and a root span (services/tracing.py) and
+    records its latency and status under the route template (services/metrics.py).
+    """
+    collect = bool(request.headers.get(tracing.TIMINGS_HEADER))
+    started = time.perf_counter()
+    status = 500
+    try:
+        with tracing.trace(request.headers.get(tracing.TRACE_HEADER), collect=collect) as trace_id:
+            with tracing.span(f"{request.method} {request.url.path}") as span:
+                response = await call_next(request)
+                status = response.status_code
+                span.set(status_code=status)
+    finally:
+        # The template, not the raw path, so IDs in URLs don't each become a series
+        route = request.scope.get("route")
+        metrics.observe_request(request.method, getattr(route, "path", "unmatched"), status,
+                                time.perf_counter() - started)
+    response.headers[tracing.TRACE_HEADER] = trace_id
+    return response
+
+
 # --- Session middleware ---
 SESSION_SECRET_KEY = os.getenv("SESSION_SECRET_KEY", "alma-dev-secret-change-in-prod")
 app.add_middleware(SessionMiddleware, secret_key=SESSION_SECRET_KEY)
@@ -42,6 +72,28 @@ app.include_router(payments_router)      # handles /api/payments/create + /api/p
 app.include_router(issuing_router)
 app.include_router(transactions_router)
 app.include_router(chat_router)         # handles /api/chat + /api/chat/state
+app.include_router(payees_router)       # handles /api/payees CRUD
+app.include_router(overseer_router)     # handles /api/overseer/dashboard + /api/overseer/events
+app.include_router(metrics_router)      # handles /metrics (Prometheus)
+
+# --- Background workers ---
+@app.on_event("startup")
+async def start_background_queues():
+    alert_queue.start()
+    alert_aggregator.start()
+    webhook_queue.start()
+    reconciliation.start()
+
+
+@app.on_event("shutdown")
+async def drain_background_queues():
+    reconciliation.stop()
+    await webhook_queue.drain()
+    alert_aggregator.flush(force=True)
+    await alert_queue.drain()
+    ledger.close()
+    tracing.close()
+
 
 # --- Serve static frontend (optional, for production build) ---
 if os.path.isdir("static"):
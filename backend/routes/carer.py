@@ -1,7 +1,8 @@
 from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from services.alerts import send_carer_sms, build_registration_message
+from services.alerts import build_registration_message
+from services import alert_queue
 
 router = APIRouter()
 
@@ -28,7 +29,7 @@ async def register_carer(request: Request, body: RegisterCarerRequest):
     request.session["carer_phone"] = body.carer_phone
 
     # Send confirmation SMS to carer
-    send_carer_sms(
+    alert_queue.enqueue(
         carer_phone=body.carer_phone,
         message=build_registration_message(user_name)
     )
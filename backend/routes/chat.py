@@ -7,6 +7,7 @@ dispatches to the appropriate Stripe or TrueLayer service.
 Endpoints
 ---------
 POST /api/chat        — main chat turn
+POST /api/chat/stream — same turn as Server-Sent Events (intent → ack → result)
 GET  /api/chat/state  — inspect session state (debug)
 
 Intent → action mapping
@@ -21,21 +22,24 @@ HELP            → Returns a help blurb
 
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import json
 import os
+import uuid
+from types import SimpleNamespace
+
 import stripe
 from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from services.gemini import GeminiIntentClient
+from services import fast_intent, payee_storage
 from dotenv import load_dotenv
 
-from services.truelayer import get_balance, get_accounts
-from services.stripe import get_radar_risk
-from services.alerts import (
-    send_carer_sms,
-    build_fraud_alert_message,
-    build_large_payment_message,
-)
+from services import balance_prefetch, tracing
+from services.stripe import create_payment_intent, ledger_status
+from services import alert_aggregator, transaction_storage, locks, events
 
 load_dotenv()
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
@@ -46,34 +50,20 @@ LARGE_PAYMENT_THRESHOLD = 200.0
 
 # ---------------------------------------------------------------------------
 # Payee registry
-# Mirrors the allowed payees concept from connect.py.
-# Add real Stripe Connect account IDs via env vars for person-to-person.
+# Per-user payees live in services/payee_storage.py (CRUD under /api/payees);
+# users who haven't edited theirs get DEFAULT_PAYEES.
 # ---------------------------------------------------------------------------
 
-PAYEE_REGISTRY: list[dict] = [
-    {"label": "Tesco",           "type": "merchant", "stripe_account": None},
-    {"label": "Lidl",            "type": "merchant", "stripe_account": None},
-    {"label": "Dunnes Stores",   "type": "merchant", "stripe_account": None},
-    {"label": "Boots",           "type": "merchant", "stripe_account": None},
-    {"label": "Pharmacy",        "type": "merchant", "stripe_account": None},
-    {"label": "Electric Ireland","type": "merchant", "stripe_account": None},
-    {"label": "Irish Water",     "type": "merchant", "stripe_account": None},
-    # Person-to-person — set STRIPE_CONNECT_MARY / STRIPE_CONNECT_JOHN in .env
-    {"label": "Mary", "type": "person", "stripe_account": os.getenv("STRIPE_CONNECT_MARY", "")},
-    {"label": "John", "type": "person", "stripe_account": os.getenv("STRIPE_CONNECT_JOHN", "")},
-]
+PAYEE_REGISTRY: list[dict] = payee_storage.DEFAULT_PAYEES
 
 
-def _get_payee(label: str) -> dict | None:
-    label_lower = label.lower()
-    for p in PAYEE_REGISTRY:
-        if p["label"].lower() == label_lower:
-            return p
-    return None
+def _get_payee(request: Request, label: str) -> dict | None:
+    """Exact label match, else a confident fuzzy match ("Dunne's", "Marie")."""
+    return payee_storage.resolve_payee(request.session.get("user_id"), label)
 
 
-def _payee_labels() -> list[str]:
-    return [p["label"] for p in PAYEE_REGISTRY]
+def _payee_labels(request: Request) -> list[str]:
+    return payee_storage.list_labels(request.session.get("user_id"))
 
 
 # ---------------------------------------------------------------------------
@@ -102,7 +92,7 @@ class ChatRequest(BaseModel):
 # Intent handlers
 # ---------------------------------------------------------------------------
 
-def _handle_check_balance(request: Request, intent_data: dict) -> dict:
+def _handle_check_balance(request: Request, intent_data: dict, prefetched: dict | None = None) -> dict:
     token = request.session.get("truelayer_access_token")
     if not token:
         return {
@@ -113,29 +103,32 @@ def _handle_check_balance(request: Request, intent_data: dict) -> dict:
             "data": None,
         }
 
-    primary_account_id = request.session.get("primary_account_id")
-
-    if not primary_account_id:
-        try:
-            resp = get_accounts(access_token=token)
-            results = resp.get("results", [])
-            if results:
-                primary_account_id = results[0]["account_id"]
-                request.session["primary_account_id"] = primary_account_id
-        except Exception as exc:
-            return {
-                "assistant_say": f"I had trouble fetching your accounts. Please try again. ({exc})",
-                "data": None,
-            }
+    # A speculative fetch started while the intent was being classified, if any
+    fetched = prefetched or balance_prefetch.fetch_balance(token, request.session.get("primary_account_id"))
+    error = fetched["error"]
+    if error and error[0] == "accounts":
+        return {
+            "assistant_say": f"I had trouble fetching your accounts. Please try again. ({error[1]})",
+            "data": None,
+        }
 
+    primary_account_id = fetched["primary_account_id"]
     if not primary_account_id:
         return {
             "assistant_say": "I couldn't find a linked bank account. Please link your bank first.",
             "data": None,
         }
+    if request.session.get("primary_account_id") != primary_account_id:
+        request.session["primary_account_id"] = primary_account_id
+
+    if error:
+        return {
+            "assistant_say": f"Sorry, I had trouble checking your balance. ({error[1]})",
+            "data": None,
+        }
 
     try:
-        balance_resp = get_balance(primary_account_id, access_token=token)
+        balance_resp = fetched["balance"]
         results = balance_resp.get("results", [])
         if not results:
             return {
@@ -171,9 +164,20 @@ def _handle_transfer_draft(request: Request, intent_data: dict) -> dict:
             "data": None,
         }
 
-    payee = _get_payee(payee_label)
+    payee = _get_payee(request, payee_label)
     if not payee:
-        labels = ", ".join(_payee_labels())
+        suggestions = [
+            m.label for m in payee_storage.match_payees(request.session.get("user_id"), payee_label)
+            if m.score >= 0.5
+        ]
+        if suggestions:
+            return {
+                "assistant_say": (
+                    f"I'm not sure who '{payee_label}' is. Did you mean {' or '.join(suggestions)}?"
+                ),
+                "data": {"choices": suggestions},
+            }
+        labels = ", ".join(_payee_labels(request))
         return {
             "assistant_say": (
                 f"I don't recognise '{payee_label}' as an allowed payee. "
@@ -188,6 +192,8 @@ def _handle_transfer_draft(request: Request, intent_data: dict) -> dict:
         "stripe_account": payee.get("stripe_account") or "",
         "amount": amount,
         "currency": currency,
+        # Stripe idempotency key for the confirm, so a replayed confirm can't charge twice
+        "draft_id": uuid.uuid4().hex[:16],
     }
 
     assistant_say = intent_data.get("assistant_say") or (
@@ -206,38 +212,24 @@ def _execute_stripe_payment(
     payee: dict,
     description: str,
     metadata: dict,
+    idempotency_key: str | None = None,
 ) -> dict:
     """
-    Creates a Stripe PaymentIntent.
-    Person payees use transfer_data for Connect destination charges.
+    Creates a Stripe PaymentIntent through create_payment_intent, so a chat
+    payment gets the same scam-pattern, local risk and Radar checks as
+    /api/payments. Person payees use transfer_data for Connect destination charges.
     """
-    params: dict = dict(
-        amount=int(amount_euros * 100),
-        currency="eur",
-        customer=customer_id,
+    result = create_payment_intent(
+        customer_id=customer_id,
+        amount_euros=amount_euros,
         description=description,
-        metadata={**metadata, "source": "alma_app"},
+        metadata=metadata,
+        # Same payee key the ledger row's to_account_id uses, so history rebuilt from it matches
+        payee=payee.get("stripe_account") or payee["label"],
+        transfer_destination=(payee.get("stripe_account") or None) if payee["type"] == "person" else None,
+        idempotency_key=idempotency_key,
     )
-    if payee["type"] == "person" and payee.get("stripe_account"):
-        params["transfer_data"] = {"destination": payee["stripe_account"]}
-
-    intent = stripe.PaymentIntent.create(**params)
-
-    radar = None
-    if intent.latest_charge:
-        try:
-            radar = get_radar_risk(intent.latest_charge, description)
-        except Exception:
-            pass
-
-    return {
-        "id": intent.id,
-        "client_secret": intent.client_secret,
-        "amount": amount_euros,
-        "status": intent.status,
-        "payee_type": payee["type"],
-        "radar": radar,
-    }
+    return {**result, "payee_type": payee["type"]}
 
 
 def _handle_confirm(request: Request, intent_data: dict) -> dict:
@@ -261,7 +253,7 @@ def _handle_confirm(request: Request, intent_data: dict) -> dict:
     payee_label: str = pending["payee_label"]
     amount_euros: float = float(pending["amount"])
 
-    payee = _get_payee(payee_label)
+    payee = _get_payee(request, payee_label)
     if not payee:
         request.session.pop("pending_transfer", None)
         return {
@@ -269,6 +261,17 @@ def _handle_confirm(request: Request, intent_data: dict) -> dict:
             "data": None,
         }
 
+    # A replayed cookie still carries the draft; answer from the ledger before
+    # Stripe or the risk engine see the payment again (the per-user lock is held)
+    idempotency_key = f"confirm_{pending['draft_id']}" if pending.get("draft_id") else None
+    sent = transaction_storage.get_transaction_by_idempotency_key(idempotency_key) if idempotency_key else None
+    if sent:
+        request.session.pop("pending_transfer", None)
+        return {
+            "assistant_say": f"That payment to {payee_label} has already been sent.",
+            "data": {"id": sent["provider_id"], "amount": amount_euros, "status": sent["status"]},
+        }
+
     try:
         result = _execute_stripe_payment(
             customer_id=customer_id,
@@ -280,6 +283,7 @@ def _handle_confirm(request: Request, intent_data: dict) -> dict:
                 "carer_name": carer_name,
                 "user_name": user_name,
             },
+            idempotency_key=idempotency_key,
         )
     except stripe.error.StripeError as exc:
         return {
@@ -293,23 +297,41 @@ def _handle_confirm(request: Request, intent_data: dict) -> dict:
         }
 
     request.session.pop("pending_transfer", None)
+    balance_prefetch.invalidate(request.session.get("truelayer_access_token"))
+
+    if result.get("id"):
+        transaction = transaction_storage.record_transaction(
+            user_id=request.session.get("user_id") or customer_id,
+            transaction_type="PAYMENT",
+            amount=amount_euros,
+            currency="EUR",
+            from_account_id=customer_id,
+            to_account_id=payee.get("stripe_account") or payee_label,
+            description=f"Payment to {payee_label}",
+            status=ledger_status(result["status"]),
+            provider_id=result["id"],
+            idempotency_key=idempotency_key,
+        )
+        events.publish("chat.confirmed", transaction["user_id"], {
+            "transaction_id": transaction["transaction_id"],
+            "payment_id": result["id"],
+            "amount": amount_euros,
+            "currency": "EUR",
+            "payee": payee_label,
+            "status": transaction["status"],
+            "risk_level": (result.get("radar") or {}).get("risk_level"),
+        })
 
     radar = result.get("radar")
 
     if carer_phone and radar and radar.get("should_alert"):
-        send_carer_sms(
-            carer_phone=carer_phone,
-            message=build_fraud_alert_message(
-                user_name, amount_euros, "EUR",
-                radar["risk_level"], radar.get("alma_message", ""),
-            ),
+        alert_aggregator.submit(
+            carer_phone, result.get("id"), user_name, amount_euros, "EUR", "fraud",
+            risk_level=radar["risk_level"], alma_message=radar.get("alma_message", ""),
         )
 
     if carer_phone and amount_euros >= LARGE_PAYMENT_THRESHOLD:
-        send_carer_sms(
-            carer_phone=carer_phone,
-            message=build_large_payment_message(user_name, amount_euros, "EUR"),
-        )
+        alert_aggregator.submit(carer_phone, result.get("id"), user_name, amount_euros, "EUR", "large")
 
     if radar and radar.get("should_block"):
         assistant_say = radar["alma_message"]
@@ -339,8 +361,8 @@ def _handle_clarify(intent_data: dict) -> dict:
     }
 
 
-def _handle_help(intent_data: dict) -> dict:
-    labels = ", ".join(_payee_labels())
+def _handle_help(request: Request, intent_data: dict) -> dict:
+    labels = ", ".join(_payee_labels(request))
     return {
         "assistant_say": intent_data.get(
             "assistant_say",
@@ -358,43 +380,121 @@ def _handle_help(intent_data: dict) -> dict:
 # Main chat endpoint
 # ---------------------------------------------------------------------------
 
-@router.post("/api/chat")
-async def chat(request: Request, body: ChatRequest):
+async def _classify_turn(request: Request, transcript: str) -> tuple[dict, dict, asyncio.Task | None]:
     """
-    Single conversational turn.
+    Classifies one transcript with the local fast-path rules, falling through
+    to Gemini (with automatic fallback + repair) when they aren't sure.
 
-    1. Classify intent via Gemini (with automatic fallback + repair).
-    2. Dispatch to the appropriate handler.
-    3. Return { intent, assistant_say, data, debug }.
+    While Gemini is thinking, the user's balance is fetched speculatively;
+    the returned task is that prefetch (None on the fast path or without a
+    linked bank).
     """
     pending_transfer = request.session.get("pending_transfer")
-
+    payees_allowed = _payee_labels(request)
+
+    def resolve_payee_label(spoken: str) -> str | None:
+        payee = _get_payee(request, spoken)
+        return payee["label"] if payee else None
+
+    with tracing.span("chat.fast_intent") as span:
+        fast = fast_intent.classify(transcript, payees_allowed, pending_transfer, resolve_payee_label)
+        if span:
+            span.set(hit=fast is not None)
+    if fast is not None:
+        intent_data, rule = fast
+        fast_intent.record_path("fast")
+        return intent_data, {"path": "fast", "rule": rule}, None
+
+    prefetch = balance_prefetch.start(
+        request.session.get("truelayer_access_token"),
+        request.session.get("primary_account_id"),
+    )
     try:
         client = _get_gemini_client()
-        intent_data, debug_info = client.classify_intent(
-            transcript=body.transcript,
-            payees_allowed=_payee_labels(),
-            pending_transfer=pending_transfer,
-        )
+        with tracing.span("chat.gemini"):
+            intent_data, debug_info = await client.aclassify_intent(
+                transcript=transcript,
+                payees_allowed=payees_allowed,
+                pending_transfer=pending_transfer,
+            )
     except RuntimeError as exc:
+        balance_prefetch.discard(prefetch)
         raise HTTPException(status_code=503, detail=f"Gemini unavailable: {exc}")
+    fast_intent.record_path("gemini")
+    return intent_data, {"path": "gemini", **(debug_info or {})}, prefetch
+
+
+async def _settle_prefetch(intent: str, prefetch: asyncio.Task | None, debug_info: dict) -> dict | None:
+    """Returns the prefetched balance for CHECK_BALANCE turns and discards it otherwise."""
+    if prefetch is None:
+        return None
+    if intent != "CHECK_BALANCE":
+        balance_prefetch.discard(prefetch)
+        debug_info["balance_prefetch"] = "discarded"
+        return None
+    with tracing.span("chat.balance_prefetch_wait"):
+        prefetched = await balance_prefetch.take(prefetch)
+    debug_info["balance_prefetch"] = "used" if prefetched else "failed"
+    return prefetched
 
-    intent: str = intent_data.get("intent", "CLARIFY")
 
+def _dispatch(request: Request, intent: str, intent_data: dict, prefetched: dict | None = None) -> dict:
     dispatch = {
-        "CHECK_BALANCE":  lambda: _handle_check_balance(request, intent_data),
+        "CHECK_BALANCE":  lambda: _handle_check_balance(request, intent_data, prefetched),
         "TRANSFER_DRAFT": lambda: _handle_transfer_draft(request, intent_data),
         "CONFIRM":        lambda: _handle_confirm(request, intent_data),
         "CANCEL":         lambda: _handle_cancel(request, intent_data),
         "CLARIFY":        lambda: _handle_clarify(intent_data),
-        "HELP":           lambda: _handle_help(intent_data),
+        "HELP":           lambda: _handle_help(request, intent_data),
     }
 
     handler = dispatch.get(intent)
-    result = handler() if handler else {
-        "assistant_say": "I'm not sure how to help with that. Could you rephrase?",
-        "data": None,
-    }
+    if handler is None:
+        return {
+            "assistant_say": "I'm not sure how to help with that. Could you rephrase?",
+            "data": None,
+        }
+    with tracing.span("chat.dispatch", intent=intent):
+        return handler()
+
+
+def _payment_lock(request: Request, intent: str):
+    """
+    Per-user lock held while a CONFIRM runs, so concurrent confirms (from
+    any worker) execute one at a time. Other intents don't lock.
+    """
+    user_id = request.session.get("user_id") or request.session.get("stripe_customer_id")
+    if intent != "CONFIRM" or not user_id:
+        return contextlib.nullcontext()
+    return locks.hold(locks.user_key(user_id))
+
+
+def _wants_timings(request: Request) -> bool:
+    return bool(request.headers.get(tracing.TIMINGS_HEADER))
+
+
+@router.post("/api/chat")
+async def chat(request: Request, body: ChatRequest):
+    """
+    Single conversational turn.
+
+    1. Classify intent (fast-path rules, then Gemini).
+    2. Dispatch to the appropriate handler.
+    3. Return { intent, assistant_say, data, debug }.
+
+    Send the X-Debug-Timings header to get the turn's spans as debug.timings.
+    """
+    intent_data, debug_info, prefetch = await _classify_turn(request, body.transcript)
+    intent: str = intent_data.get("intent", "CLARIFY")
+    prefetched = await _settle_prefetch(intent, prefetch, debug_info)
+    try:
+        async with _payment_lock(request, intent):
+            # Handlers make blocking Stripe / TrueLayer / storage calls; keep them off the loop
+            result = await asyncio.to_thread(_dispatch, request, intent, intent_data, prefetched)
+    except locks.LockTimeout:
+        raise HTTPException(status_code=409, detail="Another payment is in progress. Please try again.")
+    if _wants_timings(request):
+        debug_info["timings"] = tracing.timings()
 
     return JSONResponse(content={
         "intent": intent,
@@ -404,6 +504,89 @@ async def chat(request: Request, body: ChatRequest):
     })
 
 
+# ---------------------------------------------------------------------------
+# Streaming chat endpoint
+# ---------------------------------------------------------------------------
+
+# Intents whose handlers call TrueLayer / Stripe / Twilio; everything else is
+# answered straight from the classification.
+SLOW_INTENTS = {"CHECK_BALANCE", "CONFIRM"}
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _ack_message(intent: str, pending: dict | None) -> str:
+    if intent == "CONFIRM" and pending:
+        return f"Okay, sending {float(pending['amount']):.2f} {pending.get('currency', 'EUR')} to {pending['payee_label']} now."
+    if intent == "CONFIRM":
+        return "One moment."
+    return "Let me check your balance."
+
+
+@router.post("/api/chat/stream")
+async def chat_stream(request: Request, body: ChatRequest):
+    """
+    Streaming variant of /api/chat. Emits Server-Sent Events:
+
+    - intent: {intent, debug} as soon as classification finishes
+    - ack:    {assistant_say} interim line to speak while a slow intent runs
+    - result: the same payload /api/chat returns
+
+    The session cookie is written when the stream starts, so everything that
+    changes the session happens before the response is returned. A confirmed
+    transfer is taken off the session up front; if the payment then fails
+    the user has to draft it again rather than risk it being confirmed twice.
+    """
+    intent_data, debug_info, prefetch = await _classify_turn(request, body.transcript)
+    intent: str = intent_data.get("intent", "CLARIFY")
+    if intent != "CHECK_BALANCE":
+        await _settle_prefetch(intent, prefetch, debug_info)
+    wants_timings = _wants_timings(request)
+
+    if intent in SLOW_INTENTS:
+        # Slow handlers run after the headers are sent, against a snapshot of the session
+        snapshot = SimpleNamespace(session=dict(request.session))
+        pending = request.session.get("pending_transfer") if intent == "CONFIRM" else None
+        if pending and request.session.get("stripe_customer_id"):
+            request.session.pop("pending_transfer")
+        ack = _ack_message(intent, pending)
+        result = None
+    else:
+        snapshot = None
+        ack = None
+        result = await asyncio.to_thread(_dispatch, request, intent, intent_data)
+
+    async def _stream():
+        yield _sse("intent", {"intent": intent, "debug": debug_info})
+        final = result
+        if final is None:
+            yield _sse("ack", {"assistant_say": ack})
+            try:
+                prefetched = await _settle_prefetch(intent, prefetch, debug_info)
+                async with _payment_lock(snapshot, intent):
+                    final = await asyncio.to_thread(_dispatch, snapshot, intent, intent_data, prefetched)
+            except Exception as exc:
+                print(f"❌ Streaming chat handler failed: {exc}")
+                yield _sse("error", {"assistant_say": "Something went wrong. Please try again."})
+                return
+        if wants_timings:
+            debug_info["timings"] = tracing.timings()
+        yield _sse("result", {
+            "intent": intent,
+            "assistant_say": final["assistant_say"],
+            "data": final.get("data"),
+            "debug": debug_info,
+        })
+
+    return StreamingResponse(
+        _stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # ---------------------------------------------------------------------------
 # Debug endpoint
 # ---------------------------------------------------------------------------
@@ -418,4 +601,9 @@ async def get_chat_state(request: Request):
         "pending_transfer": request.session.get("pending_transfer"),
         "carer_linked": bool(request.session.get("carer_phone")),
         "user_name": request.session.get("user_name"),
+        "classifier": fast_intent.stats(),
+        "intent_cache": _gemini_client.cache.stats() if _gemini_client else None,
+        "gemini_output": _gemini_client.stats() if _gemini_client else None,
+        "balance_prefetch": balance_prefetch.stats(),
+        "locks": locks.stats(),
     })
\ No newline at end of file
@@ -5,11 +5,7 @@ from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
 from routes.payments import process_payment, list_payee_labels
-from services.alerts import (
-    send_carer_sms,
-    build_fraud_alert_message,
-    build_large_payment_message,
-)
+from services import alert_aggregator
 
 router = APIRouter()
 
@@ -31,12 +27,12 @@ class PaymentRequest(BaseModel):
 # ---------------------------------------------------------------------------
 
 @router.get("/api/payments/payees")
-async def get_payees():
+async def get_payees(request: Request):
     """
-    Returns the list of allowed payee labels.
+    Returns the list of allowed payee labels for the current user.
     Feed this into the Gemini intent classifier as payees_allowed.
     """
-    return JSONResponse(content={"payees": list_payee_labels()})
+    return JSONResponse(content={"payees": list_payee_labels(request.session.get("user_id"))})
 
 
 @router.post("/api/payments/create")
@@ -66,6 +62,7 @@ async def create_payment(request: Request, body: PaymentRequest):
                 "carer_name": carer_name,
                 "user_name": user_name,
             },
+            user_id=request.session.get("user_id"),
         )
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -74,25 +71,16 @@ async def create_payment(request: Request, body: PaymentRequest):
 
     radar = result.get("radar")
 
-    # Alert carer on fraud risk
+    # Alert carer on fraud risk (merged with the large-payment reason and the webhook's repeats)
     if carer_phone and radar and radar.get("should_alert"):
-        send_carer_sms(
-            carer_phone=carer_phone,
-            message=build_fraud_alert_message(
-                user_name,
-                body.amount,
-                "EUR",
-                radar["risk_level"],
-                radar["alma_message"],
-            ),
+        alert_aggregator.submit(
+            carer_phone, result.get("id"), user_name, body.amount, "EUR", "fraud",
+            risk_level=radar["risk_level"], alma_message=radar["alma_message"],
         )
 
     # Alert carer on large payment
     if carer_phone and body.amount >= LARGE_PAYMENT_THRESHOLD:
-        send_carer_sms(
-            carer_phone=carer_phone,
-            message=build_large_payment_message(user_name, body.amount, "EUR"),
-        )
+        alert_aggregator.submit(carer_phone, result.get("id"), user_name, body.amount, "EUR", "large")
 
     payee_type = result.get("payee_type", "merchant")
     alma_message = (
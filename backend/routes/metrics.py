@@ -0,0 +1,62 @@
+"""
+routes/metrics.py
+
+GET /metrics in the Prometheus text format (services/metrics.py).
+
+Request, upstream and storage metrics are recorded as they happen. The
+gauges below read queue depths and totals from each background component's
+own stats at scrape time, so nothing extra runs between scrapes.
+"""
+
+from __future__ import annotations
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from services import (
+    alert_aggregator, alert_outbox, alert_queue, balance_prefetch, events, ledger, locks, metrics,
+    reconciliation, tracing, webhook_queue, webhook_store,
+)
+
+router = APIRouter(tags=["Metrics"])
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _queue_depths() -> dict[tuple, float]:
+    return {
+        ("alert_queue",): alert_queue.metrics()["queue_depth"],
+        ("alert_outbox",): alert_outbox.stats()["pending"],
+        ("alert_aggregator",): alert_aggregator.metrics()["pending"],
+        ("webhook_queue",): webhook_queue.metrics()["queue_depth"],
+        ("webhook_store",): webhook_store.stats()["pending"],
+        ("event_bus",): events.stats()["queued"],
+    }
+
+
+def _reconcile_totals() -> dict[tuple, float]:
+    totals = reconciliation.metrics()
+    return {(key,): totals[key] for key in ("checked", "updated", "not_found", "expired", "pages", "errors")}
+
+
+metrics.gauge("alma_queue_depth", "Items waiting in each background queue.", _queue_depths, labels=("queue",))
+metrics.gauge("alma_alert_outbox_dead", "Alerts that exhausted their retries.", lambda: alert_outbox.stats()["dead"])
+metrics.gauge("alma_event_subscribers", "Open overseer event streams.", lambda: events.stats()["subscribers"])
+metrics.gauge("alma_events_dropped_total", "Events dropped from full subscriber queues.",
+              lambda: events.stats()["dropped"], kind="counter")
+metrics.gauge("alma_locks_held", "Keyed locks currently held.", lambda: locks.stats()["held"])
+metrics.gauge("alma_locks_waiting", "Requests waiting for a keyed lock.", lambda: locks.stats()["waiting"])
+metrics.gauge("alma_lock_contended_total", "Lock acquisitions that had to wait.",
+              lambda: locks.stats()["contended"], kind="counter")
+metrics.gauge("alma_lock_timeouts_total", "Lock waits that timed out.", lambda: locks.stats()["timeouts"], kind="counter")
+metrics.gauge("alma_reconcile_total", "Reconciliation job totals by kind.", _reconcile_totals,
+              labels=("kind",), kind="counter")
+metrics.gauge("alma_ledger_journal_entries", "Entries posted to the ledger journal.", lambda: ledger.stats()["seq"])
+metrics.gauge("alma_trace_spans_dropped_total", "Spans dropped because the trace export queue was full.",
+              lambda: tracing.stats()["dropped"], kind="counter")
+metrics.gauge("alma_balance_cache_entries", "Cached TrueLayer balances.", lambda: balance_prefetch.stats()["cached"])
+
+
+@router.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type=PROMETHEUS_CONTENT_TYPE)
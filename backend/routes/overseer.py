@@ -0,0 +1,228 @@
+"""
+routes/overseer.py
+
+One-call overseer dashboard.
+
+GET /api/overseer/dashboard returns a page of the users this overseer
+supervises (those whose own overseer password matched at login; see
+supervised_users) with up to four summary sections each:
+
+    profile       name, email, linked bank account
+    balance       platform ledger balance and, if a bank is linked, the bank balance
+    transactions  latest platform transactions
+    alerts        recent carer alerts about those transactions
+
+Every (user, section) pair is fetched concurrently, with at most
+OVERSEER_DASHBOARD_CONCURRENCY blocking fetches on threads at once, and is
+cached for OVERSEER_SECTION_TTL_S. A section that fails is reported under
+that user's "errors" and does not fail the page.
+
+GET /api/overseer/events is a Server-Sent Events stream of what happens to
+those users as it happens (services/events.py): payments created, transfers
+sent, chat confirmations, webhook settlements and carer alerts.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import time
+
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+
+from services import alert_aggregator, balance_prefetch, events, ledger, tracing, transaction_storage, user_storage
+
+router = APIRouter(tags=["Overseer"])
+
+OVERSEER_DASHBOARD_CONCURRENCY = int(os.getenv("OVERSEER_DASHBOARD_CONCURRENCY", 8))
+OVERSEER_SECTION_TTL_S = float(os.getenv("OVERSEER_SECTION_TTL_S", 15))
+OVERSEER_CACHE_MAX_ENTRIES = 5000
+DASHBOARD_TRANSACTIONS = 5
+DASHBOARD_ALERTS = 5
+EVENT_HEARTBEAT_S = float(os.getenv("EVENT_HEARTBEAT_S", 15))
+
+_cache: dict[tuple, tuple[float, dict]] = {}   # (section, user_id, currency) -> (fetched_at, section)
+_semaphore: asyncio.Semaphore | None = None
+_counters = {"requests": 0, "cache_hits": 0, "fetches": 0, "errors": 0}
+
+
+def _profile(user: dict, currency: str) -> dict:
+    return {
+        "name": user.get("name"),
+        "email": user.get("email"),
+        "phone": user.get("phone"),
+        "bank_linked": bool(user.get("access_token")),
+        "primary_account_name": user.get("primary_account_name"),
+        "created_at": user.get("created_at"),
+    }
+
+
+def _balance(user: dict, currency: str) -> dict:
+    section = {"currency": currency, "platform": ledger.balance(user["user_id"], currency), "bank": None}
+    if user.get("access_token"):
+        result = balance_prefetch.fetch_balance(user["access_token"], user.get("primary_account_id") or None)
+        if result["error"]:
+            raise RuntimeError(f"bank {result['error'][0]}: {result['error'][1]}")
+        balances = (result["balance"] or {}).get("results") or []
+        section["bank"] = balances[0] if balances else None
+    return section
+
+
+def _transactions(user: dict, currency: str) -> dict:
+    transactions = transaction_storage.get_user_transactions(user["user_id"], limit=DASHBOARD_TRANSACTIONS)
+    return {"transactions": transactions}
+
+
+def _alerts(user: dict, currency: str) -> dict:
+    # Alerts are keyed by provider payment ID, so look at a longer slice of history than we show
+    recent = transaction_storage.get_user_transactions(user["user_id"], limit=DASHBOARD_TRANSACTIONS * 10)
+    payment_ids = [t["provider_id"] for t in recent if t.get("provider_id")]
+    return {"alerts": alert_aggregator.recent_alerts(payment_ids)[:DASHBOARD_ALERTS]}
+
+
+SECTIONS = {
+    "profile": _profile,
+    "balance": _balance,
+    "transactions": _transactions,
+    "alerts": _alerts,
+}
+
+
+def _cache_put(key: tuple, value: dict, now: float) -> None:
+    if len(_cache) >= OVERSEER_CACHE_MAX_ENTRIES:
+        for stale in [k for k, (at, _) in _cache.items() if now - at > OVERSEER_SECTION_TTL_S]:
+            del _cache[stale]
+        if len(_cache) >= OVERSEER_CACHE_MAX_ENTRIES:
+            _cache.clear()
+    _cache[key] = (now, value)
+
+
+async def _section(name: str, user: dict, currency: str) -> dict:
+    """Fetches one section, from cache when fresh. Raises whatever the fetch raised."""
+    global _semaphore
+    key = (name, user["user_id"], currency)
+    hit = _cache.get(key)
+    if hit is not None and time.monotonic() - hit[0] <= OVERSEER_SECTION_TTL_S:
+        _counters["cache_hits"] += 1
+        return hit[1]
+
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(OVERSEER_DASHBOARD_CONCURRENCY)
+    async with _semaphore:
+        _counters["fetches"] += 1
+        with tracing.span("overseer.section", section=name):
+            value = await asyncio.to_thread(SECTIONS[name], user, currency)
+    _cache_put(key, value, time.monotonic())
+    return value
+
+
+async def _summary(user: dict, sections: list[str], currency: str) -> dict:
+    results = await asyncio.gather(
+        *(_section(name, user, currency) for name in sections), return_exceptions=True
+    )
+    summary = {"user_id": user["user_id"], "name": user.get("name"), "errors": {}}
+    for name, result in zip(sections, results):
+        if isinstance(result, Exception):
+            _counters["errors"] += 1
+            print(f"⚠️ Overseer dashboard {name} failed for {user['user_id']}: {result}")
+            summary[name] = None
+            summary["errors"][name] = str(result)
+        else:
+            summary[name] = result
+    return summary
+
+
+def supervised_users(request: Request) -> list[dict]:
+    """
+    Users the logged-in overseer may see: only those whose own overseer
+    password matched at login, and who still name this overseer's number.
+    """
+    if not request.session.get("is_overseer"):
+        raise HTTPException(status_code=401, detail="Not authenticated as overseer")
+    number = user_storage.normalise_phone(request.session.get("overseer_number"))
+    granted = request.session.get("overseer_user_ids") or []
+    users = []
+    for user_id in granted:
+        user = user_storage.get_user(user_id)
+        if user and number and user_storage.normalise_phone(user.get("overseer_number")) == number:
+            users.append(user)
+    return users
+
+
+@router.get("/api/overseer/dashboard")
+async def overseer_dashboard(
+    request: Request,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100),
+    sections: str = Query(",".join(SECTIONS)),
+    currency: str = Query("GBP"),
+):
+    """
+    Returns a page of supervised users with the requested summary sections
+    (comma-separated; defaults to all of them).
+    """
+    users = supervised_users(request)
+    wanted = [name.strip() for name in sections.split(",") if name.strip()]
+    unknown = [name for name in wanted if name not in SECTIONS]
+    if unknown or not wanted:
+        raise HTTPException(status_code=400, detail=f"Unknown sections: {', '.join(unknown) or '(none)'}")
+
+    _counters["requests"] += 1
+    start = (page - 1) * page_size
+    page_users = users[start:start + page_size]
+    with tracing.span("overseer.dashboard", users=len(page_users), sections=len(wanted)):
+        summaries = await asyncio.gather(*(_summary(u, wanted, currency.upper()) for u in page_users))
+
+    return {
+        "success": True,
+        "page": page,
+        "page_size": page_size,
+        "total_users": len(users),
+        "next_page": page + 1 if start + page_size < len(users) else None,
+        "users": summaries,
+    }
+
+
+def _sse(event: dict) -> str:
+    return f"id: {event['id']}\nevent: {event['topic']}\ndata: {json.dumps(event)}\n\n"
+
+
+@router.get("/api/overseer/events")
+async def overseer_events(request: Request):
+    """
+    Streams events about supervised users as Server-Sent Events, with the
+    topic as the SSE event name. A client that falls behind gets a "lagged"
+    event with the number of events it missed; reconnecting with
+    Last-Event-ID replays recent events it hasn't seen.
+    """
+    user_ids = [u["user_id"] for u in supervised_users(request)]
+    try:
+        subscriber = events.subscribe(user_ids, request.headers.get("last-event-id"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+
+    async def stream():
+        try:
+            yield f"event: ready\ndata: {json.dumps({'users': len(user_ids)})}\n\n"
+            while not await request.is_disconnected():
+                batch, dropped = await subscriber.get(EVENT_HEARTBEAT_S)
+                if dropped:
+                    yield f"event: lagged\ndata: {json.dumps({'dropped': dropped})}\n\n"
+                for event in batch:
+                    yield _sse(event)
+                if not batch and not dropped:
+                    yield ": keepalive\n\n"
+        finally:
+            events.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def stats() -> dict:
+    return {**_counters, "cached_sections": len(_cache)}
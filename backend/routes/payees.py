@@ -0,0 +1,113 @@
+import asyncio
+
+from fastapi import APIRouter, Request, HTTPException, Query
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from typing import List, Optional
+from services import payee_storage
+from services.stripe import is_connected_account
+
+router = APIRouter(tags=["Payees"])
+
+
+# --- Request models ---
+
+class CreatePayeeRequest(BaseModel):
+    label: str
+    type: str = "merchant"            # "merchant" or "person"
+    stripe_account: str = ""          # Stripe Connect account for person payees
+    aliases: List[str] = []           # other names the user says, e.g. "Dunnes"
+
+
+class UpdatePayeeRequest(BaseModel):
+    label: Optional[str] = None
+    type: Optional[str] = None
+    stripe_account: Optional[str] = None
+    aliases: Optional[List[str]] = None
+
+
+def _require_user(request: Request) -> str:
+    user_id = request.session.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="No user session found")
+    return user_id
+
+
+async def _check_stripe_account(stripe_account: Optional[str]) -> None:
+    """Rejects a Connect account that isn't well-formed or doesn't belong to this platform."""
+    if not stripe_account:
+        return
+    if not payee_storage.STRIPE_ACCOUNT_RE.match(stripe_account):
+        raise HTTPException(status_code=400, detail="Stripe account must be a Connect account ID (acct_...)")
+    try:
+        connected = await asyncio.to_thread(is_connected_account, stripe_account)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Could not verify Stripe account: {e}")
+    if not connected:
+        raise HTTPException(status_code=400, detail=f"{stripe_account} is not a Connect account on this platform")
+
+
+# --- Routes ---
+
+@router.get("/api/payees")
+async def list_payees(request: Request):
+    """
+    Returns the current user's payees.
+    Users who haven't edited their payees get the default list.
+    """
+    return JSONResponse(content={"payees": payee_storage.list_payees(request.session.get("user_id"))})
+
+
+@router.get("/api/payees/match")
+async def match_payees(request: Request, q: str = Query(..., min_length=1), limit: int = Query(3, ge=1, le=10)):
+    """
+    Ranks the user's payees against a spoken name, with confidence scores.
+    `resolved` is the payee a chat turn would pick without asking, if any.
+    """
+    user_id = request.session.get("user_id")
+    matches = payee_storage.match_payees(user_id, q, limit)
+    resolved = payee_storage.resolve_payee(user_id, q)
+    return JSONResponse(content={
+        "query": q,
+        "matches": [{"label": m.label, "score": m.score, "matched": m.matched} for m in matches],
+        "resolved": resolved["label"] if resolved else None,
+    })
+
+
+@router.post("/api/payees")
+async def create_payee(request: Request, body: CreatePayeeRequest):
+    user_id = _require_user(request)
+    await _check_stripe_account(body.stripe_account)
+    try:
+        payee = payee_storage.add_payee(user_id, body.label, body.type, body.stripe_account, body.aliases)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content={"success": True, "payee": payee})
+
+
+@router.patch("/api/payees/{label}")
+async def update_payee(request: Request, label: str, body: UpdatePayeeRequest):
+    user_id = _require_user(request)
+    await _check_stripe_account(body.stripe_account)
+    try:
+        payee = payee_storage.update_payee(
+            user_id,
+            label,
+            new_label=body.label,
+            payee_type=body.type,
+            stripe_account=body.stripe_account,
+            aliases=body.aliases,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if payee is None:
+        raise HTTPException(status_code=404, detail=f"Payee '{label}' not found")
+    return JSONResponse(content={"success": True, "payee": payee})
+
+
+@router.delete("/api/payees/{label}")
+async def delete_payee(request: Request, label: str):
+    user_id = _require_user(request)
+    if not payee_storage.delete_payee(user_id, label):
+        raise HTTPException(status_code=404, detail=f"Payee '{label}' not found")
+    return JSONResponse(content={"success": True, "message": f"Payee '{label}' removed"})
@@ -4,13 +4,8 @@ from pydantic import BaseModel
 import stripe
 import os
 from dotenv import load_dotenv
-from services.stripe import create_payment_intent, get_radar_risk
-from services.alerts import (
-    send_carer_sms,
-    build_fraud_alert_message,
-    build_large_payment_message,
-)
-from services import user_storage, transaction_storage
+from services.stripe import create_payment_intent, get_radar_risk, ledger_status
+from services import user_storage, transaction_storage, alert_aggregator, payee_storage, ledger, locks, events
 
 load_dotenv()
 
@@ -26,6 +21,45 @@ class CreatePaymentRequest(BaseModel):
     description: str
 
 
+def list_payee_labels(user_id: str = None) -> list[str]:
+    """Payee labels for a user (the defaults when user_id is None)."""
+    return payee_storage.list_labels(user_id)
+
+
+def process_payment(
+    customer_id: str,
+    amount_euros: float,
+    payee_label: str,
+    description: str,
+    metadata: dict = None,
+    user_id: str = None,
+) -> dict:
+    """
+    Pays one of the user's payees: a plain PaymentIntent for merchants, a
+    destination charge to the payee's Connect account for people.
+
+    Raises:
+        ValueError: if the payee is unknown or a person payee has no Connect account
+    """
+    payee = payee_storage.get_payee(user_id, payee_label)
+    if payee is None:
+        raise ValueError(f"Unknown payee '{payee_label}'")
+    destination = None
+    if payee["type"] == "person":
+        destination = payee.get("stripe_account")
+        if not destination:
+            raise ValueError(f"{payee['label']} has no Stripe Connect account set up")
+    result = create_payment_intent(
+        customer_id=customer_id,
+        amount_euros=amount_euros,
+        description=description,
+        metadata=metadata,
+        payee=payee["label"],
+        transfer_destination=destination,
+    )
+    return {**result, "payee_type": payee["type"]}
+
+
 # --- Routes ---
 
 @router.post("/api/payments/create")
@@ -55,27 +89,49 @@ async def create_payment(request: Request, body: CreatePaymentRequest):
             }
         )
 
+        # Blocked by the local risk engine before reaching Stripe; nothing was charged
+        if result["status"] == "blocked":
+            return JSONResponse(content={
+                "success": False,
+                **result,
+                "alma_message": result["radar"]["alma_message"],
+            })
+
+        # Ledger row keyed by the PaymentIntent, settled later by the webhook or reconciliation
+        if result.get("id"):
+            transaction = transaction_storage.record_transaction(
+                user_id=request.session.get("user_id") or customer_id,
+                transaction_type="PAYMENT",
+                amount=body.amount,
+                currency="EUR",
+                from_account_id=customer_id,
+                description=body.description,
+                status=ledger_status(result["status"]),
+                provider_id=result["id"],
+            )
+            events.publish("payment.created", transaction["user_id"], {
+                "transaction_id": transaction["transaction_id"],
+                "payment_id": result["id"],
+                "amount": body.amount,
+                "currency": "EUR",
+                "description": body.description,
+                "status": transaction["status"],
+                "risk_level": (result.get("radar") or {}).get("risk_level"),
+            })
+
         radar = result.get("radar")
 
         # FIX 2: alert carer on fraud-flagged payments created here, not just via webhook
+        # (the aggregator merges this with the large-payment reason and the webhook's repeats)
         if carer_phone and radar and radar.get("should_alert"):
-            send_carer_sms(
-                carer_phone=carer_phone,
-                message=build_fraud_alert_message(
-                    user_name,
-                    body.amount,
-                    "EUR",
-                    radar["risk_level"],
-                    radar["alma_message"]
-                )
+            alert_aggregator.submit(
+                carer_phone, result.get("id"), user_name, body.amount, "EUR", "fraud",
+                risk_level=radar["risk_level"], alma_message=radar["alma_message"],
             )
 
         # Alert carer if large payment
         if carer_phone and body.amount >= LARGE_PAYMENT_THRESHOLD:
-            send_carer_sms(
-                carer_phone=carer_phone,
-                message=build_large_payment_message(user_name, body.amount, "EUR")
-            )
+            alert_aggregator.submit(carer_phone, result.get("id"), user_name, body.amount, "EUR", "large")
 
         alma_message = (
             radar["alma_message"]
@@ -132,18 +188,12 @@ async def test_radar(request: Request):
 
         radar = None
         if intent.latest_charge:
-            radar = get_radar_risk(intent.latest_charge)
+            radar = get_radar_risk(intent.latest_charge, payment_intent_id=intent.id)
 
         if carer_phone and radar and radar.get("should_alert"):
-            send_carer_sms(
-                carer_phone=carer_phone,
-                message=build_fraud_alert_message(
-                    user_name,
-                    50.0,
-                    "EUR",
-                    radar["risk_level"],
-                    radar["alma_message"]
-                )
+            alert_aggregator.submit(
+                carer_phone, intent.id, user_name, 50.0, "EUR", "fraud",
+                risk_level=radar["risk_level"], alma_message=radar["alma_message"],
             )
 
         return JSONResponse(content={
@@ -183,7 +233,8 @@ class SendToUserRequest(BaseModel):
 async def send_to_user(body: SendToUserRequest):
     """
     Send money to another platform user.
-    Records an outgoing transaction for the sender and an incoming one for the recipient.
+    Posts the transfer to the platform ledger (rejected if the sender's balance is too low),
+    then records an outgoing transaction for the sender and an incoming one for the recipient.
     Both appear in each user's platform transaction history.
     """
     if body.sender_user_id == body.recipient_user_id:
@@ -202,27 +253,52 @@ async def send_to_user(body: SendToUserRequest):
 
     description = body.description.strip() if body.description else ""
 
-    transaction_storage.record_transaction(
-        user_id=body.sender_user_id,
-        transaction_type="SENT",
-        amount=body.amount,
-        currency=body.currency,
-        from_account_id=body.sender_user_id,
-        to_account_id=body.recipient_user_id,
-        description=description or f"Sent to {recipient['name']}",
-        status="COMPLETED",
-    )
+    # Serialise against other transfers touching either user, in this worker or another
+    try:
+        async with locks.hold(locks.user_key(body.sender_user_id), locks.user_key(body.recipient_user_id)):
+            try:
+                entry = ledger.transfer(
+                    body.sender_user_id,
+                    body.recipient_user_id,
+                    body.amount,
+                    body.currency,
+                    description or f"{sender['name']} to {recipient['name']}",
+                )
+            except ValueError as e:  # includes ledger.InsufficientFunds
+                raise HTTPException(status_code=400, detail=str(e))
+
+            sent = transaction_storage.record_transaction(
+                user_id=body.sender_user_id,
+                transaction_type="SENT",
+                amount=body.amount,
+                currency=body.currency,
+                from_account_id=body.sender_user_id,
+                to_account_id=body.recipient_user_id,
+                description=description or f"Sent to {recipient['name']}",
+                status="COMPLETED",
+            )
 
-    transaction_storage.record_transaction(
-        user_id=body.recipient_user_id,
-        transaction_type="RECEIVED",
-        amount=body.amount,
-        currency=body.currency,
-        from_account_id=body.sender_user_id,
-        to_account_id=body.recipient_user_id,
-        description=description or f"Received from {sender['name']}",
-        status="COMPLETED",
-    )
+            received = transaction_storage.record_transaction(
+                user_id=body.recipient_user_id,
+                transaction_type="RECEIVED",
+                amount=body.amount,
+                currency=body.currency,
+                from_account_id=body.sender_user_id,
+                to_account_id=body.recipient_user_id,
+                description=description or f"Received from {sender['name']}",
+                status="COMPLETED",
+            )
+    except locks.LockTimeout:
+        raise HTTPException(status_code=409, detail="Another transfer is in progress. Please try again.")
+
+    for topic, row, other in (("transfer.sent", sent, recipient), ("transfer.received", received, sender)):
+        events.publish(topic, row["user_id"], {
+            "transaction_id": row["transaction_id"],
+            "amount": body.amount,
+            "currency": body.currency,
+            "counterparty": other["name"],
+            "description": row["description"],
+        })
 
     return {
         "success": True,
@@ -231,18 +307,37 @@ async def send_to_user(body: SendToUserRequest):
         "recipient": recipient["name"],
         "amount": body.amount,
         "currency": body.currency,
+        "ledger_entry_id": entry.entry_id,
+        "balance": ledger.balance(body.sender_user_id, body.currency),
     }
 
 
+@router.get("/api/payments/platform-balance")
+async def platform_balance(user_id: str = Query(...), currency: str = Query("GBP")):
+    """Returns a user's platform ledger balance for one currency."""
+    if not user_storage.get_user(user_id):
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"user_id": user_id, "currency": currency.upper(), "balance": ledger.balance(user_id, currency)}
+
+
 @router.get("/api/payments/platform-history")
-async def platform_history(user_id: str = Query(...), limit: int = Query(50, ge=1, le=500)):
+async def platform_history(
+    user_id: str = Query(...),
+    limit: int = Query(50, ge=1, le=500),
+    before: str = Query(None),
+):
     """
-    Returns platform transaction history (sent/received) for a user.
+    Returns platform transaction history (sent/received) for a user, latest first.
+    Pass the previous page's next_cursor as `before` to fetch older transactions.
     No session auth required — intended for the onboarding dashboard.
     """
     user = user_storage.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    transactions = transaction_storage.get_user_transactions(user_id, limit=limit)
-    return {"transactions": transactions, "count": len(transactions)}
\ No newline at end of file
+    try:
+        transactions = transaction_storage.get_user_transactions(user_id, limit=limit, before=before)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    next_cursor = transactions[-1]["transaction_id"] if len(transactions) == limit else None
+    return {"transactions": transactions, "count": len(transactions), "next_cursor": next_cursor}
\ No newline at end of file
@@ -353,9 +353,10 @@ async def initiate_payment(request: PaymentRequest, authorization: str = Header(
                 transaction_type="payment",
                 amount=request.amount,
                 currency=request.currency,
+                to_account_id=request.beneficiary_account,
+                description=f"Payment to {request.beneficiary_name} ({request.beneficiary_account})",
                 status="initiated",
-                details=f"Payment to {request.beneficiary_name} ({request.beneficiary_account})",
-                transaction_id=payment_id
+                provider_id=payment_id
             )
         
     
@@ -422,7 +423,7 @@ async def initiate_transfer(request: TransferRequest, authorization: str = Heade
 
 
 @router.get("/transactions")
-async def get_user_transactions(user_id: str = Query(...), limit: int = Query(50, ge=1, le=500), authorization: str = Header(None)):
+async def get_user_transactions(user_id: str = Query(...), limit: int = Query(50, ge=1, le=500), before: str = Query(None), authorization: str = Header(None)):
     """
     Get transaction history for a user.
     Requires valid Bearer token for authorization.
@@ -430,10 +431,11 @@ async def get_user_transactions(user_id: str = Query(...), limit: int = Query(50
     Args:
         user_id: User's unique identifier
         limit: Maximum number of transactions to return (1-500, default 50)
+        before: Cursor from a previous page's next_cursor, for older transactions
         authorization: Bearer token for authentication
     
     Returns:
-        dict with list of transactions
+        dict with list of transactions and next_cursor (None on the last page)
     """
     # Verify Bearer token is present
     if not authorization or not authorization.startswith("Bearer "):
@@ -449,26 +451,35 @@ async def get_user_transactions(user_id: str = Query(...), limit: int = Query(50
     if user.get("access_token") != token:
         raise HTTPException(status_code=403, detail="Token does not match this user")
     
-    transactions = transaction_storage.get_user_transactions(user_id, limit=limit)
+    try:
+        transactions = transaction_storage.get_user_transactions(user_id, limit=limit, before=before)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     return {
         "user_id": user_id,
         "transactions": transactions,
-        "count": len(transactions)
+        "count": len(transactions),
+        "next_cursor": transactions[-1]["transaction_id"] if len(transactions) == limit else None
     }
 
 
 @router.get("/platform-history")
-async def get_platform_history(user_id: str = Query(...), limit: int = Query(50, ge=1, le=500)):
+async def get_platform_history(user_id: str = Query(...), limit: int = Query(50, ge=1, le=500), before: str = Query(None)):
     """
     Get platform transaction history (sent/received between app users).
     No TrueLayer auth required — used for the internal transfer feed.
+    Pass next_cursor back as `before` for the next (older) page.
     """
     user = user_storage.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail=f"User {user_id} not found")
 
-    transactions = transaction_storage.get_user_transactions(user_id, limit=limit)
-    return {"user_id": user_id, "transactions": transactions, "count": len(transactions)}
+    try:
+        transactions = transaction_storage.get_user_transactions(user_id, limit=limit, before=before)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    next_cursor = transactions[-1]["transaction_id"] if len(transactions) == limit else None
+    return {"user_id": user_id, "transactions": transactions, "count": len(transactions), "next_cursor": next_cursor}
 
 
 @router.get("/callback")
@@ -1,13 +1,19 @@
 from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from services.issuing import create_issuing_cardholder
-from services.stripe import create_stripe_customer, get_stripe_customer
-from services import user_storage
+from services.stripe import get_stripe_customer
+from services import user_storage, onboarding
+from routes.overseer import supervised_users
 import hashlib
+import hmac
+import os
 
 router = APIRouter()
 
+# Bulk onboarding is for care organisations' admins; unset disables it
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY", "")
+ADMIN_KEY_HEADER = "X-Admin-Key"
+
 
 class CreateUserRequest(BaseModel):
     name: str = None
@@ -18,6 +24,11 @@ class CreateUserRequest(BaseModel):
     overseer_password: str = None
 
 
+class BulkOnboardRequest(BaseModel):
+    users: list[CreateUserRequest]
+    concurrency: int = None
+
+
 class LoginRequest(BaseModel):
     email: str
     password: str
@@ -34,6 +45,25 @@ def verify_password(password: str, hashed: str) -> bool:
     return hash_password(password) == hashed
 
 
+def _require_admin(request: Request) -> None:
+    if not ADMIN_API_KEY:
+        raise HTTPException(status_code=403, detail="Bulk onboarding is disabled (ADMIN_API_KEY is not set)")
+    if not hmac.compare_digest(request.headers.get(ADMIN_KEY_HEADER, ""), ADMIN_API_KEY):
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+
+def _prepare_signup(entry: dict) -> dict:
+    """Hashes signup passwords into onboarding.provision_user keyword arguments."""
+    return {
+        "name": entry["name"],
+        "email": entry["email"],
+        "password_hash": hash_password(entry["password"]) if entry.get("password") else "",
+        "overseer_name": entry.get("overseer_name") or "",
+        "overseer_number": entry.get("overseer_number") or "",
+        "overseer_password_hash": hash_password(entry["overseer_password"]) if entry.get("overseer_password") else "",
+    }
+
+
 @router.post("/api/user/create")
 async def create_user(request: Request, body: CreateUserRequest):
     """
@@ -42,49 +72,20 @@ async def create_user(request: Request, body: CreateUserRequest):
     """
     if not body.name:
         raise HTTPException(status_code=400, detail="Name is required for signup")
+    if await onboarding.run_blocking(user_storage.get_user_by_email, body.email):
+        raise HTTPException(status_code=409, detail="An account with this email already exists")
     
     try:
-        # Create Stripe customer
-        customer_id = create_stripe_customer(body.name, body.email)
-        print(f"DEBUG: Customer created: {customer_id}")
-        
-        # Create Issuing cardholder (with mock address for testing)
-        address = {
-            "line1": "123 Test Street",
-            "city": "Dublin",
-            "postal_code": "D01 1AA"
-        }
-        
-        cardholder = create_issuing_cardholder(
-            name=body.name,
-            email=body.email,
-            phone="+353871234567",
-           
-            address=address
-        )
-        print(f"DEBUG: Cardholder created: {cardholder}")
-        
-        user_id = customer_id  # use stripe customer ID as the user_id
-        password_hash = hash_password(body.password) if body.password else ""
-        overseer_password_hash = hash_password(body.overseer_password) if body.overseer_password else ""
-
-        # Persist to CSV
-        user_storage.save_user(
-            user_id=user_id,
-            name=body.name,
-            email=body.email,
-            stripe_customer_id=customer_id,
-            cardholder_id=cardholder["cardholder_id"],
-            password_hash=password_hash,
-            overseer_name=body.overseer_name or "",
-            overseer_number=body.overseer_number or "",
-            overseer_password_hash=overseer_password_hash,
-        )
+        # Stripe customer + Issuing cardholder are created concurrently, then saved in one write
+        fields = await onboarding.run_blocking(_prepare_signup, body.model_dump())
+        user = await onboarding.onboard_user(**fields)
+        user_id = user["user_id"]
+        customer_id = user["stripe_customer_id"]
 
         # Store in session
         request.session["user_id"] = user_id
         request.session["stripe_customer_id"] = customer_id
-        request.session["cardholder_id"] = cardholder["cardholder_id"]
+        request.session["cardholder_id"] = user["cardholder_id"]
         request.session["user_name"] = body.name
         request.session["user_email"] = body.email
         request.session["overseer_name"] = body.overseer_name
@@ -95,27 +96,77 @@ async def create_user(request: Request, body: CreateUserRequest):
         
         # Store hashed password if provided
         if body.password:
-            request.session["password_hash"] = hash_password(body.password)
+            request.session["password_hash"] = user["password_hash"]
         
         # Store overseer password hash if provided
         if body.overseer_password:
-            request.session["overseer_password_hash"] = hash_password(body.overseer_password)
+            request.session["overseer_password_hash"] = user["overseer_password_hash"]
         
         return JSONResponse(content={
             "success": True,
             "user_id": user_id,
             "stripe_customer_id": customer_id,
-            "cardholder_id": cardholder["cardholder_id"],
+            "cardholder_id": user["cardholder_id"],
             "name": body.name,
             "email": body.email,
             "overseer_name": body.overseer_name,
             "overseer_number": body.overseer_number
         })
+    except ValueError as e:  # email registered by another request meanwhile
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         print(f"DEBUG: Error creating user: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error creating user: {str(e)}")
 
 
+@router.post("/api/user/bulk-onboard")
+async def bulk_onboard_users(request: Request, body: BulkOnboardRequest):
+    """
+    Onboards a batch of users for a care organisation. Requires the
+    X-Admin-Key header to match ADMIN_API_KEY.
+    Stripe calls run with bounded concurrency; each entry succeeds or fails
+    independently and all created users are saved in one write.
+    Does not touch the caller's session.
+    """
+    _require_admin(request)
+    if not body.users:
+        raise HTTPException(status_code=400, detail="At least one user is required")
+    if len(body.users) > onboarding.BULK_ONBOARDING_MAX_USERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {onboarding.BULK_ONBOARDING_MAX_USERS} users can be onboarded per request",
+        )
+    missing = [i for i, u in enumerate(body.users) if not u.name]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Name is required for signup (entries {missing})")
+
+    results = await onboarding.bulk_onboard(
+        [u.model_dump() for u in body.users],
+        prepare=_prepare_signup,
+        concurrency=body.concurrency,
+    )
+
+    created = [r for r in results if r["success"]]
+    return JSONResponse(content={
+        "success": len(created) == len(results),
+        "created": len(created),
+        "failed": len(results) - len(created),
+        "results": [
+            {
+                "index": r["index"],
+                "email": r["email"],
+                "success": r["success"],
+                **(
+                    {"user_id": r["user"]["user_id"], "cardholder_id": r["user"]["cardholder_id"]}
+                    if r["success"]
+                    else {"error": r["error"]}
+                ),
+            }
+            for r in results
+        ],
+    })
+
+
 @router.post("/api/user/login")
 async def login_user(request: Request, body: LoginRequest):
     """
@@ -222,54 +273,30 @@ class OverseerLoginRequest(BaseModel):
 async def overseer_login(request: Request, body: OverseerLoginRequest):
     """
     Authenticates overseer by phone number and password.
-    Uses a separate password hash for overseer authentication.
+
+    Every user stores their own overseer password hash, and anyone can sign
+    up naming any number, so the overseer is only granted the users whose
+    own hash matches this password, not everyone listing the number.
     """
     try:
-        # Search CSV for a user with matching overseer number
-        csv_user = None
-        for u in user_storage.get_all_users():
-            if u.get("overseer_number") == body.number:
-                csv_user = u
-                break
-
-        if csv_user:
-            stored_overseer_password_hash = csv_user.get("overseer_password_hash", "")
-            if not stored_overseer_password_hash or not verify_password(body.password, stored_overseer_password_hash):
-                raise HTTPException(status_code=401, detail="Invalid number or password")
-
-            request.session["is_overseer"] = True
-            request.session["overseer_logged_in"] = True
-            request.session["overseer_user_id"] = csv_user["user_id"]
-
-            return JSONResponse(content={
-                "success": True,
-                "number": body.number,
-                "user_name": csv_user["name"],
-                "user_email": csv_user["email"],
-            })
-
-        # Fall back to session-only (legacy)
-        stored_overseer_number = request.session.get("overseer_number")
-        stored_overseer_password_hash = request.session.get("overseer_password_hash")
-
-        if not stored_overseer_number or not stored_overseer_password_hash:
-            raise HTTPException(status_code=401, detail="No overseer account found in system")
-
-        if stored_overseer_number != body.number:
+        granted = [
+            u for u in user_storage.get_users_by_overseer(body.number)
+            if u.get("overseer_password_hash") and verify_password(body.password, u["overseer_password_hash"])
+        ]
+        if not granted:
             raise HTTPException(status_code=401, detail="Invalid number or password")
 
-        if not verify_password(body.password, stored_overseer_password_hash):
-            raise HTTPException(status_code=401, detail="Invalid number or password")
-        
-        # Set overseer session
         request.session["is_overseer"] = True
         request.session["overseer_logged_in"] = True
-        
+        request.session["overseer_user_id"] = granted[0]["user_id"]
+        request.session["overseer_user_ids"] = [u["user_id"] for u in granted]
+        request.session["overseer_number"] = user_storage.normalise_phone(body.number)
+
         return JSONResponse(content={
             "success": True,
             "number": body.number,
-            "user_name": request.session.get("user_name"),
-            "user_email": request.session.get("user_email"),
+            "user_name": granted[0]["name"],
+            "user_email": granted[0]["email"],
         })
     except HTTPException:
         raise
@@ -283,15 +310,13 @@ async def get_overseer_users(request: Request):
     """
     Returns users associated with this overseer.
     """
-    if not request.session.get("is_overseer"):
-        raise HTTPException(status_code=401, detail="Not authenticated as overseer")
-    
     return JSONResponse(content={
         "success": True,
         "users": [{
-            "name": request.session.get("user_name"),
-            "email": request.session.get("user_email"),
-            "cardholder_id": request.session.get("cardholder_id"),
-            "stripe_customer_id": request.session.get("stripe_customer_id"),
-        }]
+            "user_id": u["user_id"],
+            "name": u.get("name"),
+            "email": u.get("email"),
+            "cardholder_id": u.get("cardholder_id"),
+            "stripe_customer_id": u.get("stripe_customer_id"),
+        } for u in supervised_users(request)]
     })
@@ -1,16 +1,14 @@
+import asyncio
+
 from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import JSONResponse
 import stripe
 import os
 import json
+import hashlib
 from dotenv import load_dotenv
 from services.stripe import get_radar_risk
-from services.alerts import (
-    send_carer_sms,
-    build_fraud_alert_message,
-    build_large_payment_message,
-    build_payment_failure_message,
-)
+from services import alert_aggregator, events, transaction_storage, webhook_queue, webhook_store
 
 load_dotenv()
 
@@ -20,109 +18,133 @@ STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
 LARGE_PAYMENT_THRESHOLD = float(200)
 
 
+def _payment_details(event: dict) -> dict:
+    payment_intent = event.get("data", {}).get("object", {})
+    metadata = payment_intent.get("metadata", {})
+    return {
+        "payment_intent": payment_intent,
+        "amount": payment_intent.get("amount", 0) / 100,
+        "currency": payment_intent.get("currency", "eur").upper(),
+        "payment_intent_id": payment_intent.get("id"),
+        # Carer info stored in payment metadata
+        "carer_phone": metadata.get("carer_phone"),
+        "user_name": metadata.get("user_name", "the account holder"),
+    }
+
+
+def _settle(payment_intent_id: str, status: str) -> None:
+    """Moves the ledger row for a PaymentIntent to its final status."""
+    if not payment_intent_id:
+        return
+    transaction_id = transaction_storage.update_status_by_provider_id(payment_intent_id, status, source="webhook")
+    if transaction_id is None:
+        print(f"ℹ️ No ledger transaction for {payment_intent_id}")
+        return
+    transaction = transaction_storage.get_transaction_by_provider_id(payment_intent_id)
+    events.publish("payment.settled", transaction["user_id"], {
+        "transaction_id": transaction_id,
+        "payment_id": payment_intent_id,
+        "amount": float(transaction["amount"] or 0),
+        "currency": transaction["currency"],
+        "status": transaction["status"],
+    })
+
+
+def handle_payment_succeeded(event: dict) -> None:
+    """Settles the ledger row, checks Radar and alerts the carer on fraud flags and large payments."""
+    p = _payment_details(event)
+    _settle(p["payment_intent_id"], "COMPLETED")
+    amount, currency, carer_phone = p["amount"], p["currency"], p["carer_phone"]
+    latest_charge = p["payment_intent"].get("latest_charge")
+    radar = None
+
+    if latest_charge:
+        try:
+            radar = get_radar_risk(latest_charge, payment_intent_id=p["payment_intent_id"])
+        except Exception as e:
+            print(f"Radar check failed: {e}")
+
+    # Alert carer if fraud flagged (dropped by the aggregator if the create path already sent it)
+    if carer_phone and radar and radar.get("should_alert"):
+        alert_aggregator.submit(
+            carer_phone, p["payment_intent_id"], p["user_name"], amount, currency, "fraud",
+            risk_level=radar["risk_level"], alma_message=radar["alma_message"],
+        )
+
+    # Alert carer if large payment
+    if carer_phone and amount >= LARGE_PAYMENT_THRESHOLD:
+        alert_aggregator.submit(carer_phone, p["payment_intent_id"], p["user_name"], amount, currency, "large")
+
+    print(f"✅ Payment succeeded: {amount} {currency} | Risk: {radar}")
+
+
+def handle_payment_failed(event: dict) -> None:
+    """Marks the ledger row failed and alerts the carer that the payment didn't go through."""
+    p = _payment_details(event)
+    _settle(p["payment_intent_id"], "FAILED")
+    amount, currency, carer_phone = p["amount"], p["currency"], p["carer_phone"]
+    failure_reason = (
+        p["payment_intent"].get("last_payment_error", {}).get("message")
+        or "an unknown error"
+    )
+
+    if carer_phone:
+        alert_aggregator.submit(
+            carer_phone, p["payment_intent_id"], p["user_name"], amount, currency, "failure",
+            failure_reason=failure_reason,
+        )
+
+    print(f"❌ Payment failed: {amount} {currency} | Reason: {failure_reason}")
+
+
+def handle_payment_canceled(event: dict) -> None:
+    _settle(_payment_details(event)["payment_intent_id"], "CANCELLED")
+
+
+webhook_queue.register("payment_intent.succeeded", handle_payment_succeeded)
+webhook_queue.register("payment_intent.payment_failed", handle_payment_failed)
+webhook_queue.register("payment_intent.canceled", handle_payment_canceled)
+
+
 @router.post("/api/webhooks/stripe")
 async def stripe_webhook(request: Request):
     """
-    Handles incoming Stripe webhook events.
-    Fires carer alerts on fraud flags, large payments, and failures.
+    Receives Stripe webhook events.
+
+    Only verifies the signature and records the event ID before answering;
+    Radar checks and carer alerts run on the webhook workers
+    (services/webhook_queue.py). Redelivered event IDs are acknowledged
+    without being processed again.
     """
     payload = await request.body()
     sig_header = request.headers.get("stripe-signature")
 
     if STRIPE_WEBHOOK_SECRET:
         try:
-            event = stripe.Webhook.construct_event(
+            stripe.Webhook.construct_event(
                 payload, sig_header, STRIPE_WEBHOOK_SECRET
             )
         except stripe.error.SignatureVerificationError:
             raise HTTPException(status_code=400, detail="Invalid webhook signature")
-    else:
+
+    # Plain dict (not a StripeObject) so it can be stored and handed to the workers
+    try:
         event = json.loads(payload)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid webhook payload")
 
     event_type = event.get("type")
-    payment_intent = event.get("data", {}).get("object", {})
-    amount = payment_intent.get("amount", 0) / 100
-    currency = payment_intent.get("currency", "eur").upper()
-    customer_id = payment_intent.get("customer")
-    latest_charge = payment_intent.get("latest_charge")
-
-    # Carer info stored in payment metadata
-    carer_phone = payment_intent.get("metadata", {}).get("carer_phone")
-    carer_name = payment_intent.get("metadata", {}).get("carer_name")
-    user_name = payment_intent.get("metadata", {}).get("user_name", "the account holder")
-
-    # --- Payment succeeded ---
-    if event_type == "payment_intent.succeeded":
-        radar = None
-
-        if latest_charge:
-            try:
-                radar = get_radar_risk(latest_charge)
-            except Exception as e:
-                print(f"Radar check failed: {e}")
-
-        # Build Alma's message
-        if radar and radar["should_block"]:
-            alma_message = radar["alma_message"]
-        else:
-            alma_message = f"Your payment of {amount} {currency} was successful."
-
-        # Alert carer if fraud flagged
-        if carer_phone and radar and radar.get("should_alert"):
-            send_carer_sms(
-                carer_phone=carer_phone,
-                message=build_fraud_alert_message(user_name, amount, currency, radar["risk_level"], radar["alma_message"])
-            )
-
-        # Alert carer if large payment
-        if carer_phone and amount >= LARGE_PAYMENT_THRESHOLD:
-            send_carer_sms(
-                carer_phone=carer_phone,
-                message=build_large_payment_message(user_name, amount, currency)
-            )
-
-        print(f"✅ Payment succeeded: {amount} {currency} | Risk: {radar}")
-        return JSONResponse(content={
-            "status": "success",
-            "amount": amount,
-            "currency": currency,
-            "customer_id": customer_id,
-            "radar": radar,
-            "alma_message": alma_message,
-            # TODO: pass alma_message to ElevenLabs TTS here
-        })
-
-    # --- Payment failed ---
-    elif event_type == "payment_intent.payment_failed":
-        failure_reason = (
-            payment_intent.get("last_payment_error", {}).get("message")
-            or "an unknown error"
-        )
+    # Stripe events always carry an ID; hand-built test events fall back to a payload hash
+    event_id = event.get("id") or "sha256_" + hashlib.sha256(payload).hexdigest()[:32]
 
-        alma_message = (
-            f"I'm sorry, your payment of {amount} {currency} didn't go through. "
-            f"The reason was: {failure_reason}. "
-            f"Please check your payment details and try again, or ask someone you trust for help."
-        )
+    if not webhook_queue.handles(event_type):
+        print(f"ℹ️ Unhandled event: {event_type}")
+        return JSONResponse(content={"received": True, "event_id": event_id, "status": "ignored"})
 
-        # Alert carer on failure
-        if carer_phone:
-            send_carer_sms(
-                carer_phone=carer_phone,
-                message=build_payment_failure_message(user_name, amount, currency, failure_reason)
-            )
+    if not await asyncio.to_thread(webhook_store.claim, event_id, event):
+        status = await asyncio.to_thread(webhook_store.status, event_id)
+        print(f"ℹ️ Duplicate webhook {event_id} ({event_type}) — already {status}")
+        return JSONResponse(content={"received": True, "event_id": event_id, "status": "duplicate"})
 
-        print(f"❌ Payment failed: {amount} {currency} | Reason: {failure_reason}")
-        return JSONResponse(content={
-            "status": "failed",
-            "amount": amount,
-            "currency": currency,
-            "customer_id": customer_id,
-            "failure_reason": failure_reason,
-            "alma_message": alma_message,
-            # TODO: pass alma_message to ElevenLabs TTS here
-        })
-
-    else:
-        print(f"ℹ️ Unhandled event: {event_type}")
-        return JSONResponse(content={"status": "ignored", "event_type": event_type})
\ No newline at end of file
+    webhook_queue.submit(event_id, event)
+    return JSONResponse(content={"received": True, "event_id": event_id, "status": "queued"})
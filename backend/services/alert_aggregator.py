@@ -0,0 +1,257 @@
+"""
+services/alert_aggregator.py
+
+Coalesces carer alerts per payment before they reach the alert queue.
+
+The payments route, chat confirm and the Stripe webhook each raise alerts
+about the same payment (fraud flag, large amount, failure). Reasons for one
+payment ID that arrive within ALERT_COALESCE_WINDOW_S are merged into a
+single message, and a reason already sent for that payment within
+ALERT_DEDUP_TTL_S is dropped, so a webhook repeating the create path's
+alerts costs nothing. That check is in memory; each reason is also reserved
+in the shared alert outbox (alert_outbox.claim_once) right before the
+message or digest carrying it is queued, so a repeat that reaches another
+worker, or arrives after a restart, is dropped too.
+
+Flushing runs on a worker thread. The lock only guards the in-memory
+tables; transaction lookups, outbox writes and queueing happen outside it.
+
+With ALERT_DIGEST_INTERVAL_S set, payments whose only reasons are
+low-severity (e.g. a large payment Radar was happy with) are batched into
+one periodic digest per carer instead of a message each.
+
+The last ALERT_HISTORY_SIZE dispatched alerts are kept in memory by payment
+ID for the overseer dashboard (recent_alerts()), and each one is published
+to the overseer event feed (services/events.py).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from services import alert_outbox, alert_queue, events, tracing, transaction_storage
+from services.alerts import build_combined_alert_message, build_digest_message
+
+ALERT_COALESCE_WINDOW_S = float(os.getenv("ALERT_COALESCE_WINDOW_S", 1.0))
+ALERT_DEDUP_TTL_S = float(os.getenv("ALERT_DEDUP_TTL_S", 3600))
+ALERT_DIGEST_INTERVAL_S = float(os.getenv("ALERT_DIGEST_INTERVAL_S", 0))   # 0 disables digests
+ALERT_FLUSH_TICK_S = 0.25
+ALERT_HISTORY_SIZE = int(os.getenv("ALERT_HISTORY_SIZE", 1000))
+
+SEVERITY_ORDER = {"low": 0, "medium": 1, "high": 2}
+
+_pending: dict[tuple[str, str], dict] = {}       # (carer_phone, payment_id) -> open alert
+_sent: dict[tuple[str, str], tuple[float, set]] = {}  # (carer_phone, payment_id) -> (sent_at, reason kinds)
+_digests: dict[str, dict] = {}                    # carer_phone -> {"opened_at", "entries"}
+_history: OrderedDict[str, list] = OrderedDict()  # payment_id -> dispatched alerts, oldest payment first
+_lock = threading.Lock()
+_loop: asyncio.AbstractEventLoop | None = None
+_flusher: asyncio.Task | None = None
+
+_counters = {"submitted": 0, "deduplicated": 0, "merged": 0, "messages": 0, "digested": 0, "digests": 0}
+
+
+def _severity(reason: dict) -> str:
+    if reason["kind"] == "fraud":
+        return "high" if reason.get("risk_level") == "highest" else "medium"
+    if reason["kind"] == "failure":
+        return "medium"
+    return "low"
+
+
+def _ensure_flusher() -> bool:
+    """Starts the flush task on the running loop. Returns False when there is no loop."""
+    global _loop, _flusher
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return _loop is not None and _loop.is_running()
+    if _loop is not loop:
+        _loop = loop
+        _flusher = loop.create_task(_flush_forever(), name="alert-aggregator-flusher")
+    return True
+
+
+def start() -> None:
+    _ensure_flusher()
+
+
+def submit(
+    carer_phone: str,
+    payment_id: str | None,
+    user_name: str,
+    amount: float,
+    currency: str,
+    kind: str,
+    **detail,
+) -> None:
+    """
+    Raises one alert reason about a payment.
+
+    kind is "fraud" (needs risk_level, alma_message), "large", or
+    "failure" (needs failure_reason).
+    """
+    if not carer_phone:
+        return
+    payment_id = payment_id or f"anon_{uuid.uuid4().hex}"
+    key = (carer_phone, payment_id)
+    reason = {"kind": kind, **detail}
+    now = time.monotonic()
+
+    with _lock:
+        _counters["submitted"] += 1
+        sent = _sent.get(key)
+        if sent and now - sent[0] <= ALERT_DEDUP_TTL_S and kind in sent[1]:
+            _counters["deduplicated"] += 1
+            return
+
+        entry = _pending.get(key)
+        if entry is None:
+            _pending[key] = {
+                "carer_phone": carer_phone,
+                "payment_id": payment_id,
+                "user_name": user_name,
+                "amount": amount,
+                "currency": currency,
+                "reasons": [reason],
+                "flush_at": now + ALERT_COALESCE_WINDOW_S,
+                "trace_id": tracing.current_trace_id(),
+            }
+        elif all(r["kind"] != kind for r in entry["reasons"]):
+            entry["reasons"].append(reason)
+            _counters["merged"] += 1
+        else:
+            _counters["deduplicated"] += 1
+
+    if not _ensure_flusher():
+        flush(force=True)   # no event loop (scripts, CLI) — send right away
+
+
+def _claim_reasons(entry: dict) -> list[dict]:
+    """The entry's reasons not yet sent by any worker, reserving them in the outbox. Does file I/O."""
+    return [
+        r for r in entry["reasons"]
+        if alert_outbox.claim_once(f"reason:{entry['carer_phone']}:{entry['payment_id']}:{r['kind']}")
+    ]
+
+
+def _dispatch(entry: dict, now: float) -> None:
+    """Sends or digests one coalesced alert. Called without _lock; does file I/O."""
+    severity = max((_severity(r) for r in entry["reasons"]), key=SEVERITY_ORDER.get)
+    digested = severity == "low" and ALERT_DIGEST_INTERVAL_S > 0
+    # Digested reasons are reserved when the digest is queued, so a crash before then loses nothing
+    reasons = entry["reasons"] if digested else _claim_reasons(entry)
+    if not reasons:
+        with _lock:
+            _counters["deduplicated"] += 1
+        return
+
+    kinds = {r["kind"] for r in reasons}
+    severity = max((_severity(r) for r in reasons), key=SEVERITY_ORDER.get)
+    alert = {
+        "payment_id": entry["payment_id"],
+        "user_name": entry["user_name"],
+        "amount": entry["amount"],
+        "currency": entry["currency"],
+        "kinds": sorted(kinds),
+        "severity": severity,
+        "digested": digested,
+        "at": time.time(),
+    }
+    with _lock:
+        _history.setdefault(entry["payment_id"], []).append(alert)
+        _history.move_to_end(entry["payment_id"])
+        while len(_history) > ALERT_HISTORY_SIZE:
+            _history.popitem(last=False)
+        if digested:
+            digest = _digests.setdefault(entry["carer_phone"], {"opened_at": now, "entries": []})
+            digest["entries"].append({**entry, "reasons": reasons})
+            _counters["digested"] += 1
+        else:
+            _counters["messages"] += 1
+
+    transaction = transaction_storage.get_transaction_by_provider_id(entry["payment_id"] or "")
+    if transaction:
+        events.publish("alert", transaction["user_id"], dict(alert))
+
+    if digested:
+        return
+
+    # Deterministic ID so the outbox drops an identical alert raised twice
+    message_id = f"{entry['payment_id']}:{'+'.join(sorted(kinds))}"
+    alert_queue.enqueue(
+        carer_phone=entry["carer_phone"],
+        message=build_combined_alert_message(
+            entry["user_name"], entry["amount"], entry["currency"], reasons,
+        ),
+        message_id=message_id,
+        trace_id=entry.get("trace_id"),
+    )
+
+
+def flush(force: bool = False) -> None:
+    """Sends coalesced alerts whose window has closed and digests that are due."""
+    now = time.monotonic()
+    with _lock:
+        due = [_pending.pop(k) for k in [k for k, e in _pending.items() if force or e["flush_at"] <= now]]
+        for entry in due:
+            key = (entry["carer_phone"], entry["payment_id"])
+            prev = _sent.get(key)
+            _sent[key] = (now, {r["kind"] for r in entry["reasons"]} | (prev[1] if prev else set()))
+
+        due_digests = [
+            (c, _digests.pop(c)) for c in [
+                c for c, d in _digests.items()
+                if force or now - d["opened_at"] >= ALERT_DIGEST_INTERVAL_S
+            ]
+        ]
+
+        for key in [k for k, (sent_at, _) in _sent.items() if now - sent_at > ALERT_DEDUP_TTL_S]:
+            del _sent[key]
+
+    for entry in due:
+        _dispatch(entry, now)
+
+    for carer_phone, digest in due_digests:
+        entries = []
+        for entry in digest["entries"]:
+            reasons = _claim_reasons(entry)
+            if reasons:
+                entries.append({**entry, "reasons": reasons})
+        if not entries:
+            with _lock:
+                _counters["deduplicated"] += 1
+            continue
+        alert_queue.enqueue(carer_phone=carer_phone, message=build_digest_message(entries))
+        with _lock:
+            _counters["digests"] += 1
+
+
+async def _flush_forever() -> None:
+    while True:
+        await asyncio.sleep(ALERT_FLUSH_TICK_S)
+        try:
+            await asyncio.to_thread(flush)
+        except Exception as e:
+            print(f"❌ Alert aggregator flush failed: {e}")
+
+
+def recent_alerts(payment_ids) -> list[dict]:
+    """Dispatched alerts about any of the given payments, newest first."""
+    with _lock:
+        alerts = [dict(a) for pid in payment_ids for a in _history.get(pid, ())]
+    return sorted(alerts, key=lambda a: a["at"], reverse=True)
+
+
+def metrics() -> dict:
+    with _lock:
+        return {
+            **_counters,
+            "pending": len(_pending),
+            "digest_entries": sum(len(d["entries"]) for d in _digests.values()),
+        }
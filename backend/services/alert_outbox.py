@@ -0,0 +1,414 @@
+"""
+services/alert_outbox.py
+
+Durable, append-only outbox for carer alerts.
+
+Every alert is written to ALERT_OUTBOX_PATH (JSON lines) before delivery is
+attempted, and every claim, attempt, delivery and dead-letter is appended as
+its own record. On startup the log is replayed to rebuild state, so alerts
+queued while Twilio was down, or before a restart, are still delivered later.
+The log is compacted at import and, once ALERT_OUTBOX_COMPACT_EVERY records
+have been appended since, by the sweep owner on its next claim_due().
+
+Delivery is tracked per message ID: once a message is marked delivered it is
+never handed out again, and add() with an ID delivered in the last
+ALERT_OUTBOX_DEDUP_S seconds is a no-op. claim_once() reservations (dedup
+keys that aren't messages) are recorded separately from deliveries and
+kept for the same time. Compaction keeps both, so a restart does not
+resend them. A crash between the provider accepting a
+message and mark_delivered() being written can still cause one resend.
+
+Several uvicorn workers share one log. Every operation holds an fcntl lock
+on ALERT_OUTBOX_PATH + ".lock" and first applies whatever other workers
+appended, so dedup and claims see the whole log. A claim is a lease written
+to the log (ALERT_CLAIM_LEASE_S), so no other worker hands the message out
+while it is being sent, and only the worker holding
+ALERT_OUTBOX_PATH + ".sweeper" returns anything from claim_due(). Without
+fcntl (Windows) only a single worker may use the outbox.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
+
+try:
+    import fcntl
+except ImportError:   # Windows: single worker only
+    fcntl = None
+
+ALERT_OUTBOX_PATH = os.getenv("ALERT_OUTBOX_PATH", "alert_outbox.jsonl")
+ALERT_OUTBOX_FSYNC = os.getenv("ALERT_OUTBOX_FSYNC", "").lower() in ("1", "true", "yes")
+ALERT_OUTBOX_DEDUP_S = float(os.getenv("ALERT_OUTBOX_DEDUP_S", 86400))   # delivered IDs kept through compaction
+ALERT_OUTBOX_COMPACT_EVERY = int(os.getenv("ALERT_OUTBOX_COMPACT_EVERY", 1000))   # records between compactions
+ALERT_CLAIM_LEASE_S = float(os.getenv("ALERT_CLAIM_LEASE_S", 120))
+ALERT_MAX_ATTEMPTS = int(os.getenv("ALERT_MAX_ATTEMPTS", 6))
+ALERT_RETRY_BASE_S = float(os.getenv("ALERT_RETRY_BASE_S", 2.0))
+ALERT_RETRY_MAX_S = float(os.getenv("ALERT_RETRY_MAX_S", 300.0))
+
+PENDING = "pending"
+DELIVERED = "delivered"
+DEAD = "dead"
+
+_messages: dict[str, dict] = {}     # pending and dead-lettered messages
+_delivered: dict[str, float] = {}   # delivered ID -> delivered_at
+_reserved: dict[str, float] = {}    # claim_once key -> reserved_at
+_lock = threading.Lock()
+_file = None
+_offset = 0          # bytes of the log applied to state
+_inode = None        # inode of the log _offset refers to (compaction replaces the file)
+_sweep_fd = None     # held for the life of the process by the sweep owner
+_since_compact = 0   # records applied since the log was last compacted
+_compactions = 0
+
+
+def _dumps(record: dict) -> str:
+    return json.dumps(record, separators=(",", ":"))
+
+
+def _append(record: dict) -> None:
+    """Appends one record to the log and applies it. Caller holds the log lock."""
+    global _file, _offset, _since_compact
+    if _file is None:
+        _file = open(ALERT_OUTBOX_PATH, "ab")
+    line = (_dumps(record) + "\n").encode("utf-8")
+    _file.write(line)
+    _file.flush()
+    if ALERT_OUTBOX_FSYNC:
+        os.fsync(_file.fileno())
+    _offset += len(line)
+    _since_compact += 1
+    _apply(record)
+
+
+def _apply(record: dict) -> None:
+    """Folds one log record into in-memory state. Caller holds _lock."""
+    op = record.get("op")
+    msg_id = record.get("id")
+    if op == "enqueue":
+        if msg_id in _delivered:
+            return
+        _messages.setdefault(msg_id, {
+            "id": msg_id,
+            "carer_phone": record["carer_phone"],
+            "message": record["message"],
+            "created_at": record["created_at"],
+            "status": PENDING,
+            "attempts": 0,
+            "next_attempt_at": record["created_at"],
+            "claimed_until": record.get("claimed_until", 0),
+            "last_error": None,
+        })
+        return
+    if op == "delivered":
+        # Compacted logs carry delivered IDs with no enqueue record before them
+        _messages.pop(msg_id, None)
+        _delivered[msg_id] = record.get("at", time.time())
+        return
+    if op == "reserve":
+        _reserved[msg_id] = record["at"]
+        return
+
+    msg = _messages.get(msg_id)
+    if msg is None or msg["status"] != PENDING:
+        return
+    if op == "claim":
+        msg["claimed_until"] = record["until"]
+    elif op == "release":
+        msg["claimed_until"] = 0
+    elif op == "attempt":
+        msg["attempts"] = record["attempts"]
+        msg["next_attempt_at"] = record["next_attempt_at"]
+        msg["claimed_until"] = 0
+        msg["last_error"] = record.get("error")
+    elif op == "dead":
+        msg["status"] = DEAD
+        msg["attempts"] = record.get("attempts", msg["attempts"])
+        msg["last_error"] = record.get("error", msg["last_error"])
+
+
+def _reset() -> None:
+    global _file, _offset, _inode, _since_compact
+    _messages.clear()
+    _delivered.clear()
+    _reserved.clear()
+    if _file is not None:
+        _file.close()
+        _file = None
+    _offset = 0
+    _inode = None
+    _since_compact = 0
+
+
+def _catch_up() -> None:
+    """
+    Applies records appended since _offset, by this or any other process.
+    If another worker compacted the log, starts over from the new file.
+    Caller holds the log lock, so no writer is part-way through a line.
+    """
+    global _offset, _inode, _since_compact
+    try:
+        st = os.stat(ALERT_OUTBOX_PATH)
+    except FileNotFoundError:
+        if _inode is not None:
+            _reset()
+        return
+    if _inode is not None and st.st_ino != _inode:
+        _reset()
+    _inode = st.st_ino
+    if st.st_size == _offset:
+        return
+    with open(ALERT_OUTBOX_PATH, "rb") as f:
+        f.seek(_offset)
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break   # torn final line after a crash
+            _offset += len(raw)
+            _since_compact += 1
+            try:
+                _apply(json.loads(raw))
+            except (ValueError, KeyError):
+                continue
+    if _offset < st.st_size:
+        with open(ALERT_OUTBOX_PATH, "r+b") as f:
+            f.truncate(_offset)
+
+
+@contextmanager
+def _log_locked() -> Iterator[None]:
+    """Holds _lock and the cross-process log lock, with state caught up to the end of the log."""
+    with _lock:
+        fd = None
+        if fcntl is not None:
+            fd = os.open(ALERT_OUTBOX_PATH + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            _catch_up()
+            yield
+        finally:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+
+def _compact() -> None:
+    """
+    Rewrites the log as pending and dead-lettered messages plus IDs
+    delivered or keys reserved within ALERT_OUTBOX_DEDUP_S. Caller holds
+    the log lock; other workers notice the new inode and re-read it.
+    """
+    global _file, _offset, _inode, _since_compact, _compactions
+    cutoff = time.time() - ALERT_OUTBOX_DEDUP_S
+    for msg_id in [i for i, at in _delivered.items() if at < cutoff]:
+        del _delivered[msg_id]
+    for key in [k for k, at in _reserved.items() if at < cutoff]:
+        del _reserved[key]
+
+    lines = []
+    for msg_id, at in _delivered.items():
+        lines.append(_dumps({"op": "delivered", "id": msg_id, "at": at}))
+    for key, at in _reserved.items():
+        lines.append(_dumps({"op": "reserve", "id": key, "at": at}))
+    for msg in _messages.values():
+        lines.append(_dumps({
+            "op": "enqueue", "id": msg["id"], "carer_phone": msg["carer_phone"],
+            "message": msg["message"], "created_at": msg["created_at"],
+        }))
+        if msg["status"] == DEAD:
+            lines.append(_dumps({"op": "dead", "id": msg["id"], "attempts": msg["attempts"], "error": msg["last_error"]}))
+        else:
+            if msg["attempts"]:
+                lines.append(_dumps({
+                    "op": "attempt", "id": msg["id"], "attempts": msg["attempts"],
+                    "next_attempt_at": msg["next_attempt_at"], "error": msg["last_error"],
+                }))
+            if msg["claimed_until"]:
+                lines.append(_dumps({"op": "claim", "id": msg["id"], "until": msg["claimed_until"]}))
+
+    data = "".join(line + "\n" for line in lines).encode("utf-8")
+    tmp_path = f"{ALERT_OUTBOX_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, ALERT_OUTBOX_PATH)
+    if _file is not None:
+        _file.close()
+        _file = None
+    _offset = len(data)
+    _inode = os.stat(ALERT_OUTBOX_PATH).st_ino
+    _since_compact = 0
+    _compactions += 1
+
+
+def load() -> None:
+    """Rebuilds state from the log and compacts it. Called once at import."""
+    with _lock:
+        _reset()
+    with _log_locked():
+        _compact()
+
+
+def _reset_after_fork() -> None:
+    """A forked child reopens the log and competes for the sweep on its own."""
+    global _lock, _file, _sweep_fd
+    _lock = threading.Lock()
+    _file = None
+    _sweep_fd = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _owns_sweep() -> bool:
+    """
+    True if this process runs the retry sweep. The first worker to lock
+    ALERT_OUTBOX_PATH + ".sweeper" keeps it until it exits; the others keep
+    trying, so the sweep moves on when the owner dies.
+    """
+    global _sweep_fd
+    if fcntl is None or _sweep_fd is not None:
+        return True
+    fd = os.open(ALERT_OUTBOX_PATH + ".sweeper", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    _sweep_fd = fd
+    return True
+
+
+def add(carer_phone: str, message: str, message_id: str = None) -> tuple[str, bool]:
+    """
+    Durably records an alert and claims it for immediate delivery.
+    Returns (message_id, claimed); claimed is False when the ID already
+    exists in any worker or was delivered within ALERT_OUTBOX_DEDUP_S.
+    """
+    msg_id = message_id or uuid.uuid4().hex
+    with _log_locked():
+        if msg_id in _messages or msg_id in _delivered:
+            return msg_id, False
+        now = time.time()
+        _append({
+            "op": "enqueue",
+            "id": msg_id,
+            "carer_phone": carer_phone,
+            "message": message,
+            "created_at": now,
+            "claimed_until": now + ALERT_CLAIM_LEASE_S,
+        })
+    return msg_id, True
+
+
+def claim_once(key: str) -> bool:
+    """
+    Reserves a dedup key (e.g. one alert reason about one payment) in the
+    shared log. Returns False if any worker reserved it within
+    ALERT_OUTBOX_DEDUP_S. Keys are separate from message IDs.
+    """
+    with _log_locked():
+        if key in _reserved:
+            return False
+        _append({"op": "reserve", "id": key, "at": time.time()})
+    return True
+
+
+def claim_due(limit: int, now: float = None) -> list[dict]:
+    """
+    Claims up to `limit` unclaimed pending messages whose retry time has
+    passed, oldest first. Returns nothing unless this process owns the sweep,
+    which also compacts the log once it has grown by ALERT_OUTBOX_COMPACT_EVERY.
+    """
+    if not _owns_sweep():
+        return []
+    now = time.time() if now is None else now
+    with _log_locked():
+        if _since_compact >= ALERT_OUTBOX_COMPACT_EVERY:
+            _compact()
+        due = sorted(
+            (
+                m for m in _messages.values()
+                if m["status"] == PENDING and m["claimed_until"] <= now and m["next_attempt_at"] <= now
+            ),
+            key=lambda m: m["next_attempt_at"],
+        )[:limit]
+        for msg in due:
+            _append({"op": "claim", "id": msg["id"], "until": now + ALERT_CLAIM_LEASE_S})
+        return [dict(m) for m in due]
+
+
+def release(msg_id: str) -> None:
+    """Returns a claimed message to the sweeper without counting an attempt."""
+    with _log_locked():
+        msg = _messages.get(msg_id)
+        if msg is not None and msg["status"] == PENDING and msg["claimed_until"]:
+            _append({"op": "release", "id": msg_id})
+
+
+def mark_delivered(msg_id: str) -> None:
+    with _log_locked():
+        msg = _messages.get(msg_id)
+        if msg is None or msg["status"] != PENDING:
+            return
+        _append({"op": "delivered", "id": msg_id, "at": time.time()})
+
+
+def mark_failed(msg_id: str, error: str = None) -> str:
+    """
+    Records a failed attempt and schedules a retry with exponential backoff
+    and jitter, or dead-letters the message after ALERT_MAX_ATTEMPTS.
+    Returns the message's new status.
+    """
+    with _log_locked():
+        msg = _messages.get(msg_id)
+        if msg is None:
+            return DELIVERED if msg_id in _delivered else DEAD
+        if msg["status"] != PENDING:
+            return msg["status"]
+
+        attempts = msg["attempts"] + 1
+        if attempts >= ALERT_MAX_ATTEMPTS:
+            record = {"op": "dead", "id": msg_id, "attempts": attempts, "error": error, "at": time.time()}
+            print(f"❌ Alert {msg_id} to {msg['carer_phone']} dead-lettered after {attempts} attempts")
+        else:
+            delay = min(ALERT_RETRY_BASE_S * (2 ** (attempts - 1)), ALERT_RETRY_MAX_S)
+            delay *= random.uniform(0.8, 1.2)
+            record = {
+                "op": "attempt",
+                "id": msg_id,
+                "attempts": attempts,
+                "next_attempt_at": time.time() + delay,
+                "error": error,
+            }
+        _append(record)
+        return msg["status"]
+
+
+def dead_letters() -> list[dict]:
+    with _log_locked():
+        return [dict(m) for m in _messages.values() if m["status"] == DEAD]
+
+
+def stats() -> dict:
+    with _lock:
+        now = time.time()
+        pending = [m for m in _messages.values() if m["status"] == PENDING]
+        return {
+            "pending": len(pending),
+            "retrying": sum(1 for m in pending if m["attempts"]),
+            "in_flight": sum(1 for m in pending if m["claimed_until"] > now),
+            "delivered": len(_delivered),
+            "reserved": len(_reserved),
+            "dead": sum(1 for m in _messages.values() if m["status"] == DEAD),
+            "sweep_owner": _sweep_fd is not None or fcntl is None,
+            "compactions": _compactions,
+        }
+
+
+load()
@@ -0,0 +1,228 @@
+"""
+services/alert_queue.py
+
+In-process async queue for outbound carer WhatsApp alerts.
+
+Route handlers call enqueue() and return immediately; a small pool of
+asyncio workers delivers messages in the background by running the sink
+(send_carer_sms by default) on a thread. Tests and benchmarks can swap the
+sink for a local stand-in with set_sink().
+
+Every message is written to the durable outbox (services/alert_outbox.py)
+before it is queued. Failed sends are rescheduled there with backoff, and a
+sweeper task feeds due retries and leftovers from a previous run back into
+the queue at no more than ALERT_OUTBOX_RATE messages per second. Every
+worker process runs the sweeper, but the outbox only hands messages to the
+one that owns the sweep lock. Outbox calls take a file lock, so on the
+event loop they run on a thread.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+import uuid
+from collections import deque
+from typing import Callable
+
+from services import alert_outbox, tracing
+from services.alerts import send_carer_sms
+
+ALERT_WORKERS = int(os.getenv("ALERT_WORKERS", 2))
+ALERT_QUEUE_SIZE = int(os.getenv("ALERT_QUEUE_SIZE", 1000))
+ALERT_OUTBOX_RATE = float(os.getenv("ALERT_OUTBOX_RATE", 5))          # sweeper sends per second
+ALERT_SWEEP_INTERVAL_S = float(os.getenv("ALERT_SWEEP_INTERVAL_S", 1.0))
+RECENT_DELIVERIES = 100   # per-message delivery records kept for metrics()
+
+Sink = Callable[[str, str], bool]
+
+_sink: Sink = send_carer_sms
+_queue: asyncio.Queue | None = None
+_loop: asyncio.AbstractEventLoop | None = None
+_workers: list[asyncio.Task] = []
+_writes: set[asyncio.Task] = set()   # outbox writes started by enqueue() on the loop
+
+_counters = {"enqueued": 0, "sent": 0, "failed": 0, "dropped": 0, "swept": 0}
+_recent: deque = deque(maxlen=RECENT_DELIVERIES)
+
+
+def set_sink(sink: Sink | None = None) -> None:
+    """Replaces the delivery function; pass None to restore send_carer_sms."""
+    global _sink
+    _sink = sink or send_carer_sms
+
+
+def _start_workers(loop: asyncio.AbstractEventLoop) -> None:
+    global _queue, _loop
+    _loop = loop
+    _queue = asyncio.Queue(maxsize=ALERT_QUEUE_SIZE)
+    _workers.clear()
+    for i in range(ALERT_WORKERS):
+        _workers.append(loop.create_task(_worker(), name=f"alert-worker-{i}"))
+    _workers.append(loop.create_task(_sweeper(), name="alert-outbox-sweeper"))
+
+
+def start() -> None:
+    """Starts workers and the outbox sweeper on the running loop (app startup)."""
+    loop = asyncio.get_running_loop()
+    if _loop is not loop:
+        _start_workers(loop)
+
+
+def _put(item: dict) -> bool:
+    try:
+        _queue.put_nowait(item)
+    except asyncio.QueueFull:
+        # Still durable in the outbox; release it so the sweeper retries later
+        _counters["dropped"] += 1
+        asyncio.get_running_loop().run_in_executor(None, alert_outbox.release, item["id"])
+        print(f"❌ Alert queue full — deferred message to {item['carer_phone']}")
+        return False
+    _counters["enqueued"] += 1
+    return True
+
+
+def enqueue(carer_phone: str, message: str, message_id: str = None, trace_id: str = None) -> str | None:
+    """
+    Records a WhatsApp message in the outbox and queues it for background delivery.
+    Safe to call from the event loop or from worker threads. Passing a message_id
+    that was already recorded is a no-op. Delivery is traced under trace_id
+    (default: the caller's trace).
+    Returns the message ID, or None if it was a duplicate or deferred to the sweeper.
+    On the event loop the outbox write runs on a thread, so the ID is returned
+    before that is known.
+    """
+    msg_id = message_id or uuid.uuid4().hex
+    trace_id = trace_id or tracing.current_trace_id()
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+
+    if loop is not None:
+        if _loop is not loop:
+            _start_workers(loop)
+        task = loop.create_task(_record_and_put(carer_phone, message, msg_id, trace_id))
+        _writes.add(task)
+        task.add_done_callback(_writes.discard)
+        return msg_id
+
+    item = _record(carer_phone, message, msg_id, trace_id)
+    if item is None:
+        return None
+
+    if _loop is not None and _loop.is_running():
+        _loop.call_soon_threadsafe(_put, item)
+        return item["id"]
+
+    # No event loop anywhere (scripts, CLI) — deliver inline
+    _deliver(item)
+    return item["id"]
+
+
+def _record(carer_phone: str, message: str, msg_id: str, trace_id: str | None) -> dict | None:
+    """Writes the message to the outbox; returns the queue item, or None for a duplicate. Blocking."""
+    msg_id, claimed = alert_outbox.add(carer_phone, message, msg_id)
+    if not claimed:
+        return None
+    return {
+        "id": msg_id,
+        "carer_phone": carer_phone,
+        "message": message,
+        "enqueued_at": time.monotonic(),
+        "trace_id": trace_id,
+    }
+
+
+async def _record_and_put(carer_phone: str, message: str, msg_id: str, trace_id: str | None) -> None:
+    item = await asyncio.to_thread(_record, carer_phone, message, msg_id, trace_id)
+    if item is not None:
+        _put(item)
+
+
+def _deliver(item: dict) -> bool:
+    started = time.monotonic()
+    queue_wait_ms = round((started - item["enqueued_at"]) * 1000, 2)
+    with tracing.span("alerts.deliver", trace_id=item.get("trace_id"), queue_wait_ms=queue_wait_ms) as span:
+        try:
+            ok = bool(_sink(item["carer_phone"], item["message"]))
+        except Exception as e:
+            print(f"❌ Alert sink raised for {item['carer_phone']}: {e}")
+            ok = False
+        if span:
+            span.set(ok=ok)
+    finished = time.monotonic()
+
+    if ok:
+        alert_outbox.mark_delivered(item["id"])
+    else:
+        alert_outbox.mark_failed(item["id"], "provider send failed")
+
+    _counters["sent" if ok else "failed"] += 1
+    _recent.append({
+        "id": item["id"],
+        "carer_phone": item["carer_phone"],
+        "ok": ok,
+        "queue_wait_ms": queue_wait_ms,
+        "send_ms": round((finished - started) * 1000, 2),
+    })
+    return ok
+
+
+async def _worker() -> None:
+    while True:
+        item = await _queue.get()
+        try:
+            await asyncio.to_thread(_deliver, item)
+        finally:
+            _queue.task_done()
+
+
+async def _sweeper() -> None:
+    """Feeds due retries and leftover pending alerts back into the queue, rate-limited."""
+    budget = 0.0
+    while True:
+        await asyncio.sleep(ALERT_SWEEP_INTERVAL_S)
+        budget = min(budget + ALERT_OUTBOX_RATE * ALERT_SWEEP_INTERVAL_S, max(ALERT_OUTBOX_RATE, 1.0))
+        free = _queue.maxsize - _queue.qsize()
+        limit = min(int(budget), free)
+        if limit <= 0:
+            continue
+        for msg in await asyncio.to_thread(alert_outbox.claim_due, limit):
+            _put({
+                "id": msg["id"],
+                "carer_phone": msg["carer_phone"],
+                "message": msg["message"],
+                "enqueued_at": time.monotonic(),
+            })
+            _counters["swept"] += 1
+            budget -= 1
+
+
+async def drain(timeout: float = 10.0) -> None:
+    """Waits for queued alerts to be delivered, then stops the workers."""
+    global _loop
+    if _queue is None:
+        return
+    if _writes:
+        await asyncio.gather(*_writes, return_exceptions=True)
+    try:
+        await asyncio.wait_for(_queue.join(), timeout)
+    except asyncio.TimeoutError:
+        print(f"⚠️ Alert queue drain timed out with {_queue.qsize()} messages left")
+    for task in _workers:
+        task.cancel()
+    _workers.clear()
+    _loop = None
+
+
+def metrics() -> dict:
+    return {
+        **_counters,
+        "queue_depth": _queue.qsize() if _queue is not None else 0,
+        "workers": len(_workers),
+        "outbox": alert_outbox.stats(),
+        "recent": list(_recent),
+    }
@@ -1,6 +1,8 @@
 from twilio.rest import Client
 import os
+import threading
 from dotenv import load_dotenv
+from services import tracing
 
 load_dotenv()
 
@@ -8,6 +10,19 @@ TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_WHATSAPP_NUMBER = "whatsapp:+14155238886"  # Twilio shared sandbox number
 
+_twilio_client: Client | None = None
+_twilio_client_lock = threading.Lock()
+
+
+def _get_twilio_client() -> Client:
+    """Returns one shared Twilio client so its HTTP session is reused across sends."""
+    global _twilio_client
+    if _twilio_client is None:
+        with _twilio_client_lock:
+            if _twilio_client is None:
+                _twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+    return _twilio_client
+
 
 def send_carer_sms(carer_phone: str, message: str) -> bool:
     """
@@ -19,12 +34,14 @@ def send_carer_sms(carer_phone: str, message: str) -> bool:
         return False
 
     try:
-        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-        client.messages.create(
-            body=message,
-            from_=TWILIO_WHATSAPP_NUMBER,
-            to=f"whatsapp:{carer_phone}"  # e.g. whatsapp:+353871234567
-        )
+        # Let the error leave the span so it counts as a failed upstream call
+        with tracing.span("twilio.send"):
+            client = _get_twilio_client()
+            client.messages.create(
+                body=message,
+                from_=TWILIO_WHATSAPP_NUMBER,
+                to=f"whatsapp:{carer_phone}"  # e.g. whatsapp:+353871234567
+            )
         print(f"💬 WhatsApp sent to {carer_phone}")
         return True
 
@@ -64,4 +81,51 @@ def build_registration_message(user_name: str) -> str:
         f"👋 Hi! You've been added as a trusted contact for {user_name} on Alma.\n\n"
         f"You'll receive WhatsApp alerts if a payment looks suspicious, "
         f"fails, or is unusually large."
-    )
\ No newline at end of file
+    )
+
+def _describe_alert_reason(reason: dict) -> str:
+    if reason["kind"] == "fraud":
+        return f"flagged as {reason['risk_level'].upper()} risk"
+    if reason["kind"] == "large":
+        return "unusually large"
+    if reason["kind"] == "failure":
+        return f"failed ({reason['failure_reason']})"
+    return reason["kind"]
+
+
+def build_combined_alert_message(user_name: str, amount: float, currency: str, reasons: list) -> str:
+    """
+    One message for every reason raised about the same payment.
+    A single reason uses the dedicated builder so the wording is unchanged.
+    """
+    if len(reasons) == 1:
+        reason = reasons[0]
+        if reason["kind"] == "fraud":
+            return build_fraud_alert_message(user_name, amount, currency, reason["risk_level"], reason["alma_message"])
+        if reason["kind"] == "large":
+            return build_large_payment_message(user_name, amount, currency)
+        if reason["kind"] == "failure":
+            return build_payment_failure_message(user_name, amount, currency, reason["failure_reason"])
+
+    lines = "\n".join(f"• {_describe_alert_reason(r)}" for r in reasons)
+    fraud = next((r for r in reasons if r["kind"] == "fraud"), None)
+    return (
+        f"🚨 ALMA ALERT\n"
+        f"{user_name} made a payment of {amount} {currency} that was:\n"
+        f"{lines}\n\n"
+        + (fraud["alma_message"] if fraud else "Please check in with them if this seems unexpected.")
+    )
+
+
+def build_digest_message(entries: list) -> str:
+    lines = "\n".join(
+        f"• {e['user_name']}: {e['amount']} {e['currency']} — "
+        + ", ".join(_describe_alert_reason(r) for r in e["reasons"])
+        for e in entries
+    )
+    return (
+        f"📋 ALMA DIGEST\n"
+        f"{len(entries)} payment{'s' if len(entries) != 1 else ''} worth a look:\n"
+        f"{lines}\n"
+        f"Please check in if any of these seem unexpected."
+    )
@@ -0,0 +1,160 @@
+"""
+services/balance_prefetch.py
+
+Speculative, cached TrueLayer balance fetches for the chat endpoint.
+
+CHECK_BALANCE is the most common chat intent, and its get_accounts +
+get_balance round trips used to start only after Gemini had answered.
+When a turn goes to Gemini and the session has a linked bank token, the
+chat route calls start() so the fetch runs on a thread while the intent is
+being classified. If the intent turns out to be CHECK_BALANCE the handler
+awaits the task instead of fetching; otherwise the task is left to finish
+and its result simply warms the cache.
+
+Results are cached per token/account for BALANCE_CACHE_TTL_S. Speculative
+fetches draw from a token bucket (TRUELAYER_PREFETCH_RATE per second, bursts
+of TRUELAYER_PREFETCH_BURST) so chatter that never asks for a balance can't
+run up TrueLayer calls; when the bucket is empty the handler fetches on
+demand as before.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import threading
+import time
+
+from services.truelayer import get_accounts, get_balance
+
+BALANCE_CACHE_TTL_S = float(os.getenv("BALANCE_CACHE_TTL_S", 30))
+TRUELAYER_PREFETCH_RATE = float(os.getenv("TRUELAYER_PREFETCH_RATE", 2))
+TRUELAYER_PREFETCH_BURST = float(os.getenv("TRUELAYER_PREFETCH_BURST", 5))
+
+_cache: dict[tuple[str, str | None], tuple[float, dict]] = {}   # (token hash, account) -> (fetched_at, result)
+_inflight: dict[tuple[str, str | None], asyncio.Task] = {}
+_lock = threading.Lock()
+
+_budget = TRUELAYER_PREFETCH_BURST
+_budget_at = time.monotonic()
+
+_counters = {"started": 0, "used": 0, "discarded": 0, "over_budget": 0, "cache_hits": 0, "fetches": 0}
+
+
+def _key(token: str, account_id: str | None) -> tuple[str, str | None]:
+    return hashlib.sha256(token.encode()).hexdigest()[:16], account_id or None
+
+
+def _take_budget() -> bool:
+    global _budget, _budget_at
+    now = time.monotonic()
+    _budget = min(TRUELAYER_PREFETCH_BURST, _budget + (now - _budget_at) * TRUELAYER_PREFETCH_RATE)
+    _budget_at = now
+    if _budget < 1:
+        return False
+    _budget -= 1
+    return True
+
+
+def _cached(key: tuple[str, str | None]) -> dict | None:
+    hit = _cache.get(key)
+    if hit is None or time.monotonic() - hit[0] > BALANCE_CACHE_TTL_S:
+        return None
+    return hit[1]
+
+
+def fetch_balance(token: str, primary_account_id: str | None = None) -> dict:
+    """
+    Fetches the primary account's balance, discovering the account first if
+    needed. Served from cache when fresh.
+
+    Returns:
+        dict: {"primary_account_id", "balance" (TrueLayer response or None),
+               "error" (None, or ("accounts" | "balance", message))}
+    """
+    key = _key(token, primary_account_id)
+    with _lock:
+        cached = _cached(key)
+    if cached is not None:
+        _counters["cache_hits"] += 1
+        return cached
+
+    _counters["fetches"] += 1
+    result = {"primary_account_id": primary_account_id, "balance": None, "error": None}
+    if not primary_account_id:
+        try:
+            results = get_accounts(access_token=token).get("results", [])
+        except Exception as exc:
+            result["error"] = ("accounts", str(exc))
+            return result
+        if not results:
+            return result
+        result["primary_account_id"] = results[0]["account_id"]
+
+    try:
+        result["balance"] = get_balance(result["primary_account_id"], access_token=token)
+    except Exception as exc:
+        result["error"] = ("balance", str(exc))
+        return result
+
+    fetched_at = time.monotonic()
+    with _lock:
+        _cache[key] = (fetched_at, result)
+        _cache[_key(token, result["primary_account_id"])] = (fetched_at, result)
+    return result
+
+
+def start(token: str | None, primary_account_id: str | None = None) -> asyncio.Task | None:
+    """
+    Starts a speculative fetch_balance on a thread. Returns None when there
+    is no token or the rate budget is spent.
+    """
+    if not token:
+        return None
+    key = _key(token, primary_account_id)
+    with _lock:
+        task = _inflight.get(key)
+        if task is not None and not task.done():
+            return task
+        if _cached(key) is None and not _take_budget():
+            _counters["over_budget"] += 1
+            return None
+        task = asyncio.get_running_loop().create_task(asyncio.to_thread(fetch_balance, token, primary_account_id))
+        _inflight[key] = task
+    task.add_done_callback(lambda t: _inflight.pop(key, None) if _inflight.get(key) is t else None)
+    _counters["started"] += 1
+    return task
+
+
+async def take(task: asyncio.Task | None) -> dict | None:
+    """Awaits a prefetch for a CHECK_BALANCE turn. None if there was none or it failed."""
+    if task is None:
+        return None
+    try:
+        result = await task
+    except Exception:
+        return None
+    _counters["used"] += 1
+    return result
+
+
+def discard(task: asyncio.Task | None) -> None:
+    """Marks a prefetch unused; it still finishes and warms the cache."""
+    if task is not None:
+        _counters["discarded"] += 1
+
+
+def invalidate(token: str | None) -> None:
+    """Drops cached balances for a token (e.g. after a payment)."""
+    if not token:
+        return
+    token_hash = _key(token, None)[0]
+    with _lock:
+        for key in [k for k in _cache if k[0] == token_hash]:
+            del _cache[key]
+
+
+def stats() -> dict:
+    with _lock:
+        return {**_counters, "cached": len(_cache), "budget": round(_budget, 2)}
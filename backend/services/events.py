@@ -0,0 +1,143 @@
+"""
+services/events.py
+
+In-process pub/sub for the overseer live feed.
+
+Payment, chat-confirm, webhook and alert code calls publish(topic, user_id,
+data); it never blocks and may be called from any thread. Each subscriber
+(one per open /api/overseer/events stream) names the user IDs it follows and
+gets its own queue of at most EVENT_QUEUE_SIZE events. When a slow client
+lets its queue fill, the oldest events are dropped and counted, and the
+stream tells the client how many it missed so it can refetch the dashboard.
+Publishers never wait on a subscriber.
+
+The last EVENT_REPLAY_SIZE events are also kept so a client reconnecting
+with Last-Event-ID gets what it missed in between. Event IDs are k-sortable
+(services/ids.py), so "after this ID" is a plain comparison.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+from services import ids
+
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", 100))
+EVENT_REPLAY_SIZE = int(os.getenv("EVENT_REPLAY_SIZE", 500))
+
+_lock = threading.Lock()
+_subscribers: set["Subscriber"] = set()
+_recent: deque = deque(maxlen=EVENT_REPLAY_SIZE)
+_counters = {"published": 0, "delivered": 0, "dropped": 0, "subscribed": 0}
+
+
+class Subscriber:
+    """One consumer's bounded queue. Create with subscribe()."""
+
+    def __init__(self, user_ids, loop: asyncio.AbstractEventLoop):
+        self.user_ids = frozenset(user_ids)
+        self.dropped = 0   # dropped since the consumer last looked
+        self._queue: deque = deque()
+        self._loop = loop
+        self._ready = asyncio.Event()
+        self._woken = False   # a wake-up is already scheduled on the loop
+
+    def _offer(self, event: dict) -> None:
+        """Queues an event, dropping the oldest if full. Caller holds _lock."""
+        if len(self._queue) >= EVENT_QUEUE_SIZE:
+            self._queue.popleft()
+            self.dropped += 1
+            _counters["dropped"] += 1
+        self._queue.append(event)
+        _counters["delivered"] += 1
+        if not self._woken:
+            # asyncio.Event is not thread-safe; one wake-up per batch is enough
+            self._loop.call_soon_threadsafe(self._ready.set)
+            self._woken = True
+
+    async def get(self, timeout: float) -> tuple[list[dict], int]:
+        """
+        Waits up to timeout seconds for events. May return nothing early;
+        callers just ask again.
+
+        Returns:
+            tuple: (queued events, oldest first; events dropped since the last call)
+        """
+        if not self._queue:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        with _lock:
+            events = list(self._queue)
+            self._queue.clear()
+            self._ready.clear()
+            self._woken = False
+            dropped, self.dropped = self.dropped, 0
+        return events, dropped
+
+    def pending(self) -> int:
+        return len(self._queue)
+
+
+def publish(topic: str, user_id: str | None, data: dict) -> dict:
+    """
+    Fans an event out to every subscriber following user_id. Thread-safe
+    and non-blocking.
+
+    Returns:
+        dict: The event, {"id", "topic", "user_id", "at", "data"}
+    """
+    with _lock:
+        # IDs are taken under the lock so queues and the replay buffer stay in ID order
+        event = {"id": ids.new_id("evt"), "topic": topic, "user_id": user_id, "at": time.time(), "data": data}
+        _counters["published"] += 1
+        _recent.append(event)
+        for subscriber in _subscribers:
+            if user_id in subscriber.user_ids:
+                try:
+                    subscriber._offer(event)
+                except RuntimeError:   # its loop has closed; unsubscribe() will follow
+                    pass
+    return event
+
+
+def subscribe(user_ids, last_event_id: str | None = None) -> Subscriber:
+    """
+    Registers a subscriber on the running loop. With last_event_id, replays
+    retained events newer than it first (oldest are dropped as usual if
+    there are more than fit).
+
+    Raises:
+        ValueError: if last_event_id is not an event ID
+    """
+    loop = asyncio.get_running_loop()
+    after = ids.sort_key(last_event_id) if last_event_id else None
+    subscriber = Subscriber(user_ids, loop)
+    with _lock:
+        if after is not None:
+            for event in _recent:
+                if event["user_id"] in subscriber.user_ids and ids.sort_key(event["id"]) > after:
+                    subscriber._offer(event)
+        _subscribers.add(subscriber)
+        _counters["subscribed"] += 1
+    return subscriber
+
+
+def unsubscribe(subscriber: Subscriber) -> None:
+    with _lock:
+        _subscribers.discard(subscriber)
+
+
+def stats() -> dict:
+    with _lock:
+        return {
+            **_counters,
+            "subscribers": len(_subscribers),
+            "queued": sum(s.pending() for s in _subscribers),
+            "retained": len(_recent),
+        }
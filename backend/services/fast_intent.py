@@ -0,0 +1,146 @@
+"""
+services/fast_intent.py
+
+Deterministic intent classifier that runs before Gemini.
+
+Short, unambiguous utterances ("yes", "cancel", "what's my balance",
+"send 20 euro to Tesco") are recognised with a few regexes and returned
+in the same shape GeminiIntentClient.classify_intent produces. Anything
+the rules aren't sure about returns None and falls through to the LLM.
+"""
+
+from __future__ import annotations
+
+import re
+import threading
+from typing import Any, Callable
+
+Intent = dict[str, Any]
+
+_PUNCT_RE = re.compile(r"[^\w\s'€.,]")
+_SPACE_RE = re.compile(r"\s+")
+
+CONFIRM_PHRASES = {
+    "yes", "yeah", "yep", "yes please", "confirm", "confirmed", "i confirm",
+    "go ahead", "yes go ahead", "do it", "send it", "ok", "okay", "sure",
+    "that's right", "thats right", "correct", "yes confirm", "please confirm",
+}
+CANCEL_PHRASES = {
+    "no", "nope", "no thanks", "no thank you", "cancel", "cancel that",
+    "cancel it", "stop", "don't", "dont", "never mind", "nevermind",
+    "forget it", "don't send it", "dont send it",
+}
+HELP_PHRASES = {
+    "help", "help me", "what can you do", "what can i do", "how does this work",
+    "what can you help with", "what can you help me with",
+}
+_FILLER_RE = re.compile(r"^(?:um+|uh+|er+|hey alma|alma|hi|hello|ok alma|please)[\s,]+|[\s,]+(?:please|thanks|thank you)$")
+
+BALANCE_RE = re.compile(
+    r"\b(?:balance|how much (?:money )?(?:do i have|have i got|is in my (?:bank )?account|is left|have i left))\b"
+)
+MONEY_VERB_RE = re.compile(r"\b(?:send|pay|transfer|give)\b")
+
+_AMOUNT = r"(?:€\s*)?(?P<amount>\d+(?:[.,]\d{1,2})?)\s*(?:euros?|eur|€)?"
+TRANSFER_RES = [
+    # "send 20 euro to Tesco", "transfer €15.50 to Mary"
+    re.compile(rf"^(?:can you |could you |i want to |i'd like to |id like to )?(?:send|pay|transfer|give)\s+{_AMOUNT}\s+to\s+(?P<payee>.+)$"),
+    # "pay Tesco 20 euro", "give Mary €10"
+    re.compile(rf"^(?:can you |could you |i want to |i'd like to |id like to )?(?:pay|give|send)\s+(?P<payee>.+?)\s+{_AMOUNT}$"),
+]
+
+_stats = {"fast": 0, "gemini": 0}
+_stats_lock = threading.Lock()
+
+
+def normalise(transcript: str) -> str:
+    """Lower-cases, strips punctuation/filler and collapses whitespace."""
+    text = _PUNCT_RE.sub(" ", transcript.lower())
+    text = _SPACE_RE.sub(" ", text).strip(" .,")
+    previous = None
+    while previous != text:
+        previous = text
+        text = _FILLER_RE.sub("", text).strip(" .,")
+    return text
+
+
+def _match_payee(
+    spoken: str,
+    payees_allowed: list[str],
+    resolve_payee: Callable[[str], str | None] | None = None,
+) -> str | None:
+    spoken = spoken.strip(" .,")
+    spoken = re.sub(r"^the\s+", "", spoken)
+    candidates = {spoken, spoken.replace("'s", "").replace("'", "")}
+    for label in payees_allowed:
+        if label.lower() in candidates:
+            return label
+    if resolve_payee is not None:
+        label = resolve_payee(spoken)
+        if label in payees_allowed:
+            return label
+    return None
+
+
+def _parse_amount(raw: str) -> float:
+    return float(raw.replace(",", "."))
+
+
+def classify(
+    transcript: str,
+    payees_allowed: list[str],
+    pending_transfer: dict | None,
+    resolve_payee: Callable[[str], str | None] | None = None,
+) -> tuple[Intent, str] | None:
+    """
+    Returns (intent, rule_name) when a rule matches with high confidence,
+    otherwise None so the caller falls through to Gemini.
+
+    resolve_payee, if given, maps a spoken payee that isn't an exact label
+    to a confident fuzzy match (or None).
+    """
+    text = normalise(transcript)
+    if not text:
+        return None
+
+    if text in CONFIRM_PHRASES:
+        # "yes" with nothing pending is ambiguous — let Gemini ask what they mean
+        return ({"intent": "CONFIRM"}, "confirm_phrase") if pending_transfer else None
+
+    if text in CANCEL_PHRASES:
+        # "no"/"stop" with nothing pending may answer another question — same as "yes"
+        return ({"intent": "CANCEL"}, "cancel_phrase") if pending_transfer else None
+
+    if text in HELP_PHRASES:
+        return {"intent": "HELP"}, "help_phrase"
+
+    if BALANCE_RE.search(text) and not MONEY_VERB_RE.search(text):
+        return {"intent": "CHECK_BALANCE"}, "balance_question"
+
+    for pattern in TRANSFER_RES:
+        match = pattern.match(text)
+        if not match:
+            continue
+        payee = _match_payee(match.group("payee"), payees_allowed, resolve_payee)
+        amount = _parse_amount(match.group("amount"))
+        if payee and amount > 0:
+            return {
+                "intent": "TRANSFER_DRAFT",
+                "payee_label": payee,
+                "amount": amount,
+                "currency": "EUR",
+            }, "transfer_pattern"
+
+    return None
+
+
+def record_path(path: str) -> None:
+    """Counts which classifier handled a turn ("fast" or "gemini")."""
+    with _stats_lock:
+        _stats[path] = _stats.get(path, 0) + 1
+
+
+def stats() -> dict:
+    with _stats_lock:
+        total = sum(_stats.values())
+        return {**_stats, "fast_ratio": round(_stats["fast"] / total, 3) if total else 0.0}
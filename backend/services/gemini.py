@@ -1,30 +1,208 @@
 from __future__ import annotations
 
+import asyncio
+import copy
+import hashlib
 import json
 import os
 import re
+import threading
+import time
+from collections import OrderedDict, deque
 from dataclasses import dataclass, field
-from typing import Any
+from typing import Any, Literal, Optional
 
 from google import genai
+from google.genai import types
+from pydantic import BaseModel, ValidationError, create_model
 
-VALID_INTENTS = {"CHECK_BALANCE", "TRANSFER_DRAFT", "CONFIRM", "CANCEL", "CLARIFY", "HELP"}
+from services import tracing
+from services.fast_intent import normalise
+
+INTENT_SCHEMA: dict[str, dict[str, Any]] = {
+    "CHECK_BALANCE": {"intent": "CHECK_BALANCE", "assistant_say": "string"},
+    "TRANSFER_DRAFT": {
+        "intent": "TRANSFER_DRAFT",
+        "payee_label": "string",
+        "amount": "number",
+        "currency": "EUR",
+        "assistant_say": "string",
+    },
+    "CONFIRM": {"intent": "CONFIRM", "assistant_say": "string"},
+    "CANCEL": {"intent": "CANCEL", "assistant_say": "string"},
+    "CLARIFY": {
+        "intent": "CLARIFY",
+        "assistant_say": "string",
+        "choices": ["optional", "array", "of", "strings"],
+    },
+    "HELP": {"intent": "HELP", "assistant_say": "string"},
+}
+
+VALID_INTENTS = set(INTENT_SCHEMA)
 
 Intent = dict[str, Any]
 
+_SCHEMA_FIELD_TYPES = {"string": str, "number": float}
+
+
+def build_intent_response_model(schema: dict[str, dict[str, Any]]) -> type[BaseModel]:
+    """
+    Generates the typed response model from the intent schema: `intent` is an
+    enum of the schema's intents and every other field is optional.
+    """
+    fields: dict[str, Any] = {"intent": (Literal[tuple(schema)], ...)}
+    for shape in schema.values():
+        for name, example in shape.items():
+            if name in fields:
+                continue
+            if isinstance(example, list):
+                field_type = list[str]
+            else:
+                field_type = _SCHEMA_FIELD_TYPES.get(example, str)
+            fields[name] = (Optional[field_type], None)
+    return create_model("IntentResponse", **fields)
+
+
+IntentResponse = build_intent_response_model(INTENT_SCHEMA)
+
+
+def _build_static_prompt() -> str:
+    """The part of the classifier prompt that never changes between turns."""
+    return (
+        "You are an intent classifier for a banking voice assistant called Alma.\n"
+        "Return ONLY JSON. No markdown, no explanation.\n"
+        "Valid intents and shape:\n"
+        f"{json.dumps(INTENT_SCHEMA)}\n"
+        "Rules: if user asks to send/transfer money, use TRANSFER_DRAFT. "
+        "Use exact payee label when possible. If ambiguous, choose CLARIFY.\n"
+    )
+
+
+_started = time.perf_counter()
+STATIC_PROMPT = _build_static_prompt()
+STATIC_PROMPT_BUILD_US = round((time.perf_counter() - _started) * 1e6, 1)
+
+
+@dataclass
+class Generation:
+    text: str
+    intent: Intent | None
+    structured: bool
+
 JSON_RE = re.compile(r"\{.*\}", re.DOTALL)
 
+# Intents that act on whatever transfer is pending right now; never served from cache
+TIME_SENSITIVE_INTENTS = {"CONFIRM", "CANCEL"}
+
 
 @dataclass(frozen=True)
 class Settings:
     gemini_api_key: str | None = field(default_factory=lambda: os.getenv("GEMINI_API_KEY"))
     gemini_model: str = field(default_factory=lambda: os.getenv("GEMINI_MODEL", "gemini-2.5-flash"))
+    intent_cache_max_bytes: int = field(default_factory=lambda: int(os.getenv("INTENT_CACHE_MAX_BYTES", 1_000_000)))
+    intent_cache_ttl_s: float = field(default_factory=lambda: float(os.getenv("INTENT_CACHE_TTL_S", 600)))
+    # Async path: total time allowed per classification, and when to hedge to the fallback model
+    turn_budget_s: float = field(default_factory=lambda: float(os.getenv("GEMINI_TURN_BUDGET_S", 6.0)))
+    hedge_percentile: float = field(default_factory=lambda: float(os.getenv("GEMINI_HEDGE_PERCENTILE", 90)))
+    hedge_default_delay_s: float = field(default_factory=lambda: float(os.getenv("GEMINI_HEDGE_DELAY_S", 1.5)))
+    # >0 uploads STATIC_PROMPT as an explicit context cache per model; 0 sends it as system_instruction
+    prompt_cache_ttl_s: float = field(default_factory=lambda: float(os.getenv("GEMINI_PROMPT_CACHE_TTL_S", 0)))
 
 
 def get_settings() -> Settings:
     return Settings()
 
 
+class IntentCache:
+    """
+    LRU + TTL cache of classified intents, bounded by the approximate size
+    of the cached payloads rather than the number of entries.
+    """
+
+    def __init__(self, max_bytes: int, ttl_s: float) -> None:
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self._entries: OrderedDict[tuple, tuple[float, int, Intent]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(transcript: str, payees_allowed: list[str], pending_transfer: dict | None) -> tuple:
+        payees_version = hashlib.blake2b("\x1f".join(payees_allowed).encode(), digest_size=8).hexdigest()
+        return normalise(transcript), payees_version, pending_transfer is not None
+
+    def get(self, key: tuple) -> Intent | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, size, intent = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(intent)
+
+    def put(self, key: tuple, intent: Intent) -> None:
+        if intent.get("intent") in TIME_SENSITIVE_INTENTS:
+            return
+        size = len(json.dumps(intent)) + sum(len(str(k)) for k in key)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl_s, size, copy.deepcopy(intent))
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: tuple) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class LatencyTracker:
+    """Recent primary-model latencies, used to pick when to fire a hedged request."""
+
+    MIN_SAMPLES = 20
+
+    def __init__(self, percentile: float, default_delay_s: float, window: int = 200) -> None:
+        self.percentile = percentile
+        self.default_delay_s = default_delay_s
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def hedge_delay(self) -> float:
+        if len(self._samples) < self.MIN_SAMPLES:
+            return self.default_delay_s
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return ordered[index]
+
+
 class GeminiIntentClient:
     def __init__(self) -> None:
         settings = get_settings()
@@ -33,6 +211,56 @@ class GeminiIntentClient:
         self.client = genai.Client(api_key=settings.gemini_api_key)
         self.primary_model = settings.gemini_model
         self.fallback_model = "gemini-1.5-flash"
+        self.cache = IntentCache(settings.intent_cache_max_bytes, settings.intent_cache_ttl_s)
+        self.turn_budget_s = settings.turn_budget_s
+        self.latency = LatencyTracker(settings.hedge_percentile, settings.hedge_default_delay_s)
+        self._unstructured_models: set[str] = set()
+        self.metrics = {
+            "classified": 0, "structured": 0, "unstructured": 0,
+            "repairs": 0, "repair_failures": 0, "parse_failures": 0,
+        }
+        self.prompt_metrics = {
+            "turns": 0, "dynamic_chars": 0, "dynamic_build_us": 0.0,
+            "responses": 0, "prompt_tokens": 0, "cached_tokens": 0,
+        }
+        self._prompt_caches: dict[str, tuple[str, float]] = {}   # model -> (cache name, expires_at)
+        if settings.prompt_cache_ttl_s > 0:
+            for model in (self.primary_model, self.fallback_model):
+                self._create_prompt_cache(model, settings.prompt_cache_ttl_s)
+
+    def _create_prompt_cache(self, model: str, ttl_s: float) -> None:
+        """
+        Uploads STATIC_PROMPT as a context cache for one model. Models or
+        prompts below the API's minimum cacheable size are rejected; those
+        keep sending the prefix as system_instruction.
+        """
+        try:
+            cache = self.client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=STATIC_PROMPT,
+                    ttl=f"{int(ttl_s)}s",
+                ),
+            )
+        except Exception as e:
+            print(f"⚠️ Prompt cache unavailable for {model}, using system_instruction: {e}")
+            return
+        # Stop using the cache slightly before the server expires it
+        self._prompt_caches[model] = (cache.name, time.monotonic() + ttl_s * 0.9)
+
+    def _config(self, model: str, structured: bool) -> types.GenerateContentConfig:
+        cached = self._prompt_caches.get(model)
+        if cached is not None and cached[1] > time.monotonic():
+            prefix = {"cached_content": cached[0]}
+        else:
+            prefix = {"system_instruction": STATIC_PROMPT}
+        if structured:
+            return types.GenerateContentConfig(
+                response_mime_type="application/json",
+                response_schema=IntentResponse,
+                **prefix,
+            )
+        return types.GenerateContentConfig(**prefix)
 
     def classify_intent(
         self,
@@ -40,27 +268,91 @@ class GeminiIntentClient:
         payees_allowed: list[str],
         pending_transfer: dict | None,
     ) -> tuple[Intent, dict[str, Any] | None]:
+        """Blocking aclassify_intent for scripts; not for use inside a running event loop."""
+        return asyncio.run(self.aclassify_intent(transcript, payees_allowed, pending_transfer))
+
+    async def aclassify_intent(
+        self,
+        transcript: str,
+        payees_allowed: list[str],
+        pending_transfer: dict | None,
+    ) -> tuple[Intent, dict[str, Any] | None]:
+        """
+        Classifies one chat turn. Model calls are hedged: if the primary model
+        hasn't returned valid JSON by the hedge delay, the fallback model is
+        asked too and the first valid answer wins. The whole turn is bounded
+        by GEMINI_TURN_BUDGET_S.
+        """
+        cache_key = self.cache.make_key(transcript, payees_allowed, pending_transfer)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached, {"cache": "hit"}
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.turn_budget_s
+
+        self.metrics["classified"] += 1
         prompt = self._build_prompt(transcript, payees_allowed, pending_transfer)
-        raw_text, model_used = self._generate_with_fallback(prompt)
-        parsed = self._extract_and_validate(raw_text)
-        if parsed is not None:
-            return parsed, {"model": model_used, "raw": raw_text}
+        gen, model_used, hedge = await self._agenerate_hedged(prompt, deadline)
+        if gen.intent is not None:
+            self.cache.put(cache_key, gen.intent)
+            return gen.intent, {"model": model_used, "raw": gen.text, "structured": gen.structured, "hedge": hedge}
+        if gen.structured:
+            return self._parse_failed(gen.text)
 
-        repair_prompt = (
+        self.metrics["repairs"] += 1
+        with tracing.span("gemini.repair"):
+            repaired, repair_model, hedge = await self._agenerate_hedged(self._repair_prompt(gen.text), deadline)
+        if repaired.intent is not None:
+            self.cache.put(cache_key, repaired.intent)
+            return repaired.intent, {"model": repair_model, "raw": repaired.text, "repair": True, "hedge": hedge}
+
+        self.metrics["repair_failures"] += 1
+        return self._parse_failed(repaired.text)
+
+    def _repair_prompt(self, raw_text: str) -> str:
+        return (
             "You returned invalid JSON. Return ONLY ONE corrected JSON object that matches the schema.\n"
             f"Original output:\n{raw_text}"
         )
-        repaired_text, repair_model = self._generate_with_fallback(repair_prompt)
-        repaired = self._extract_and_validate(repaired_text)
-        if repaired is not None:
-            return repaired, {"model": repair_model, "raw": repaired_text, "repair": True}
 
+    def _parse_failed(self, raw_text: str) -> tuple[Intent, dict[str, Any]]:
+        self.metrics["parse_failures"] += 1
         fallback: Intent = {
             "intent": "CLARIFY",
             "assistant_say": "I didn't catch that. Please rephrase your request.",
             "choices": None,
         }
-        return fallback, {"error": "intent_parse_failed", "raw": repaired_text}
+        return fallback, {"error": "intent_parse_failed", "raw": raw_text}
+
+    def stats(self) -> dict[str, Any]:
+        classified = self.metrics["classified"]
+        return {
+            **self.metrics,
+            "repair_rate": round(self.metrics["repairs"] / classified, 3) if classified else 0.0,
+            "unstructured_models": sorted(self._unstructured_models),
+            "prompt": self.prompt_stats(),
+        }
+
+    def prompt_stats(self) -> dict[str, Any]:
+        """
+        Per-turn prompt cost. Before the static prefix was hoisted, every turn
+        paid static_chars + dynamic_chars_avg and static_build_us of CPU.
+        """
+        m = self.prompt_metrics
+        turns = m["turns"] or 1
+        responses = m["responses"] or 1
+        now = time.monotonic()
+        return {
+            "static_chars": len(STATIC_PROMPT),
+            "static_build_us": STATIC_PROMPT_BUILD_US,
+            "dynamic_chars_avg": round(m["dynamic_chars"] / turns, 1),
+            "dynamic_build_us_avg": round(m["dynamic_build_us"] / turns, 1),
+            "prompt_tokens_avg": round(m["prompt_tokens"] / responses, 1),
+            "cached_tokens_avg": round(m["cached_tokens"] / responses, 1),
+            "context_caches": sorted(model for model, (_, exp) in self._prompt_caches.items() if exp > now),
+            "turns": m["turns"],
+        }
 
     def _build_prompt(
         self,
@@ -68,52 +360,133 @@ class GeminiIntentClient:
         payees_allowed: list[str],
         pending_transfer: dict | None,
     ) -> str:
-        schema_description = {
-            "CHECK_BALANCE": {"intent": "CHECK_BALANCE", "assistant_say": "string"},
-            "TRANSFER_DRAFT": {
-                "intent": "TRANSFER_DRAFT",
-                "payee_label": "string",
-                "amount": "number",
-                "currency": "EUR",
-                "assistant_say": "string",
-            },
-            "CONFIRM": {"intent": "CONFIRM", "assistant_say": "string"},
-            "CANCEL": {"intent": "CANCEL", "assistant_say": "string"},
-            "CLARIFY": {
-                "intent": "CLARIFY",
-                "assistant_say": "string",
-                "choices": ["optional", "array", "of", "strings"],
-            },
-            "HELP": {"intent": "HELP", "assistant_say": "string"},
-        }
-        return (
-            "You are an intent classifier for a banking voice assistant called Alma.\n"
-            "Return ONLY JSON. No markdown, no explanation.\n"
-            "Valid intents and shape:\n"
-            f"{json.dumps(schema_description)}\n"
-            "Rules: if user asks to send/transfer money, use TRANSFER_DRAFT. "
-            "Use exact payee label when possible. If ambiguous, choose CLARIFY.\n"
+        """
+        Builds the per-turn part of the prompt; STATIC_PROMPT is sent
+        separately as system_instruction or a context cache.
+        """
+        started = time.perf_counter()
+        prompt = (
             f"payees_allowed={json.dumps(payees_allowed)}\n"
             f"pending_transfer={json.dumps(pending_transfer)}\n"
             f"transcript={json.dumps(transcript)}\n"
         )
+        self.prompt_metrics["turns"] += 1
+        self.prompt_metrics["dynamic_chars"] += len(prompt)
+        self.prompt_metrics["dynamic_build_us"] += (time.perf_counter() - started) * 1e6
+        return prompt
 
-    def _generate_with_fallback(self, prompt: str) -> tuple[str, str]:
-        try:
-            resp = self.client.models.generate_content(
-                model=self.primary_model,
+    async def _agenerate(self, model: str, prompt: str) -> Generation:
+        """
+        Requests schema-constrained JSON, dropping to plain text for models
+        that reject structured output (remembered for later calls).
+        """
+        with tracing.span("gemini.generate", model=model) as span:
+            if model not in self._unstructured_models:
+                try:
+                    resp = await self.client.aio.models.generate_content(
+                        model=model,
+                        contents=prompt,
+                        config=self._config(model, structured=True),
+                    )
+                    return _tagged(span, self._parse_response(resp, structured=True))
+                except Exception as e:
+                    if not _structured_output_unsupported(e):
+                        raise
+                    self._unstructured_models.add(model)
+            resp = await self.client.aio.models.generate_content(
+                model=model,
                 contents=prompt,
+                config=self._config(model, structured=False),
             )
-            return (resp.text or ""), self.primary_model
-        except Exception:
-            try:
-                resp = self.client.models.generate_content(
-                    model=self.fallback_model,
-                    contents=prompt,
+            return _tagged(span, self._parse_response(resp, structured=False))
+
+    async def _agenerate_hedged(self, prompt: str, deadline: float) -> tuple[Generation, str, dict[str, Any]]:
+        """
+        Returns (generation, model, hedge_info) for the first response that parses as
+        a valid intent. If no response is valid, returns the last one received
+        so the caller can attempt a repair. Outstanding requests are cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        hedge_at = started + self.latency.hedge_delay()
+        tasks: dict[asyncio.Task, str] = {
+            asyncio.create_task(self._agenerate(self.primary_model, prompt)): self.primary_model,
+        }
+        hedged = False
+        last: tuple[Generation, str] | None = None
+        errors: list[str] = []
+
+        def _hedge() -> None:
+            nonlocal hedged
+            hedged = True
+            tasks[asyncio.create_task(self._agenerate(self.fallback_model, prompt))] = self.fallback_model
+
+        try:
+            while tasks:
+                now = loop.time()
+                if now >= deadline:
+                    raise RuntimeError(f"Gemini exceeded the {self.turn_budget_s:.1f}s turn budget")
+                wait_until = deadline if hedged else min(deadline, hedge_at)
+                done, _ = await asyncio.wait(
+                    tasks, timeout=max(0.0, wait_until - now), return_when=asyncio.FIRST_COMPLETED,
                 )
-                return (resp.text or ""), self.fallback_model
-            except Exception as e:
-                raise RuntimeError(f"Both primary and fallback models failed: {e}") from e
+                if not done:
+                    if not hedged:
+                        _hedge()
+                    continue
+
+                for task in done:
+                    model = tasks.pop(task)
+                    try:
+                        gen = task.result()
+                    except Exception as e:
+                        errors.append(f"{model}: {e}")
+                        continue
+                    if model == self.primary_model:
+                        self.latency.record(loop.time() - started)
+                    info = {"hedged": hedged, "elapsed_ms": round((loop.time() - started) * 1000, 1)}
+                    if gen.intent is not None:
+                        return gen, model, info
+                    last = (gen, model)
+
+                # Primary came back unusable before the hedge fired — try the fallback now
+                if not hedged:
+                    _hedge()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if last is not None:
+            gen, model = last
+            return gen, model, {"hedged": hedged, "elapsed_ms": round((loop.time() - started) * 1000, 1)}
+        raise RuntimeError(f"Both primary and fallback models failed: {'; '.join(errors)}")
+
+    def _parse_response(self, resp: Any, structured: bool) -> Generation:
+        """
+        Validates in order of cost: the SDK's already-parsed object, then the
+        whole text as strict JSON, then (unstructured only) the first {...}
+        block found in free text.
+        """
+        self.metrics["structured" if structured else "unstructured"] += 1
+        usage = getattr(resp, "usage_metadata", None)
+        if usage is not None:
+            self.prompt_metrics["responses"] += 1
+            self.prompt_metrics["prompt_tokens"] += usage.prompt_token_count or 0
+            self.prompt_metrics["cached_tokens"] += usage.cached_content_token_count or 0
+        text = resp.text or ""
+
+        parsed = getattr(resp, "parsed", None) if structured else None
+        if isinstance(parsed, IntentResponse):
+            return Generation(text, parsed.model_dump(exclude_none=True), structured)
+
+        try:
+            intent = IntentResponse.model_validate_json(text).model_dump(exclude_none=True)
+            return Generation(text, intent, structured)
+        except ValidationError:
+            pass
+
+        intent = None if structured else self._extract_and_validate(text)
+        return Generation(text, intent, structured)
 
     def _extract_and_validate(self, text: str) -> Intent | None:
         match = JSON_RE.search(text)
@@ -121,8 +494,23 @@ class GeminiIntentClient:
             return None
         try:
             payload = json.loads(match.group(0))
-            if payload.get("intent") not in VALID_INTENTS:
+            if not isinstance(payload, dict) or payload.get("intent") not in VALID_INTENTS:
                 return None
-            return payload
-        except json.JSONDecodeError:
+            return IntentResponse.model_validate(payload).model_dump(exclude_none=True)
+        except (json.JSONDecodeError, ValidationError):
             return None
+
+
+def _tagged(span: tracing.Span | None, gen: Generation) -> Generation:
+    if span:
+        span.set(structured=gen.structured, valid=gen.intent is not None)
+    return gen
+
+
+def _structured_output_unsupported(exc: Exception) -> bool:
+    """True when the API rejected the request because of the JSON schema config."""
+    message = str(exc).lower()
+    return any(
+        marker in message
+        for marker in ("response_schema", "responseschema", "response_mime_type", "responsemimetype", "json mode")
+    )
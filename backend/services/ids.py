@@ -0,0 +1,144 @@
+"""
+services/ids.py
+
+K-sortable, collision-free IDs ("txn_0190a3f4c2b1d007").
+
+An ID is a 63-bit integer written as 16 zero-padded hex digits after the
+prefix:
+
+    41 bits  milliseconds since ID_EPOCH_MS (good until 2093)
+    10 bits  worker ID
+    12 bits  per-millisecond sequence
+
+so IDs with the same prefix sort by creation time as plain strings, and the
+timestamp can be read back from the ID alone. Within a process IDs are
+strictly increasing: a clock that steps backwards is ignored, and a
+sequence that runs out borrows the next millisecond instead of sleeping.
+
+Worker IDs come from ID_WORKER_ID when set (give each host a distinct
+range). Otherwise each process claims a free slot by holding an fcntl lock
+on a file in LOCK_DIR, so uvicorn workers on one host never share one.
+
+Legacy "txn_<13-digit ms>" IDs still decode, via sort_key().
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+
+from services.locks import LOCK_DIR
+
+try:
+    import fcntl
+except ImportError:   # Windows: fall back to the PID
+    fcntl = None
+
+ID_EPOCH_MS = 1704067200000   # 2024-01-01T00:00:00Z
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+ID_HEX_DIGITS = 16
+LEGACY_DIGITS = 13
+
+_lock = threading.Lock()
+_last_ms = 0
+_sequence = 0
+_worker_id: int | None = None
+_worker_fd: int | None = None
+
+
+def _claim_worker_id() -> int:
+    """Picks this process's worker ID. Caller holds _lock."""
+    global _worker_fd
+    configured = os.getenv("ID_WORKER_ID")
+    if configured:
+        return int(configured) & MAX_WORKER_ID
+    if fcntl is None:
+        return os.getpid() & MAX_WORKER_ID
+
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    start = os.getpid() & MAX_WORKER_ID
+    for offset in range(MAX_WORKER_ID + 1):
+        slot = (start + offset) & MAX_WORKER_ID
+        fd = os.open(os.path.join(LOCK_DIR, f"id-worker-{slot}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        _worker_fd = fd   # held for the life of the process
+        return slot
+    raise RuntimeError("No free ID worker slot")
+
+
+def _reset_after_fork() -> None:
+    """A forked child must not reuse its parent's worker ID or sequence."""
+    global _lock, _worker_id, _worker_fd, _last_ms, _sequence
+    _lock = threading.Lock()
+    if _worker_fd is not None:
+        os.close(_worker_fd)   # the parent keeps its own lock on the slot
+    _worker_id = _worker_fd = None
+    _last_ms = _sequence = 0
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def worker_id() -> int:
+    global _worker_id
+    with _lock:
+        if _worker_id is None:
+            _worker_id = _claim_worker_id()
+        return _worker_id
+
+
+def _next_value() -> int:
+    global _last_ms, _sequence, _worker_id
+    with _lock:
+        if _worker_id is None:
+            _worker_id = _claim_worker_id()
+        now_ms = int(time.time() * 1000) - ID_EPOCH_MS
+        if now_ms > _last_ms:
+            _last_ms = now_ms
+            _sequence = 0
+        elif _sequence < MAX_SEQUENCE:
+            _sequence += 1
+        else:
+            _last_ms += 1
+            _sequence = 0
+        return (_last_ms << (WORKER_BITS + SEQUENCE_BITS)) | (_worker_id << SEQUENCE_BITS) | _sequence
+
+
+def new_id(prefix: str) -> str:
+    return f"{prefix}_{_next_value():0{ID_HEX_DIGITS}x}"
+
+
+def sort_key(id_: str) -> int:
+    """
+    The ID's integer value; orders new and legacy IDs by creation time.
+    Legacy "<prefix>_<ms>" IDs map to the first value of their millisecond.
+
+    Raises:
+        ValueError: if id_ is neither kind of ID
+    """
+    body = id_.rsplit("_", 1)[-1]
+    if len(body) == LEGACY_DIGITS and body.isdigit():
+        return max(0, int(body) - ID_EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)
+    if len(body) != ID_HEX_DIGITS:
+        raise ValueError(f"Not a sortable ID: {id_!r}")
+    return int(body, 16)
+
+
+def timestamp(id_: str) -> float:
+    """Creation time of an ID, in Unix seconds."""
+    return ((sort_key(id_) >> (WORKER_BITS + SEQUENCE_BITS)) + ID_EPOCH_MS) / 1000
+
+
+def floor_id(prefix: str, at: float) -> str:
+    """The smallest possible ID created at Unix time `at`, for time-range scans."""
+    ms = max(0, int(at * 1000) - ID_EPOCH_MS)
+    return f"{prefix}_{ms << (WORKER_BITS + SEQUENCE_BITS):0{ID_HEX_DIGITS}x}"
@@ -54,6 +54,11 @@ def create_issuing_cardholder(name: str, email: str, phone: str, address: dict)
     }
 
 
+def deactivate_issuing_cardholder(cardholder_id: str) -> None:
+    """Cardholders can't be deleted; an inactive one can't be issued cards or authorise spend."""
+    stripe.issuing.Cardholder.modify(cardholder_id, status="inactive")
+
+
 def create_virtual_card(cardholder_id: str, weekly_limit: int = None) -> dict:
     limit = weekly_limit or DEFAULT_WEEKLY_LIMIT
 
@@ -0,0 +1,338 @@
+"""
+services/ledger.py
+
+Double-entry ledger for platform (user-to-user) money.
+
+Every posting is one journal entry whose legs sum to zero, written to
+LEDGER_JOURNAL_PATH as a single JSON line and flushed before the in-memory
+balances change, so both legs of a transfer land together or not at all (a
+torn final line from a crash is ignored on replay). Balances are kept per
+account in memory, so balance() is a dict lookup.
+
+Amounts are integer minor units (cents). Accounts are named
+"user:<user_id>:<CURRENCY>"; "platform:funding:<CURRENCY>" is the system
+account that fund() draws from and the only kind allowed to go negative.
+Money enters a user account only through fund(); an account never funded
+has a balance of 0. For demos, LEDGER_OPENING_BALANCE (default 0, off)
+credits each user account with that much the first time it is touched.
+
+Every LEDGER_CHECKPOINT_EVERY entries (and at shutdown) the balances are
+written to LEDGER_CHECKPOINT_PATH together with the journal offset they
+cover; startup loads the checkpoint and replays only the journal after it.
+
+Several uvicorn workers share one journal. Every posting holds an fcntl
+lock on LEDGER_JOURNAL_PATH + ".lock" and, before checking a balance,
+applies whatever other workers appended since this process last read the
+file, so the funds check and the entry's seq always reflect the whole
+journal. balance() catches up the same way when the file has grown.
+Without fcntl (Windows) only a single worker may write the ledger.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:   # Windows: single writer only
+    fcntl = None
+
+LEDGER_JOURNAL_PATH = os.getenv("LEDGER_JOURNAL_PATH", "ledger_journal.jsonl")
+LEDGER_CHECKPOINT_PATH = os.getenv("LEDGER_CHECKPOINT_PATH", "ledger_checkpoint.json")
+LEDGER_CHECKPOINT_EVERY = int(os.getenv("LEDGER_CHECKPOINT_EVERY", 1000))
+LEDGER_OPENING_BALANCE = float(os.getenv("LEDGER_OPENING_BALANCE", 0))   # demo seed, major units; 0 disables
+LEDGER_FSYNC = os.getenv("LEDGER_FSYNC", "").lower() in ("1", "true", "yes")
+
+SYSTEM_PREFIX = "platform:"
+
+
+class InsufficientFunds(ValueError):
+    """Raised when a posting would take a user account below zero."""
+
+
+@dataclass
+class JournalEntry:
+    entry_id: str
+    seq: int
+    at: float
+    description: str
+    legs: List[Tuple[str, int]]    # (account, signed minor units); sums to zero
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "entry_id": self.entry_id,
+            "seq": self.seq,
+            "at": self.at,
+            "description": self.description,
+            "legs": self.legs,
+        }, separators=(",", ":"))
+
+
+_balances: Dict[str, int] = {}
+_seq = 0
+_offset = 0            # bytes of the journal applied to _balances
+_since_checkpoint = 0
+_file = None
+_lock = threading.Lock()
+_counters = {"posted": 0, "rejected": 0, "opened": 0, "checkpoints": 0, "replayed": 0}
+
+
+def to_minor(amount: float) -> int:
+    return int(round(amount * 100))
+
+
+def to_major(amount_minor: int) -> float:
+    return amount_minor / 100
+
+
+def user_account(user_id: str, currency: str) -> str:
+    return f"user:{user_id}:{currency.upper()}"
+
+
+def funding_account(currency: str) -> str:
+    return f"{SYSTEM_PREFIX}funding:{currency.upper()}"
+
+
+def _apply(legs: List[Tuple[str, int]]) -> None:
+    for account, amount in legs:
+        _balances[account] = _balances.get(account, 0) + amount
+
+
+def _write_checkpoint() -> None:
+    """Writes balances and the journal offset they cover. Caller holds the journal lock."""
+    global _since_checkpoint
+    if _file is not None:
+        _file.flush()
+    # Only what this process has applied; other workers' later entries are replayed on load
+    tmp_path = f"{LEDGER_CHECKPOINT_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"seq": _seq, "offset": _offset, "at": time.time(), "balances": _balances}, f)
+    os.replace(tmp_path, LEDGER_CHECKPOINT_PATH)
+    _since_checkpoint = 0
+    _counters["checkpoints"] += 1
+
+
+def _catch_up() -> int:
+    """
+    Applies journal entries appended since _offset, by this or any other
+    process, and truncates a torn final line. Caller holds the journal lock,
+    so no writer is part-way through a line. Returns the number applied.
+    """
+    global _seq, _offset
+    if not os.path.exists(LEDGER_JOURNAL_PATH):
+        return 0
+    size = os.path.getsize(LEDGER_JOURNAL_PATH)
+    if size == _offset:
+        return 0
+    applied = 0
+    with open(LEDGER_JOURNAL_PATH, "rb") as f:
+        f.seek(_offset)
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break   # torn final line after a crash
+            try:
+                entry = json.loads(raw)
+            except ValueError:
+                break
+            _apply([(account, amount) for account, amount in entry["legs"]])
+            _seq = max(_seq, entry["seq"])
+            _offset += len(raw)
+            applied += 1
+    if _offset < size:
+        with open(LEDGER_JOURNAL_PATH, "r+b") as f:
+            f.truncate(_offset)
+    return applied
+
+
+@contextmanager
+def _journal_locked() -> Iterator[None]:
+    """
+    Holds the in-process lock and the cross-process journal lock, with
+    _balances and _seq caught up to the end of the journal.
+    """
+    global _since_checkpoint
+    with _lock:
+        fd = None
+        if fcntl is not None:
+            fd = os.open(LEDGER_JOURNAL_PATH + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            replayed = _catch_up()
+            _counters["replayed"] += replayed
+            _since_checkpoint += replayed
+            yield
+        finally:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+
+def load() -> None:
+    """Restores balances from the checkpoint plus the journal tail. Called once at import."""
+    global _seq, _offset, _file, _since_checkpoint
+    with _lock:
+        if _file is not None:
+            _file.close()
+            _file = None
+        _balances.clear()
+        _seq = _offset = 0
+        if os.path.exists(LEDGER_CHECKPOINT_PATH):
+            with open(LEDGER_CHECKPOINT_PATH, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            _balances.update(checkpoint["balances"])
+            _seq = checkpoint["seq"]
+            _offset = checkpoint["offset"]
+        _counters["replayed"] = 0
+        _since_checkpoint = 0
+    with _journal_locked():
+        pass
+
+
+def _reset_after_fork() -> None:
+    """A forked child reopens the journal rather than sharing its parent's handle."""
+    global _lock, _file
+    _lock = threading.Lock()
+    _file = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _post(description: str, legs: List[Tuple[str, int]]) -> JournalEntry:
+    """Appends one balanced entry and applies it. Caller holds the journal lock."""
+    global _seq, _offset, _file, _since_checkpoint
+    if sum(amount for _, amount in legs) != 0:
+        raise ValueError("Journal entry legs must sum to zero")
+    entry = JournalEntry(
+        entry_id=f"je_{uuid.uuid4().hex[:16]}",
+        seq=_seq + 1,
+        at=time.time(),
+        description=description,
+        legs=legs,
+    )
+    if _file is None:
+        _file = open(LEDGER_JOURNAL_PATH, "ab")
+    line = (entry.to_json() + "\n").encode("utf-8")
+    _file.write(line)
+    _file.flush()
+    if LEDGER_FSYNC:
+        os.fsync(_file.fileno())
+    _apply(legs)
+    _seq = entry.seq
+    _offset += len(line)
+    _counters["posted"] += 1
+    _since_checkpoint += 1
+    if _since_checkpoint >= LEDGER_CHECKPOINT_EVERY:
+        _write_checkpoint()
+    return entry
+
+
+def _ensure_opened(account: str, currency: str) -> None:
+    """Credits the demo opening balance, if enabled, on first use. Caller holds the journal lock."""
+    opening = to_minor(LEDGER_OPENING_BALANCE)
+    if opening <= 0 or account in _balances or account.startswith(SYSTEM_PREFIX):
+        return
+    _post("Opening balance", [(funding_account(currency), -opening), (account, opening)])
+    _counters["opened"] += 1
+
+
+def transfer(
+    from_user_id: str,
+    to_user_id: str,
+    amount: float,
+    currency: str,
+    description: str = "",
+) -> JournalEntry:
+    """
+    Moves money between two users' accounts as one journal entry.
+
+    Raises:
+        ValueError: if the amount is not positive
+        InsufficientFunds: if the sender's balance is below the amount
+    """
+    amount_minor = to_minor(amount)
+    if amount_minor <= 0:
+        raise ValueError("Amount must be greater than zero")
+    source = user_account(from_user_id, currency)
+    destination = user_account(to_user_id, currency)
+    with _journal_locked():
+        _ensure_opened(source, currency)
+        _ensure_opened(destination, currency)
+        available = _balances.get(source, 0)
+        if available < amount_minor:
+            _counters["rejected"] += 1
+            raise InsufficientFunds(
+                f"Insufficient funds: balance {to_major(available):.2f} {currency.upper()}"
+            )
+        return _post(description or "Transfer", [(source, -amount_minor), (destination, amount_minor)])
+
+
+def fund(user_id: str, amount: float, currency: str, description: str = "Funding") -> JournalEntry:
+    """Credits a user's account from the platform funding account (top-ups, tests)."""
+    amount_minor = to_minor(amount)
+    if amount_minor <= 0:
+        raise ValueError("Amount must be greater than zero")
+    account = user_account(user_id, currency)
+    with _journal_locked():
+        _ensure_opened(account, currency)
+        return _post(description, [(funding_account(currency), -amount_minor), (account, amount_minor)])
+
+
+def _refresh() -> None:
+    """Catches up with other workers' postings if the journal has grown."""
+    try:
+        size = os.path.getsize(LEDGER_JOURNAL_PATH)
+    except OSError:
+        return
+    if size != _offset:
+        with _journal_locked():
+            pass
+
+
+def balance(user_id: str, currency: str) -> float:
+    """The user's balance in major units; 0 if the account was never funded."""
+    _refresh()
+    return to_major(_balances.get(user_account(user_id, currency), 0))
+
+
+def account_balance(account: str) -> Optional[int]:
+    """Raw balance in minor units, or None for an unknown account."""
+    _refresh()
+    return _balances.get(account)
+
+
+def checkpoint() -> None:
+    with _journal_locked():
+        _write_checkpoint()
+
+
+def close() -> None:
+    """Checkpoints and closes the journal (app shutdown)."""
+    global _file
+    with _journal_locked():
+        _write_checkpoint()
+        if _file is not None:
+            _file.close()
+            _file = None
+
+
+def stats() -> dict:
+    with _lock:
+        return {
+            **_counters,
+            "seq": _seq,
+            "accounts": len(_balances),
+            "since_checkpoint": _since_checkpoint,
+            "imbalance": sum(_balances.values()),   # always 0 unless the journal was edited by hand
+        }
+
+
+load()
@@ -0,0 +1,191 @@
+"""
+services/locks.py
+
+Keyed locks for serialising money movement per user.
+
+hold("user:a", "user:b") takes an in-process asyncio lock for each key and,
+with the "file" backend, an fcntl lock on a per-key file under LOCK_DIR, so
+requests handled by different uvicorn workers on the same host serialise
+too. Keys are always taken in sorted order, so two transfers between the
+same pair of users in opposite directions can't deadlock. Different keys
+never wait on each other.
+
+File locks are polled with a non-blocking flock and a short, growing sleep
+rather than a blocking call on a thread, so waiting never ties up the
+thread pool. Either lock not being granted within LOCK_TIMEOUT_S raises
+LockTimeout.
+
+LOCK_BACKEND is "file" (default where fcntl exists) or "local" (in-process only).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+try:
+    import fcntl
+except ImportError:   # Windows: in-process locking only
+    fcntl = None
+
+LOCK_BACKEND = os.getenv("LOCK_BACKEND", "file" if fcntl else "local")
+LOCK_DIR = os.getenv("LOCK_DIR", ".locks")
+LOCK_TIMEOUT_S = float(os.getenv("LOCK_TIMEOUT_S", 10))
+LOCK_POLL_MIN_S = 0.001
+LOCK_POLL_MAX_S = 0.05
+TOP_CONTENDED_KEYS = 10
+TRACKED_CONTENDED_KEYS = 100   # beyond this, the least contended half is forgotten
+
+
+class LockTimeout(TimeoutError):
+    """Raised when a keyed lock isn't granted within the timeout."""
+
+
+_local: dict[str, list] = {}    # key -> [asyncio.Lock, number of holders + waiters]
+_counters = {"acquired": 0, "contended": 0, "timeouts": 0, "file_polls": 0}
+_wait_total_s = 0.0
+_wait_max_s = 0.0
+_held = 0
+_contended_keys: dict[str, list] = {}   # key -> [times contended, total wait seconds]
+
+
+def _use_file_backend() -> bool:
+    return LOCK_BACKEND == "file" and fcntl is not None
+
+
+def _lock_path(key: str) -> str:
+    return os.path.join(LOCK_DIR, hashlib.sha1(key.encode()).hexdigest()[:20] + ".lock")
+
+
+async def _acquire_file(key: str, deadline: float) -> int:
+    """Takes the cross-process lock for a key. Returns the open descriptor."""
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    fd = os.open(_lock_path(key), os.O_RDWR | os.O_CREAT, 0o600)
+    delay = LOCK_POLL_MIN_S
+    while True:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            _counters["file_polls"] += 1
+            if time.monotonic() + delay > deadline:
+                os.close(fd)
+                raise LockTimeout(f"Timed out waiting for lock {key}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LOCK_POLL_MAX_S)
+
+
+def _release_file(fd: int) -> None:
+    try:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def _release_local(key: str) -> None:
+    entry = _local[key]
+    if entry[0].locked():
+        entry[0].release()
+    entry[1] -= 1
+    if entry[1] == 0:
+        del _local[key]
+
+
+def _record_wait(key: str, waited_s: float, contended: bool) -> None:
+    global _wait_total_s, _wait_max_s
+    _counters["acquired"] += 1
+    _wait_total_s += waited_s
+    _wait_max_s = max(_wait_max_s, waited_s)
+    if contended:
+        _counters["contended"] += 1
+        stats = _contended_keys.setdefault(key, [0, 0.0])
+        stats[0] += 1
+        stats[1] += waited_s
+        if len(_contended_keys) > TRACKED_CONTENDED_KEYS:
+            ranked = sorted(_contended_keys, key=lambda k: _contended_keys[k][0])
+            for stale in ranked[:len(ranked) // 2]:
+                del _contended_keys[stale]
+
+
+async def _acquire(key: str, deadline: float) -> int | None:
+    """Takes one key's local lock, then its file lock. Returns the file descriptor, if any."""
+    entry = _local.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    started = time.monotonic()
+    contended = entry[1] > 1   # someone else holds or is queued for this key
+    try:
+        if contended:
+            await asyncio.wait_for(entry[0].acquire(), max(0.0, deadline - started))
+        else:
+            await entry[0].acquire()
+    except BaseException as e:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _local[key]
+        if isinstance(e, asyncio.TimeoutError):
+            _counters["timeouts"] += 1
+            raise LockTimeout(f"Timed out waiting for lock {key}") from None
+        raise
+
+    fd = None
+    if _use_file_backend():
+        polls = _counters["file_polls"]
+        try:
+            fd = await _acquire_file(key, deadline)
+        except BaseException as e:
+            if isinstance(e, LockTimeout):
+                _counters["timeouts"] += 1
+            _release_local(key)
+            raise
+        contended = contended or _counters["file_polls"] != polls
+    _record_wait(key, time.monotonic() - started, contended)
+    return fd
+
+
+@asynccontextmanager
+async def hold(*keys: str, timeout: float | None = None) -> AsyncIterator[None]:
+    """
+    Holds the locks for every key (in sorted order) for the enclosed block.
+
+    Raises:
+        LockTimeout: if any lock isn't granted within timeout (LOCK_TIMEOUT_S by default)
+    """
+    global _held
+    deadline = time.monotonic() + (LOCK_TIMEOUT_S if timeout is None else timeout)
+    acquired: list[tuple[str, int | None]] = []
+    try:
+        for key in sorted(set(keys)):
+            acquired.append((key, await _acquire(key, deadline)))
+        _held += len(acquired)
+        try:
+            yield
+        finally:
+            _held -= len(acquired)
+    finally:
+        for key, fd in reversed(acquired):
+            if fd is not None:
+                _release_file(fd)
+            _release_local(key)
+
+
+def user_key(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+def stats() -> dict:
+    top = sorted(_contended_keys.items(), key=lambda kv: kv[1][0], reverse=True)[:TOP_CONTENDED_KEYS]
+    return {
+        **_counters,
+        "backend": "file" if _use_file_backend() else "local",
+        "held": _held,
+        "waiting": sum(entry[1] for entry in _local.values()) - _held,
+        "wait_total_ms": round(_wait_total_s * 1000, 2),
+        "wait_max_ms": round(_wait_max_s * 1000, 2),
+        "top_contended": [
+            {"key": key, "contended": n, "wait_ms": round(wait_s * 1000, 2)} for key, (n, wait_s) in top
+        ],
+    }
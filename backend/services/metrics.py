@@ -0,0 +1,261 @@
+"""
+services/metrics.py
+
+Prometheus-style runtime metrics, served as text by GET /metrics.
+
+Counters and histograms are sharded per thread. Each thread only ever
+writes to its own shard, so recording a value never takes a lock or makes
+threads wait on each other (the event loop thread and the to_thread pool
+workers each have one shard). A scrape adds the shards together. Reading
+a shard while its thread is updating it may miss that one update, which is
+fine for metrics.
+
+Gauges are callbacks evaluated at scrape time, so queue depths and similar
+numbers come straight from the owning module's existing stats
+(registered in routes/metrics.py).
+
+What is recorded:
+    alma_http_requests_total / alma_http_request_duration_seconds
+        per method, route template and status (middleware in main.py)
+    alma_upstream_request_duration_seconds / alma_upstream_errors_total
+        per upstream and operation, from stripe.* / truelayer.* / twilio.* /
+        gemini.* tracing spans (services/tracing.py)
+    alma_storage_operation_duration_seconds
+        per store and operation (@storage_timer)
+"""
+
+from __future__ import annotations
+
+import bisect
+import functools
+import threading
+import time
+from typing import Callable, Iterable
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STORAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+UPSTREAMS = {"stripe", "truelayer", "twilio", "gemini"}
+
+_registry: list = []
+_registry_lock = threading.Lock()   # only for registering metrics and shards
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Sharded:
+    """Base for metrics whose values live in one dict per writing thread."""
+
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._shards: list[dict] = []
+        self._local = threading.local()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with _registry_lock:
+                self._shards.append(shard)
+        return shard
+
+    def _snapshot(self) -> list[dict]:
+        # dict() of a shard is a single C-level copy, so it can't see a half-resized dict
+        with _registry_lock:
+            shards = list(self._shards)
+        return [dict(shard) for shard in shards]
+
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        shard = self._shard()
+        shard[label_values] = shard.get(label_values, 0) + amount
+
+    def values(self) -> dict[tuple, float]:
+        totals: dict[tuple, float] = {}
+        for shard in self._snapshot():
+            for key, value in shard.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in sorted(self.values().items())]
+
+
+class Histogram(_Sharded):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values: str) -> None:
+        shard = self._shard()
+        state = shard.get(label_values)
+        if state is None:
+            # [per-bucket counts (non-cumulative, last is +Inf), sum, count]
+            state = shard[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1   # first bucket with value <= le
+        state[1] += value
+        state[2] += 1
+
+    def time(self, *label_values: str) -> "_Timer":
+        """Context manager observing the enclosed block's duration in seconds."""
+        return _Timer(self, label_values)
+
+    def values(self) -> dict[tuple, list]:
+        totals: dict[tuple, list] = {}
+        for shard in self._snapshot():
+            for key, (counts, total, count) in shard.items():
+                merged = totals.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+                for i, c in enumerate(counts):
+                    merged[0][i] += c
+                merged[1] += total
+                merged[2] += count
+        return totals
+
+    def render(self) -> list[str]:
+        lines = []
+        for key, (counts, total, count) in sorted(self.values().items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = f'le="{_format_value(bound) if bound != float("inf") else "+Inf"}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "label_values", "started")
+
+    def __init__(self, histogram: Histogram, label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self) -> "_Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+class Gauge:
+    """
+    A value read from a callback at scrape time. kind="counter" exposes a
+    total another module already keeps (e.g. its _counters) as a counter.
+    """
+
+    def __init__(self, name: str, help: str, labels: Iterable[str], read: Callable[[], dict[tuple, float]],
+                 kind: str = "gauge"):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.read = read
+        with _registry_lock:
+            _registry.append(self)
+
+    def render(self) -> list[str]:
+        try:
+            values = self.read()
+        except Exception as e:
+            print(f"⚠️ Metrics gauge {self.name} failed: {e}")
+            return []
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in sorted(values.items())]
+
+
+def gauge(name: str, help: str, read: Callable[[], float | dict[tuple, float]], labels: Iterable[str] = (),
+          kind: str = "gauge") -> Gauge:
+    """Registers a gauge. read() returns a number, or {label values: number} for labelled gauges."""
+    labels = tuple(labels)
+    if labels:
+        return Gauge(name, help, labels, read, kind)
+    return Gauge(name, help, (), lambda: {(): read()}, kind)
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Built-in metrics ---
+
+HTTP_REQUESTS = Counter(
+    "alma_http_requests_total", "HTTP requests by route template and status.", ("method", "route", "status")
+)
+HTTP_DURATION = Histogram(
+    "alma_http_request_duration_seconds", "Time to response headers, by route template.", ("method", "route")
+)
+UPSTREAM_DURATION = Histogram(
+    "alma_upstream_request_duration_seconds", "Upstream call latency.", ("upstream", "operation")
+)
+UPSTREAM_ERRORS = Counter(
+    "alma_upstream_errors_total", "Upstream calls that raised.", ("upstream", "operation")
+)
+STORAGE_DURATION = Histogram(
+    "alma_storage_operation_duration_seconds", "CSV/JSONL storage operation latency.",
+    ("store", "operation"), buckets=STORAGE_BUCKETS,
+)
+
+
+def observe_request(method: str, route: str, status: int, duration_s: float) -> None:
+    HTTP_REQUESTS.inc(method, route, str(status))
+    HTTP_DURATION.observe(duration_s, method, route)
+
+
+def observe_span(name: str, duration_s: float, failed: bool) -> None:
+    """Called by services/tracing.py for every finished span; records upstream calls."""
+    upstream = name.split(".", 1)[0]
+    if upstream not in UPSTREAMS:
+        return
+    UPSTREAM_DURATION.observe(duration_s, upstream, name)
+    if failed:
+        UPSTREAM_ERRORS.inc(upstream, name)
+
+
+def storage_timer(store: str) -> Callable:
+    """Decorator recording a storage function's latency under its own name."""
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                STORAGE_DURATION.observe(time.perf_counter() - started, store, fn.__name__)
+        return wrapper
+    return decorator
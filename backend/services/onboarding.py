@@ -0,0 +1,202 @@
+"""
+services/onboarding.py
+
+Signup pipeline shared by single and bulk onboarding.
+
+The Stripe customer and the Issuing cardholder do not depend on each other,
+so both blocking Stripe calls run side by side on a dedicated thread pool
+instead of back to back on the event loop. If either fails, the one that
+was created is removed (customer deleted, cardholder deactivated) so no
+orphan is left behind. Users are persisted with a single append to
+users_data.csv rather than a full-file rewrite per signup; emails already
+registered are rejected before anything is created in Stripe. A user whose
+write fails anyway (e.g. another request registered the email meanwhile)
+has both Stripe objects cleaned up the same way.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from services.issuing import create_issuing_cardholder, deactivate_issuing_cardholder
+from services.stripe import create_stripe_customer, delete_stripe_customer
+from services import user_storage
+
+ONBOARDING_MAX_WORKERS = int(os.getenv("ONBOARDING_MAX_WORKERS", 8))
+BULK_ONBOARDING_CONCURRENCY = int(os.getenv("BULK_ONBOARDING_CONCURRENCY", 4))
+BULK_ONBOARDING_MAX_USERS = int(os.getenv("BULK_ONBOARDING_MAX_USERS", 200))
+
+# Mock cardholder details for testing (Issuing requires a phone + address)
+DEFAULT_CARDHOLDER_PHONE = "+353871234567"
+DEFAULT_CARDHOLDER_ADDRESS = {
+    "line1": "123 Test Street",
+    "city": "Dublin",
+    "postal_code": "D01 1AA",
+}
+
+_executor = ThreadPoolExecutor(
+    max_workers=ONBOARDING_MAX_WORKERS,
+    thread_name_prefix="onboarding",
+)
+
+
+async def run_blocking(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Runs a blocking call (Stripe SDK, hashing, CSV I/O) on the onboarding pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def provision_user(
+    name: str,
+    email: str,
+    password_hash: str = "",
+    overseer_name: str = "",
+    overseer_number: str = "",
+    overseer_password_hash: str = "",
+) -> dict:
+    """
+    Creates the Stripe customer and Issuing cardholder concurrently.
+    Returns the user row ready to persist; nothing is written to disk here.
+    If either call fails, the other's object is cleaned up and the error re-raised.
+    """
+    customer_id, cardholder = await asyncio.gather(
+        run_blocking(create_stripe_customer, name, email),
+        run_blocking(
+            create_issuing_cardholder,
+            name=name,
+            email=email,
+            phone=DEFAULT_CARDHOLDER_PHONE,
+            address=DEFAULT_CARDHOLDER_ADDRESS,
+        ),
+        return_exceptions=True,
+    )
+    if isinstance(customer_id, BaseException) or isinstance(cardholder, BaseException):
+        await _discard_partial(customer_id, cardholder)
+        raise customer_id if isinstance(customer_id, BaseException) else cardholder
+    print(f"DEBUG: Customer created: {customer_id}")
+    print(f"DEBUG: Cardholder created: {cardholder}")
+
+    return {
+        "user_id": customer_id,  # use stripe customer ID as the user_id
+        "name": name,
+        "email": email,
+        "stripe_customer_id": customer_id,
+        "cardholder_id": cardholder["cardholder_id"],
+        "password_hash": password_hash,
+        "overseer_name": overseer_name,
+        "overseer_number": overseer_number,
+        "overseer_password_hash": overseer_password_hash,
+    }
+
+
+async def _discard_partial(customer_id, cardholder) -> None:
+    """Removes whichever Stripe object a half-failed provision_user created."""
+    if not isinstance(customer_id, BaseException):
+        try:
+            await run_blocking(delete_stripe_customer, customer_id)
+        except Exception as e:
+            print(f"❌ Could not delete orphaned customer {customer_id}: {e}")
+    if not isinstance(cardholder, BaseException):
+        try:
+            await run_blocking(deactivate_issuing_cardholder, cardholder["cardholder_id"])
+        except Exception as e:
+            print(f"❌ Could not deactivate orphaned cardholder {cardholder['cardholder_id']}: {e}")
+
+
+async def _discard_user(user: dict) -> None:
+    """Removes the Stripe objects of a provisioned user that could not be saved."""
+    await _discard_partial(user["stripe_customer_id"], {"cardholder_id": user["cardholder_id"]})
+
+
+async def persist_users(users: list[dict]) -> list[dict]:
+    """Writes provisioned users with one append, off the event loop."""
+    if not users:
+        return []
+    return await run_blocking(user_storage.append_users, users)
+
+
+async def onboard_user(**fields) -> dict:
+    """
+    Provisions and persists a single user. Accepts provision_user's arguments.
+
+    Raises:
+        ValueError: if the email is already registered
+    """
+    if await run_blocking(user_storage.get_user_by_email, fields["email"]):
+        raise ValueError(f"Email already registered: {fields['email']}")
+    user = await provision_user(**fields)
+    try:
+        await persist_users([user])
+    except Exception:
+        await _discard_user(user)
+        raise
+    return user
+
+
+def _duplicate_entries(entries: list[dict]) -> set[int]:
+    """Indexes of entries whose email is already registered or used by an earlier entry. Blocking."""
+    seen: set[str] = set()
+    duplicates: set[int] = set()
+    for index, entry in enumerate(entries):
+        email = (entry.get("email") or "").lower()
+        if email and (email in seen or user_storage.get_user_by_email(email)):
+            duplicates.add(index)
+        seen.add(email)
+    return duplicates
+
+
+async def bulk_onboard(
+    entries: list[dict],
+    prepare: Callable[[dict], dict],
+    concurrency: int | None = None,
+) -> list[dict]:
+    """
+    Onboards many users for a care organisation.
+
+    At most `concurrency` users (capped at BULK_ONBOARDING_CONCURRENCY) are
+    provisioned at once so a large batch doesn't trip Stripe's rate limits.
+    Entries whose email is already registered, or repeats an earlier entry,
+    fail without calling Stripe. `prepare` turns a request entry into
+    provision_user keyword arguments (e.g. hashing passwords) and runs on the
+    thread pool. Successful users are persisted together in a single write;
+    if that write fails, each is retried on its own and the ones that still
+    fail are reported as failed, with their Stripe objects cleaned up.
+
+    Returns one result per entry, in input order:
+        {"index", "email", "success", "user" | "error"}
+    """
+    limit = max(1, min(concurrency or BULK_ONBOARDING_CONCURRENCY, BULK_ONBOARDING_CONCURRENCY))
+    semaphore = asyncio.Semaphore(limit)
+
+    duplicates = await run_blocking(_duplicate_entries, entries)
+
+    async def _one(index: int, entry: dict) -> dict:
+        if index in duplicates:
+            return {"index": index, "email": entry.get("email"), "success": False,
+                    "error": f"Email already registered: {entry.get('email')}"}
+        async with semaphore:
+            try:
+                fields = await run_blocking(prepare, entry)
+                user = await provision_user(**fields)
+                return {"index": index, "email": entry.get("email"), "success": True, "user": user}
+            except Exception as e:
+                print(f"DEBUG: Bulk onboarding failed for {entry.get('email')}: {str(e)}")
+                return {"index": index, "email": entry.get("email"), "success": False, "error": str(e)}
+
+    results = list(await asyncio.gather(*(_one(i, entry) for i, entry in enumerate(entries))))
+    created = [r for r in results if r["success"]]
+    try:
+        await persist_users([r["user"] for r in created])
+    except Exception as e:
+        print(f"DEBUG: Bulk onboarding write failed, saving users one by one: {str(e)}")
+        for result in created:
+            try:
+                await persist_users([result["user"]])
+            except Exception as e:
+                await _discard_user(result.pop("user"))
+                result.update(success=False, error=str(e))
+    return results
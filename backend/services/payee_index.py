@@ -0,0 +1,172 @@
+"""
+services/payee_index.py
+
+Fuzzy payee lookup for speech transcripts.
+
+Speech-to-text rarely produces a payee label verbatim ("Dunnes" for
+"Dunnes Stores", "Marie" for "Mary", "Tescos"). PayeeIndex is built once
+over each payee's label and aliases and keeps two inverted indexes:
+
+  - character trigrams of the normalised name, for spelling variation
+  - a Soundex-style phonetic code per word, for names that sound alike
+
+A query only scores the MAX_CANDIDATES entries sharing the most trigrams
+and phonetic codes with it, and the score is the mean of trigram similarity (Dice) and the fraction of
+spoken words whose sound matches a word in the name. resolve() accepts the
+top match only when it clears PAYEE_MATCH_THRESHOLD and beats the runner-up
+by PAYEE_MATCH_MARGIN, so ambiguous speech still goes back to the user.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass
+
+PAYEE_MATCH_THRESHOLD = float(os.getenv("PAYEE_MATCH_THRESHOLD", 0.75))
+PAYEE_MATCH_MARGIN = float(os.getenv("PAYEE_MATCH_MARGIN", 0.1))
+MAX_CANDIDATES = 32
+
+_NON_WORD_RE = re.compile(r"[^a-z0-9 ]+")
+_LEADING_ARTICLE_RE = re.compile(r"^(?:the|my|to)\s+")
+
+_SOUNDEX_CODES = {
+    **dict.fromkeys("bfpv", "1"),
+    **dict.fromkeys("cgjkqsxz", "2"),
+    **dict.fromkeys("dt", "3"),
+    "l": "4",
+    **dict.fromkeys("mn", "5"),
+    "r": "6",
+}
+_INITIAL_REWRITES = (("ph", "f"), ("kn", "n"), ("wr", "r"), ("wh", "w"))
+
+
+@dataclass
+class PayeeMatch:
+    label: str
+    score: float
+    matched: str     # the label or alias the score came from
+
+
+def normalise_name(text: str) -> str:
+    """Lower-cases, drops apostrophes/punctuation and a leading article."""
+    text = text.lower().replace("'", "")
+    text = _NON_WORD_RE.sub(" ", text)
+    text = " ".join(text.split())
+    return _LEADING_ARTICLE_RE.sub("", text)
+
+
+def _trigrams(name: str) -> set[str]:
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def phonetic_code(word: str) -> str:
+    """
+    Soundex with a few English spelling rewrites, ignoring a trailing plural
+    or possessive "s" so "Dunnes", "Dunne's" and "Dunne" share a code.
+    """
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        word = word[:-1]
+    for prefix, replacement in _INITIAL_REWRITES:
+        if word.startswith(prefix):
+            word = replacement + word[len(prefix):]
+            break
+    if not word:
+        return ""
+
+    code = word[0]
+    last = _SOUNDEX_CODES.get(word[0], "")
+    for ch in word[1:]:
+        digit = _SOUNDEX_CODES.get(ch, "")
+        if digit and digit != last:
+            code += digit
+        if ch not in "hw":
+            last = digit
+    return (code + "000")[:4]
+
+
+def _phonetic_codes(name: str) -> list[str]:
+    return [phonetic_code(w) for w in name.split() if w]
+
+
+def _dice(a: set[str], b: set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+class PayeeIndex:
+    """Trigram + phonetic index over payee labels and their aliases."""
+
+    def __init__(self, payees: list[dict]) -> None:
+        # One entry per label/alias: (payee label, name as written, normalised, trigrams, codes)
+        self._entries: list[tuple[str, str, str, set[str], set[str]]] = []
+        self._exact: dict[str, tuple[str, str]] = {}   # normalised name -> (label, name)
+        self._by_trigram: dict[str, set[int]] = {}
+        self._by_code: dict[str, set[int]] = {}
+
+        for payee in payees:
+            label = payee["label"]
+            for name in [label, *(payee.get("aliases") or [])]:
+                norm = normalise_name(name)
+                if not norm:
+                    continue
+                self._exact.setdefault(norm, (label, name))
+                entry_id = len(self._entries)
+                grams = _trigrams(norm)
+                codes = set(_phonetic_codes(norm))
+                self._entries.append((label, name, norm, grams, codes))
+                for gram in grams:
+                    self._by_trigram.setdefault(gram, set()).add(entry_id)
+                for code in codes:
+                    self._by_code.setdefault(code, set()).add(entry_id)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def exact(self, spoken: str) -> str | None:
+        """Label whose name or alias equals the spoken text after normalising."""
+        hit = self._exact.get(normalise_name(spoken))
+        return hit[0] if hit else None
+
+    def match(self, spoken: str, limit: int = 3) -> list[PayeeMatch]:
+        """Ranked matches for spoken text, best first, at most one per payee."""
+        norm = normalise_name(spoken)
+        if not norm:
+            return []
+        hit = self._exact.get(norm)
+        if hit is not None:
+            return [PayeeMatch(label=hit[0], score=1.0, matched=hit[1])]
+
+        grams = _trigrams(norm)
+        codes = _phonetic_codes(norm)
+        # Only the entries sharing the most trigrams/sounds are scored, so common
+        # fragments ("sho" in a hundred "Shop ..." payees) don't cost a full scan
+        shared: Counter[int] = Counter()
+        for gram in grams:
+            shared.update(self._by_trigram.get(gram, ()))
+        for code in codes:
+            for entry_id in self._by_code.get(code, ()):
+                shared[entry_id] += 3
+        candidates = [entry_id for entry_id, _ in shared.most_common(MAX_CANDIDATES)]
+
+        best: dict[str, PayeeMatch] = {}
+        for entry_id in candidates:
+            label, name, _, entry_grams, entry_codes = self._entries[entry_id]
+            sound = sum(1 for c in codes if c in entry_codes) / len(codes) if codes else 0.0
+            score = round((_dice(grams, entry_grams) + sound) / 2, 3)
+            if label not in best or score > best[label].score:
+                best[label] = PayeeMatch(label=label, score=score, matched=name)
+
+        return sorted(best.values(), key=lambda m: m.score, reverse=True)[:limit]
+
+    def resolve(self, spoken: str) -> PayeeMatch | None:
+        """The top match if it is confident and clearly ahead of the runner-up."""
+        matches = self.match(spoken, limit=2)
+        if not matches or matches[0].score < PAYEE_MATCH_THRESHOLD:
+            return None
+        if len(matches) > 1 and matches[0].score - matches[1].score < PAYEE_MATCH_MARGIN:
+            return None
+        return matches[0]
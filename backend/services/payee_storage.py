@@ -0,0 +1,377 @@
+"""
+services/payee_storage.py
+
+Per-user payee registry persisted to CSV.
+
+Each row is one payee belonging to one user. The whole file is read once
+into memory, keyed by user_id and then by normalised label, so lookups on
+a chat turn are dict hits rather than file scans. Each user's derived view
+(label list, fuzzy PayeeIndex) is built on first use and dropped whenever
+that user's payees are written.
+
+Users who have never edited their payees see DEFAULT_PAYEES. Their first
+write copies the defaults into their own rows, so adding one payee doesn't
+hide the rest, and records a marker row (type "seeded") so a user who later
+deletes every payee keeps an empty list rather than getting the defaults
+back. Updating or deleting a label the user doesn't have writes nothing.
+
+A person payee's stripe_account must look like a Connect account ID
+(acct_...); routes/payees.py also checks it belongs to this platform.
+
+Other uvicorn workers write the same CSV, so every call re-reads it when
+its (mtime, size, inode) changed. Writes hold an fcntl lock on
+PAYEES_CSV + ".lock" and refresh first, so an update or delete never
+rewrites the file from a stale copy and drops another worker's payees.
+"""
+
+from __future__ import annotations
+
+import csv
+import os
+import re
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:   # Windows: single worker only
+    fcntl = None
+
+from services.payee_index import PayeeIndex, PayeeMatch, normalise_name
+
+PAYEES_CSV = "payees_data.csv"
+CSV_HEADERS = [
+    "payee_id",
+    "user_id",
+    "label",
+    "normalised_label",
+    "type",
+    "stripe_account",
+    "aliases",
+    "created_at",
+    "updated_at",
+]
+PAYEE_TYPES = {"merchant", "person"}
+SEEDED_MARKER = "seeded"   # type of the per-user marker row; never shown as a payee
+STRIPE_ACCOUNT_RE = re.compile(r"^acct_[A-Za-z0-9]{8,}$")
+PAYEES_MAX_PER_USER = int(os.getenv("PAYEES_MAX_PER_USER", 500))
+ALIAS_SEPARATOR = "|"
+
+# Set real Stripe Connect account IDs via STRIPE_CONNECT_MARY / STRIPE_CONNECT_JOHN for person-to-person
+DEFAULT_PAYEES: List[Dict] = [
+    {"label": "Tesco",           "type": "merchant", "stripe_account": None},
+    {"label": "Lidl",            "type": "merchant", "stripe_account": None},
+    {"label": "Dunnes Stores",   "type": "merchant", "stripe_account": None, "aliases": ["Dunnes"]},
+    {"label": "Boots",           "type": "merchant", "stripe_account": None},
+    {"label": "Pharmacy",        "type": "merchant", "stripe_account": None, "aliases": ["chemist"]},
+    {"label": "Electric Ireland","type": "merchant", "stripe_account": None, "aliases": ["electricity", "electric bill"]},
+    {"label": "Irish Water",     "type": "merchant", "stripe_account": None, "aliases": ["water bill"]},
+    {"label": "Mary", "type": "person", "stripe_account": os.getenv("STRIPE_CONNECT_MARY", "")},
+    {"label": "John", "type": "person", "stripe_account": os.getenv("STRIPE_CONNECT_JOHN", "")},
+]
+
+
+class _PayeeView:
+    """Read-optimised view of one user's payees."""
+
+    def __init__(self, payees: List[Dict]) -> None:
+        self.payees = payees
+        self.by_label = {normalise_name(p["label"]): p for p in payees}
+        self.labels = [p["label"] for p in payees]
+        self.index = PayeeIndex(payees)
+
+
+_rows: Optional[Dict[str, Dict[str, Dict]]] = None   # user_id -> normalised label -> CSV row
+_csv_stamp = None                                   # (mtime_ns, size, inode) of the CSV _rows reflects
+_views: Dict[str, _PayeeView] = {}
+_default_view: Optional[_PayeeView] = None
+_lock = threading.RLock()
+_flock_depth = 0
+
+
+def _ensure_csv_exists():
+    """Create CSV file if it doesn't exist."""
+    if not os.path.exists(PAYEES_CSV):
+        with open(PAYEES_CSV, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
+            writer.writeheader()
+
+
+def _stamp():
+    try:
+        stat = os.stat(PAYEES_CSV)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+@contextmanager
+def _file_lock() -> Iterator[None]:
+    """Cross-process lock for reloads and writes. Re-entrant; caller holds _lock."""
+    global _flock_depth
+    if fcntl is None or _flock_depth:
+        _flock_depth += 1
+        try:
+            yield
+        finally:
+            _flock_depth -= 1
+        return
+    fd = os.open(PAYEES_CSV + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    _flock_depth = 1
+    try:
+        yield
+    finally:
+        _flock_depth = 0
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _load() -> Dict[str, Dict[str, Dict]]:
+    """
+    Returns the rows, re-reading the CSV if another worker (or nobody yet)
+    has written it since the last read. Caller holds _lock.
+    """
+    global _rows, _csv_stamp
+    if _rows is not None and _stamp() == _csv_stamp:
+        return _rows
+    with _file_lock():
+        _ensure_csv_exists()
+        rows: Dict[str, Dict[str, Dict]] = {}
+        with open(PAYEES_CSV, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                user_rows = rows.setdefault(row["user_id"], {})
+                if row["type"] != SEEDED_MARKER:
+                    user_rows[row["normalised_label"]] = row
+        _rows = rows
+        _csv_stamp = _stamp()
+        _views.clear()
+    return _rows
+
+
+def _rewrite() -> None:
+    """Writes every row back to CSV. Caller holds _lock and the file lock, with _rows loaded."""
+    global _csv_stamp
+    tmp_path = f"{PAYEES_CSV}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
+        writer.writeheader()
+        for user_id, user_rows in _rows.items():
+            writer.writerow(_marker_row(user_id))
+            writer.writerows(user_rows.values())
+    os.replace(tmp_path, PAYEES_CSV)   # atomic, so other workers never read a half-written file
+    _csv_stamp = _stamp()
+
+
+def _append(rows: List[Dict]) -> None:
+    """Appends rows to the CSV. Caller holds _lock and the file lock, with _rows loaded."""
+    global _csv_stamp
+    with open(PAYEES_CSV, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
+        writer.writerows(rows)
+    _csv_stamp = _stamp()
+
+
+def _to_payee(row: Dict) -> Dict:
+    return {
+        "payee_id": row["payee_id"],
+        "label": row["label"],
+        "type": row["type"],
+        "stripe_account": row["stripe_account"] or None,
+        "aliases": [a for a in row["aliases"].split(ALIAS_SEPARATOR) if a],
+    }
+
+
+def _make_row(user_id: str, label: str, payee_type: str, stripe_account: str, aliases: List[str]) -> Dict:
+    now = datetime.now().isoformat()
+    return {
+        "payee_id": f"payee_{uuid.uuid4().hex[:12]}",
+        "user_id": user_id,
+        "label": label.strip(),
+        "normalised_label": normalise_name(label),
+        "type": payee_type,
+        "stripe_account": stripe_account or "",
+        "aliases": ALIAS_SEPARATOR.join(a.strip() for a in aliases if a.strip()),
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def _marker_row(user_id: str) -> Dict:
+    return {header: "" for header in CSV_HEADERS} | {"user_id": user_id, "type": SEEDED_MARKER}
+
+
+def _user_rows_for_write(user_id: str) -> Dict[str, Dict]:
+    """
+    Returns the user's rows, seeding them from DEFAULT_PAYEES (plus the
+    marker row) on the first write. Caller holds _lock and the file lock.
+    """
+    rows = _load()
+    if user_id not in rows:
+        seeded = [
+            _make_row(user_id, p["label"], p["type"], p.get("stripe_account") or "", p.get("aliases") or [])
+            for p in DEFAULT_PAYEES
+        ]
+        _append([_marker_row(user_id)] + seeded)
+        rows[user_id] = {row["normalised_label"]: row for row in seeded}
+    return rows[user_id]
+
+
+def _has_label(user_id: str, key: str) -> bool:
+    """Whether the user's current payees (their own or the defaults) include key. Caller holds _lock."""
+    rows = _load()
+    if user_id in rows:
+        return key in rows[user_id]
+    return any(normalise_name(p["label"]) == key for p in DEFAULT_PAYEES)
+
+
+def _validate(label: str, payee_type: str, aliases: List[str], stripe_account: str = "") -> None:
+    if not normalise_name(label):
+        raise ValueError("Payee label is required")
+    if payee_type not in PAYEE_TYPES:
+        raise ValueError(f"Payee type must be one of: {', '.join(sorted(PAYEE_TYPES))}")
+    if any(ALIAS_SEPARATOR in a for a in aliases):
+        raise ValueError(f"Aliases may not contain '{ALIAS_SEPARATOR}'")
+    if stripe_account and not STRIPE_ACCOUNT_RE.match(stripe_account):
+        raise ValueError("Stripe account must be a Connect account ID (acct_...)")
+
+
+def _view(user_id: Optional[str]) -> _PayeeView:
+    global _default_view
+    with _lock:
+        rows = _load()
+        if not user_id or user_id not in rows:
+            if _default_view is None:
+                _default_view = _PayeeView([
+                    {**p, "aliases": p.get("aliases") or []} for p in DEFAULT_PAYEES
+                ])
+            return _default_view
+        view = _views.get(user_id)
+        if view is None:
+            view = _PayeeView([_to_payee(row) for row in rows[user_id].values()])
+            _views[user_id] = view
+        return view
+
+
+def list_payees(user_id: Optional[str]) -> List[Dict]:
+    """All payees for a user (DEFAULT_PAYEES for users without their own)."""
+    return list(_view(user_id).payees)
+
+
+def list_labels(user_id: Optional[str]) -> List[str]:
+    return list(_view(user_id).labels)
+
+
+def get_payee(user_id: Optional[str], label: str) -> Optional[Dict]:
+    """Exact lookup by label, ignoring case and punctuation."""
+    return _view(user_id).by_label.get(normalise_name(label))
+
+
+def resolve_payee(user_id: Optional[str], spoken: str) -> Optional[Dict]:
+    """Exact label match, else a confident fuzzy match on labels and aliases."""
+    view = _view(user_id)
+    payee = view.by_label.get(normalise_name(spoken))
+    if payee is not None:
+        return payee
+    match = view.index.resolve(spoken)
+    return view.by_label[normalise_name(match.label)] if match else None
+
+
+def match_payees(user_id: Optional[str], spoken: str, limit: int = 3) -> List[PayeeMatch]:
+    """Ranked fuzzy matches, best first."""
+    return _view(user_id).index.match(spoken, limit)
+
+
+def add_payee(
+    user_id: str,
+    label: str,
+    payee_type: str = "merchant",
+    stripe_account: str = "",
+    aliases: Optional[List[str]] = None,
+) -> Dict:
+    """
+    Adds a payee for a user.
+
+    Raises:
+        ValueError: if the label is invalid, already taken or the user is at PAYEES_MAX_PER_USER
+    """
+    aliases = aliases or []
+    _validate(label, payee_type, aliases, stripe_account)
+    with _lock, _file_lock():
+        user_rows = _user_rows_for_write(user_id)
+        key = normalise_name(label)
+        if key in user_rows:
+            raise ValueError(f"A payee called '{user_rows[key]['label']}' already exists")
+        if len(user_rows) >= PAYEES_MAX_PER_USER:
+            raise ValueError(f"Payee limit of {PAYEES_MAX_PER_USER} reached")
+        row = _make_row(user_id, label, payee_type, stripe_account, aliases)
+        _append([row])
+        user_rows[key] = row
+        _views.pop(user_id, None)
+    return _to_payee(row)
+
+
+def update_payee(
+    user_id: str,
+    label: str,
+    new_label: Optional[str] = None,
+    payee_type: Optional[str] = None,
+    stripe_account: Optional[str] = None,
+    aliases: Optional[List[str]] = None,
+) -> Optional[Dict]:
+    """
+    Updates a payee's fields; None leaves a field unchanged.
+
+    Returns:
+        dict: The updated payee, or None if the user has no payee with that label
+
+    Raises:
+        ValueError: if the new values are invalid or new_label is already taken
+    """
+    with _lock, _file_lock():
+        key = normalise_name(label)
+        if not _has_label(user_id, key):
+            return None
+        user_rows = _user_rows_for_write(user_id)
+        row = user_rows[key]
+
+        updated = dict(row)
+        if new_label is not None:
+            updated["label"] = new_label.strip()
+            updated["normalised_label"] = normalise_name(new_label)
+        if payee_type is not None:
+            updated["type"] = payee_type
+        if stripe_account is not None:
+            updated["stripe_account"] = stripe_account
+        if aliases is not None:
+            updated["aliases"] = ALIAS_SEPARATOR.join(a.strip() for a in aliases if a.strip())
+        _validate(updated["label"], updated["type"], aliases or [], stripe_account or "")
+        if updated["normalised_label"] != key and updated["normalised_label"] in user_rows:
+            raise ValueError(f"A payee called '{updated['label']}' already exists")
+        updated["updated_at"] = datetime.now().isoformat()
+
+        del user_rows[key]
+        user_rows[updated["normalised_label"]] = updated
+        _rewrite()
+        _views.pop(user_id, None)
+    return _to_payee(updated)
+
+
+def delete_payee(user_id: str, label: str) -> bool:
+    """
+    Deletes a payee.
+
+    Returns:
+        bool: True if the payee was deleted, False if not found
+    """
+    with _lock, _file_lock():
+        key = normalise_name(label)
+        if not _has_label(user_id, key):
+            return False
+        _user_rows_for_write(user_id).pop(key)
+        _rewrite()
+        _views.pop(user_id, None)
+    return True
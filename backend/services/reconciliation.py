@@ -0,0 +1,212 @@
+"""
+services/reconciliation.py
+
+Periodic catch-up for ledger rows whose payment webhook never arrived.
+
+Stripe webhooks normally move a transaction from PENDING to COMPLETED or
+FAILED. Every RECONCILE_INTERVAL_S this job takes the Stripe transactions
+still pending after RECONCILE_MIN_AGE_S and asks Stripe for them in
+batches: one PaymentIntent.list page covers up to 100 intents created
+since the oldest straggler, instead of one retrieve per row. Listing stops
+once every straggler has been seen or RECONCILE_MAX_PAGES is reached.
+
+Intents that are never confirmed stay requires_payment_method forever, so
+a row still pending after RECONCILE_MAX_AGE_S is expired: its intent is
+cancelled at Stripe (or, if Stripe no longer has it, the row is cancelled
+locally). Expired rows stop holding back the listing window. Old rows the
+listing didn't reach are retrieved one by one.
+
+Every uvicorn worker starts the job, but only the one holding an fcntl
+lock on RECONCILE_LOCK_PATH runs it; the others keep trying, so the job
+moves on when the owner exits. Without fcntl (Windows) only a single
+worker should run it.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:   # Windows: single worker only
+    fcntl = None
+
+import stripe
+
+from services import events, ids, tracing, transaction_storage
+from services.stripe import ledger_status
+
+RECONCILE_INTERVAL_S = float(os.getenv("RECONCILE_INTERVAL_S", 300))   # 0 disables the periodic job
+RECONCILE_MIN_AGE_S = float(os.getenv("RECONCILE_MIN_AGE_S", 900))     # leave fresh rows to the webhook
+RECONCILE_MAX_AGE_S = float(os.getenv("RECONCILE_MAX_AGE_S", 24 * 3600))   # 0 never expires stragglers
+RECONCILE_MAX_PAGES = int(os.getenv("RECONCILE_MAX_PAGES", 20))
+RECONCILE_LOCK_PATH = os.getenv("RECONCILE_LOCK_PATH", "reconcile.lock")
+STRIPE_LIST_PAGE_SIZE = 100
+
+_loop: asyncio.AbstractEventLoop | None = None
+_task: asyncio.Task | None = None
+_counters = {"runs": 0, "checked": 0, "updated": 0, "not_found": 0, "expired": 0, "pages": 0, "errors": 0}
+_last_run: dict | None = None
+_owner_fd = None     # held for the life of the process by the worker that runs the job
+
+
+def _owns_job() -> bool:
+    """True if this process runs the job; the first worker to lock RECONCILE_LOCK_PATH keeps it."""
+    global _owner_fd
+    if fcntl is None or _owner_fd is not None:
+        return True
+    fd = os.open(RECONCILE_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    _owner_fd = fd
+    return True
+
+
+def _reset_after_fork() -> None:
+    """A forked child competes for the job on its own."""
+    global _owner_fd
+    _owner_fd = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _settle(intent_id: str, status: str) -> None:
+    """Writes a final status for an intent's row and tells the overseer feed."""
+    transaction_id = transaction_storage.update_status_by_provider_id(intent_id, status, source="reconcile")
+    row = transaction_storage.get_transaction_by_provider_id(intent_id)
+    events.publish("payment.settled", row["user_id"], {
+        "transaction_id": transaction_id,
+        "payment_id": intent_id,
+        "amount": float(row["amount"] or 0),
+        "currency": row["currency"],
+        "status": row["status"],
+    })
+
+
+def _expire(intent_id: str) -> bool:
+    """
+    Cancels an abandoned intent at Stripe and settles its row. Returns False
+    if Stripe refused (e.g. it started processing meanwhile); the next run
+    sees its new status.
+    """
+    try:
+        with tracing.span("stripe.payment_intent_cancel"):
+            intent = stripe.PaymentIntent.cancel(intent_id, cancellation_reason="abandoned")
+    except stripe.error.InvalidRequestError as e:
+        if getattr(e, "code", None) != "resource_missing":
+            print(f"⚠️ Could not cancel stale PaymentIntent {intent_id}: {e}")
+            return False
+        _settle(intent_id, "CANCELLED")   # Stripe no longer has it
+        return True
+    _settle(intent_id, ledger_status(intent.status, bool(intent.last_payment_error)))
+    return True
+
+
+def reconcile_once(min_age_s: float = RECONCILE_MIN_AGE_S, max_age_s: float = RECONCILE_MAX_AGE_S) -> dict:
+    """
+    Settles pending Stripe transactions from PaymentIntent.list and expires
+    those older than max_age_s. Blocking; run it on a thread from async code.
+
+    Returns:
+        dict: {"checked", "updated", "not_found", "expired", "pages"} for this run
+    """
+    global _last_run
+    stragglers = transaction_storage.list_unsettled(older_than_s=min_age_s, provider_prefix="pi_")
+    result = {"checked": len(stragglers), "updated": 0, "not_found": 0, "expired": 0, "pages": 0}
+    if stragglers:
+        wanted = {row["provider_id"] for row in stragglers}
+        stale_before = time.time() - max_age_s if max_age_s > 0 else None
+        stale = {
+            row["provider_id"] for row in stragglers
+            if stale_before is not None and ids.timestamp(row["transaction_id"]) < stale_before
+        }
+        # Back off a minute for clock skew against Stripe's timestamp
+        created_gte = int(ids.timestamp(stragglers[0]["transaction_id"])) - 60
+
+        with tracing.span("reconcile.stripe", stragglers=len(wanted), stale=len(stale)):
+            starting_after = None
+            while wanted and result["pages"] < RECONCILE_MAX_PAGES:
+                params = {"created": {"gte": created_gte}, "limit": STRIPE_LIST_PAGE_SIZE}
+                if starting_after:
+                    params["starting_after"] = starting_after
+                with tracing.span("stripe.payment_intent_list"):
+                    page = stripe.PaymentIntent.list(**params)
+                result["pages"] += 1
+                for intent in page.data:
+                    if intent.id not in wanted:
+                        continue
+                    wanted.discard(intent.id)
+                    status = ledger_status(intent.status, bool(intent.last_payment_error))
+                    if status not in transaction_storage.PENDING_STATUSES:
+                        _settle(intent.id, status)
+                        result["updated"] += 1
+                    elif intent.id in stale and _expire(intent.id):
+                        result["expired"] += 1
+                if not page.has_more or not page.data:
+                    break
+                starting_after = page.data[-1].id
+
+            # Old rows beyond the pages listed: look them up one at a time
+            for intent_id in sorted(wanted & stale):
+                wanted.discard(intent_id)
+                try:
+                    with tracing.span("stripe.payment_intent_retrieve"):
+                        intent = stripe.PaymentIntent.retrieve(intent_id)
+                except stripe.error.InvalidRequestError:
+                    intent = None
+                status = ledger_status(intent.status, bool(intent.last_payment_error)) if intent else None
+                if status and status not in transaction_storage.PENDING_STATUSES:
+                    _settle(intent_id, status)
+                    result["updated"] += 1
+                elif _expire(intent_id):
+                    result["expired"] += 1
+        result["not_found"] = len(wanted)
+
+    _counters["runs"] += 1
+    for key in ("checked", "updated", "not_found", "expired", "pages"):
+        _counters[key] += result[key]
+    _last_run = result
+    if result["updated"] or result["not_found"] or result["expired"]:
+        print(f"🔄 Reconciled {result['updated']}/{result['checked']} pending Stripe payments "
+              f"({result['expired']} expired, {result['not_found']} not found, {result['pages']} pages)")
+    return result
+
+
+async def _reconcile_forever() -> None:
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL_S)
+        if not _owns_job():
+            continue
+        try:
+            await asyncio.to_thread(reconcile_once)
+        except Exception as e:
+            _counters["errors"] += 1
+            print(f"❌ Reconciliation failed: {e}")
+
+
+def start() -> None:
+    """Starts the periodic job on the running loop (app startup)."""
+    global _loop, _task
+    loop = asyncio.get_running_loop()
+    if RECONCILE_INTERVAL_S <= 0 or _loop is loop:
+        return
+    _loop = loop
+    _task = loop.create_task(_reconcile_forever(), name="ledger-reconciliation")
+
+
+def stop() -> None:
+    global _loop, _task
+    if _task is not None:
+        _task.cancel()
+    _loop = _task = None
+
+
+def metrics() -> dict:
+    return {**_counters, "last_run": _last_run, "owner": _owner_fd is not None or fcntl is None}
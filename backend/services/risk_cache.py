@@ -0,0 +1,124 @@
+"""
+services/risk_cache.py
+
+Bounded LRU cache of risk decisions keyed by PaymentIntent ID.
+
+get_radar_risk stores every decision that carries a Radar score here, so
+the payment_intent.succeeded webhook for an intent already scored on the
+create path skips another Radar round trip and pattern scan. Decisions
+made before the intent had a charge (local engine and description
+patterns only) are never cached: the webhook must still ask Radar about
+the real charge.
+
+Set RISK_CACHE_DIR to also keep each decision as a small JSON file, so a
+webhook delivered to a different uvicorn worker still gets a hit.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+RISK_CACHE_SIZE = int(os.getenv("RISK_CACHE_SIZE", 1024))
+RISK_CACHE_TTL_S = int(os.getenv("RISK_CACHE_TTL_S", 24 * 3600))
+RISK_CACHE_DIR = os.getenv("RISK_CACHE_DIR", "")
+
+_SAFE_KEY_RE = re.compile(r"[^A-Za-z0-9_\-]")
+
+_entries: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+_lock = threading.Lock()
+_stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+
+def _disk_path(intent_id: str) -> str:
+    return os.path.join(RISK_CACHE_DIR, _SAFE_KEY_RE.sub("_", intent_id) + ".json")
+
+
+def _read_disk(intent_id: str) -> tuple[float, dict] | None:
+    path = _disk_path(intent_id)
+    try:
+        with open(path, "r") as f:
+            record = json.load(f)
+        cached_at, decision = record["cached_at"], record["decision"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None   # missing or malformed: a miss
+    if time.time() - cached_at > RISK_CACHE_TTL_S:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    return cached_at, decision
+
+
+def _write_disk(intent_id: str, cached_at: float, decision: dict) -> None:
+    os.makedirs(RISK_CACHE_DIR, exist_ok=True)
+    path = _disk_path(intent_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"cached_at": cached_at, "decision": decision}, f)
+    os.replace(tmp_path, path)  # atomic, so other workers never read a half-written file
+
+
+def _store(intent_id: str, cached_at: float, decision: dict) -> None:
+    """Inserts into the in-memory tier. Caller holds _lock."""
+    _entries[intent_id] = (cached_at, decision)
+    _entries.move_to_end(intent_id)
+    while len(_entries) > RISK_CACHE_SIZE:
+        _entries.popitem(last=False)
+        _stats["evictions"] += 1
+
+
+def get(intent_id: str) -> dict | None:
+    """Returns the cached risk decision for a PaymentIntent, or None."""
+    if not intent_id:
+        return None
+
+    with _lock:
+        entry = _entries.get(intent_id)
+        if entry is not None:
+            if time.time() - entry[0] <= RISK_CACHE_TTL_S:
+                _entries.move_to_end(intent_id)
+                _stats["hits"] += 1
+                return entry[1]
+            del _entries[intent_id]
+
+    if RISK_CACHE_DIR:
+        entry = _read_disk(intent_id)
+        if entry is not None:
+            with _lock:
+                _store(intent_id, *entry)
+                _stats["disk_hits"] += 1
+            return entry[1]
+
+    with _lock:
+        _stats["misses"] += 1
+    return None
+
+
+def put(intent_id: str, decision: dict) -> None:
+    """Caches a PaymentIntent's risk decision in memory and, if configured, on disk."""
+    if not intent_id or decision is None:
+        return
+    cached_at = time.time()
+    with _lock:
+        _store(intent_id, cached_at, decision)
+    if RISK_CACHE_DIR:
+        try:
+            _write_disk(intent_id, cached_at, decision)
+        except OSError as e:
+            print(f"⚠️ Risk cache disk write failed for {intent_id}: {e}")
+
+
+def stats() -> dict:
+    with _lock:
+        return {**_stats, "size": len(_entries), "max_size": RISK_CACHE_SIZE, "disk": bool(RISK_CACHE_DIR)}
+
+
+def clear() -> None:
+    with _lock:
+        _entries.clear()
@@ -0,0 +1,196 @@
+"""
+services/risk_engine.py
+
+Local velocity and amount-anomaly scoring that runs before any Stripe call.
+
+Each user gets a small fixed-size ring buffer of recent payment amounts and
+timestamps (NumPy float64 arrays) plus the set of payees they've paid before.
+Scoring a payment is a handful of vectorised operations over at most
+HISTORY_SIZE values, so it costs microseconds and obvious scams can be
+flagged without waiting on Radar.
+
+Histories are rebuilt from the last RISK_SEED_DAYS of PAYMENT rows in
+transaction_storage the first time they're needed, so a restart doesn't
+reset every user to "no history". Rows are keyed like the live calls: the
+paying Stripe customer (from_account_id) and the payee (to_account_id).
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+
+import numpy as np
+
+from services import ids, transaction_storage
+
+HISTORY_SIZE = int(os.getenv("RISK_HISTORY_SIZE", 64))
+MIN_HISTORY = 5                 # payments needed before z-score / new-payee features count
+VELOCITY_WINDOW_S = 3600        # look-back window for velocity, in seconds
+VELOCITY_ELEVATED = 3           # payments in the window before it looks unusual
+VELOCITY_HIGHEST = 5            # payments in the window before it looks like a scam burst
+ZSCORE_ELEVATED = 2.5
+ZSCORE_HIGHEST = 4.0
+NIGHT_HOURS = range(0, 6)       # 00:00–05:59 local time
+RISK_SEED_DAYS = float(os.getenv("RISK_SEED_DAYS", 30))
+
+# Local score thresholds (0–100), aligned with the Radar thresholds in services/stripe.py
+LOCAL_SCORE_ELEVATED = 50
+LOCAL_SCORE_HIGHEST = 75
+
+
+class _UserHistory:
+    __slots__ = ("amounts", "timestamps", "count", "head", "payees")
+
+    def __init__(self) -> None:
+        self.amounts = np.zeros(HISTORY_SIZE, dtype=np.float64)
+        self.timestamps = np.zeros(HISTORY_SIZE, dtype=np.float64)
+        self.count = 0      # number of valid slots (<= HISTORY_SIZE)
+        self.head = 0       # next slot to overwrite
+        self.payees: set[str] = set()
+
+    def push(self, amount: float, ts: float, payee: str | None) -> None:
+        self.amounts[self.head] = amount
+        self.timestamps[self.head] = ts
+        self.head = (self.head + 1) % HISTORY_SIZE
+        self.count = min(self.count + 1, HISTORY_SIZE)
+        if payee:
+            self.payees.add(payee)
+
+
+_histories: dict[str, _UserHistory] = {}
+_lock = threading.Lock()
+_seeded = False
+
+
+def _normalise_payee(payee: str | None) -> str | None:
+    return payee.strip().lower() if payee else None
+
+
+def _seed() -> None:
+    """Rebuilds histories from the payments ledger on first use. Caller holds _lock."""
+    global _seeded
+    if _seeded:
+        return
+    _seeded = True
+    try:
+        payments = transaction_storage.list_payments(ids.floor_id("txn", time.time() - RISK_SEED_DAYS * 86400))
+    except Exception as e:
+        print(f"⚠️ Risk history not seeded from transactions: {e}")
+        return
+    for row in payments:
+        try:
+            amount = float(row["amount"])
+            ts = ids.timestamp(row["transaction_id"])
+        except ValueError:
+            continue
+        if not row["from_account_id"]:
+            continue
+        history = _histories.get(row["from_account_id"])
+        if history is None:
+            history = _histories[row["from_account_id"]] = _UserHistory()
+        history.push(amount, ts, _normalise_payee(row["to_account_id"]))
+
+
+def assess_payment(user_id: str, amount: float, payee: str = None, now: float = None) -> dict:
+    """
+    Scores a proposed payment against the user's recent history.
+
+    Returns:
+        dict with risk_level ("normal" | "elevated" | "highest"), a 0–100
+        score, human-readable reasons and the raw features.
+    """
+    now = time.time() if now is None else now
+    payee_key = _normalise_payee(payee)
+
+    with _lock:
+        _seed()
+        history = _histories.get(user_id)
+        if history is None or history.count == 0:
+            amounts = np.empty(0, dtype=np.float64)
+            timestamps = np.empty(0, dtype=np.float64)
+            known_payee = False
+        else:
+            amounts = history.amounts[:history.count].copy()
+            timestamps = history.timestamps[:history.count].copy()
+            known_payee = payee_key in history.payees
+
+    in_window = timestamps >= now - VELOCITY_WINDOW_S
+    velocity = int(np.count_nonzero(in_window))
+    window_total = float(amounts[in_window].sum()) if velocity else 0.0
+
+    zscore = 0.0
+    if amounts.size >= MIN_HISTORY:
+        mean = float(amounts.mean())
+        # Floor the spread so a user who always pays the same amount isn't flagged for cents
+        std = max(float(amounts.std()), 0.1 * mean, 1.0)
+        zscore = (amount - mean) / std
+
+    new_payee = bool(payee_key) and amounts.size >= MIN_HISTORY and not known_payee
+    night = time.localtime(now).tm_hour in NIGHT_HOURS
+
+    score = 0
+    reasons = []
+    if velocity + 1 >= VELOCITY_HIGHEST:
+        score += 40
+        reasons.append(f"{velocity + 1} payments in the last hour")
+    elif velocity + 1 >= VELOCITY_ELEVATED:
+        score += 20
+        reasons.append(f"{velocity + 1} payments in the last hour")
+    if zscore >= ZSCORE_HIGHEST:
+        score += 45
+        reasons.append("a much larger amount than usual")
+    elif zscore >= ZSCORE_ELEVATED:
+        score += 25
+        reasons.append("a larger amount than usual")
+    if new_payee:
+        score += 15
+        reasons.append("a payee you haven't paid before")
+    if night:
+        score += 10
+        reasons.append("an unusual time of day")
+    score = min(score, 100)
+
+    if score >= LOCAL_SCORE_HIGHEST:
+        risk_level = "highest"
+    elif score >= LOCAL_SCORE_ELEVATED:
+        risk_level = "elevated"
+    else:
+        risk_level = "normal"
+
+    return {
+        "risk_level": risk_level,
+        "score": score,
+        "reasons": reasons,
+        "features": {
+            "velocity_1h": velocity,
+            "velocity_1h_total": round(window_total, 2),
+            "zscore": round(zscore, 2),
+            "new_payee": new_payee,
+            "night": night,
+            "history_size": int(amounts.size),
+        },
+    }
+
+
+def record_payment(user_id: str, amount: float, payee: str = None, ts: float = None) -> None:
+    """Adds a payment that went ahead to the user's history."""
+    ts = time.time() if ts is None else ts
+    with _lock:
+        _seed()
+        history = _histories.get(user_id)
+        if history is None:
+            history = _histories[user_id] = _UserHistory()
+        history.push(float(amount), ts, _normalise_payee(payee))
+
+
+def reset_history(user_id: str = None) -> None:
+    """Forgets one user's history, or everyone's when user_id is None (without reseeding)."""
+    global _seeded
+    with _lock:
+        if user_id is None:
+            _histories.clear()
+            _seeded = True
+        else:
+            _histories.pop(user_id, None)
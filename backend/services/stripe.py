@@ -1,6 +1,7 @@
 import stripe
 import os
 from dotenv import load_dotenv
+from services import risk_engine, risk_cache, tracing
 
 load_dotenv()
 
@@ -11,6 +12,8 @@ stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 RISK_SCORE_ELEVATED = 50   # alert carer above this
 RISK_SCORE_HIGHEST = 75    # block and alert above this
 
+RISK_LEVEL_ORDER = {"unknown": 0, "normal": 0, "elevated": 1, "highest": 2}
+
 # Demo flag — set to "normal", "elevated", or "highest" to force a risk level for testing
 # Set to None in production
 FORCE_RISK_LEVEL = os.getenv("FORCE_RISK_LEVEL", None)
@@ -43,6 +46,7 @@ SUSPICIOUS_PATTERNS = [
 ]
 
 
+@tracing.traced("stripe.customer_create")
 def create_stripe_customer(name: str, email: str) -> str:
     customer = stripe.Customer.create(
         name=name,
@@ -52,6 +56,12 @@ def create_stripe_customer(name: str, email: str) -> str:
     return customer.id
 
 
+@tracing.traced("stripe.customer_delete")
+def delete_stripe_customer(customer_id: str) -> None:
+    stripe.Customer.delete(customer_id)
+
+
+@tracing.traced("stripe.customer_retrieve")
 def get_stripe_customer(customer_id: str) -> dict:
     customer = stripe.Customer.retrieve(customer_id)
     return {
@@ -61,6 +71,7 @@ def get_stripe_customer(customer_id: str) -> dict:
     }
 
 
+@tracing.traced("stripe.charge_list")
 def get_recent_transactions(customer_id: str, limit: int = 10) -> list:
     charges = stripe.Charge.list(customer=customer_id, limit=limit)
     return [
@@ -95,13 +106,26 @@ def check_suspicious_description(description: str) -> tuple[bool, str]:
     return False, None
 
 
-def build_risk_response(risk_level: str, risk_score: int, suspicious_pattern: str = None) -> dict:
+def _describe_reasons(reasons: list) -> str:
+    if len(reasons) == 1:
+        return reasons[0]
+    return ", ".join(reasons[:-1]) + " and " + reasons[-1]
+
+
+def build_risk_response(risk_level: str, risk_score: int, suspicious_pattern: str = None, local_risk: dict = None) -> dict:
     """
     Builds the risk response dict with alma_message, should_block, and should_alert.
+    A local_risk assessment from services.risk_engine can only raise the risk level.
     """
     if suspicious_pattern and risk_level == "normal":
         risk_level = "elevated"
 
+    local_reasons = []
+    if local_risk and local_risk["risk_level"] != "normal":
+        local_reasons = local_risk["reasons"]
+        if RISK_LEVEL_ORDER.get(local_risk["risk_level"], 0) > RISK_LEVEL_ORDER.get(risk_level, 0):
+            risk_level = local_risk["risk_level"]
+
     if risk_level == "highest" or (risk_score and risk_score >= RISK_SCORE_HIGHEST):
         if suspicious_pattern:
             alma_message = (
@@ -110,6 +134,13 @@ def build_risk_response(risk_level: str, risk_score: int, suspicious_pattern: st
                 f"I have blocked it to keep you safe. "
                 f"Please speak to someone you trust before trying again."
             )
+        elif local_reasons:
+            alma_message = (
+                f"I'm very concerned about this payment. "
+                f"I noticed {_describe_reasons(local_reasons)}, which is a common sign of a scam. "
+                f"I have blocked it to keep you safe. "
+                f"Please speak to someone you trust before trying again."
+            )
         else:
             alma_message = (
                 "I'm very concerned about this payment. "
@@ -127,6 +158,13 @@ def build_risk_response(risk_level: str, risk_score: int, suspicious_pattern: st
                 f"I've let your trusted contact know. "
                 f"Please double-check before going ahead."
             )
+        elif local_reasons:
+            alma_message = (
+                f"This payment looks unusual for you. "
+                f"I noticed {_describe_reasons(local_reasons)}. "
+                f"I've let your trusted contact know, but you can still go ahead if you're sure. "
+                f"Please take a moment to double-check before confirming."
+            )
         else:
             alma_message = (
                 "This payment looks a little unusual to me. "
@@ -147,21 +185,58 @@ def build_risk_response(risk_level: str, risk_score: int, suspicious_pattern: st
         "should_block": should_block,
         "should_alert": should_alert,
         "suspicious_pattern": suspicious_pattern,
+        "local_risk": local_risk,
         "alma_message": alma_message,
     }
 
 
-def get_radar_risk(charge_id: str, description: str = None) -> dict:
+@tracing.traced("stripe.account_retrieve")
+def is_connected_account(account_id: str) -> bool:
+    """True if account_id is a Connect account belonging to this platform."""
+    try:
+        stripe.Account.retrieve(account_id)
+    except stripe.error.PermissionError:
+        return False
+    except stripe.error.InvalidRequestError:
+        return False
+    return True
+
+
+def ledger_status(intent_status: str, has_payment_error: bool = False) -> str:
+    """Maps a PaymentIntent status onto transaction_storage statuses."""
+    if intent_status == "succeeded":
+        return "COMPLETED"
+    if intent_status == "canceled":
+        return "CANCELLED"
+    if intent_status == "requires_payment_method" and has_payment_error:
+        return "FAILED"
+    return "PENDING"
+
+
+@tracing.traced("stripe.radar")
+def get_radar_risk(
+    charge_id: str,
+    description: str = None,
+    local_risk: dict = None,
+    payment_intent_id: str = None,
+) -> dict:
     """
     Retrieves the Stripe Radar fraud score for a specific charge.
     Also checks description against disability-specific scam patterns.
     If FORCE_RISK_LEVEL is set, overrides Stripe score for testing.
+    With payment_intent_id, a Radar-scored decision already cached for the
+    intent is reused, and a new one is cached for the webhook.
     """
+    cached = risk_cache.get(payment_intent_id)
+    if cached is not None and cached.get("risk_score") is not None:
+        return cached
+
     if FORCE_RISK_LEVEL:
         risk_level = FORCE_RISK_LEVEL
         risk_score = {"normal": 10, "elevated": 60, "highest": 85}.get(FORCE_RISK_LEVEL, 10)
     else:
-        charge = stripe.Charge.retrieve(charge_id)
+        with tracing.span("stripe.charge_retrieve"):
+            charge = stripe.Charge.retrieve(charge_id)
         outcome = charge.outcome
         risk_level = outcome.risk_level if outcome else "unknown"
         risk_score = outcome.risk_score if outcome else None
@@ -170,7 +245,25 @@ def get_radar_risk(charge_id: str, description: str = None) -> dict:
 
     is_suspicious, matched_pattern = check_suspicious_description(description)
 
-    return build_risk_response(risk_level, risk_score, matched_pattern)
+    decision = build_risk_response(risk_level, risk_score, matched_pattern, local_risk)
+    if risk_score is not None:
+        risk_cache.put(payment_intent_id, decision)
+    return decision
+
+
+def assess_local_risk(customer_id: str, amount_euros: float, payee: str = None) -> tuple[dict, dict]:
+    """
+    Runs the local risk engine before any network call.
+    Returns (local_risk, blocked_radar); blocked_radar is None unless the payment
+    is an obvious scam that should be blocked without creating a PaymentIntent.
+    """
+    with tracing.span("risk.local") as span:
+        local_risk = risk_engine.assess_payment(customer_id, amount_euros, payee)
+        if span:
+            span.set(risk_level=local_risk["risk_level"])
+    if local_risk["risk_level"] != "highest":
+        return local_risk, None
+    return local_risk, build_risk_response("normal", None, None, local_risk)
 
 
 def create_payment_intent(
@@ -178,35 +271,61 @@ def create_payment_intent(
     amount_euros: float,
     description: str,
     metadata: dict = None,  # FIX: accept extra metadata (carer info, user name)
+    payee: str = None,
+    transfer_destination: str = None,
+    idempotency_key: str = None,
 ) -> dict:
     """
     Creates a Stripe PaymentIntent for a given customer.
-    Checks description for suspicious patterns before creating.
+    Checks description for suspicious patterns and the local risk engine before creating;
+    payments the local engine rates highest risk are blocked without calling Stripe.
     Stores carer info in metadata so webhooks can alert without needing a session.
+    With transfer_destination (a Connect account), the charge is a destination charge.
+    An idempotency_key makes a retried create return the original intent.
     """
     is_suspicious, matched_pattern = check_suspicious_description(description)
 
+    local_risk, blocked_radar = assess_local_risk(customer_id, amount_euros, payee)
+    if blocked_radar:
+        return {
+            "id": None,
+            "client_secret": None,
+            "amount": amount_euros,
+            "status": "blocked",
+            "radar": blocked_radar,
+        }
+
     # Merge caller metadata with source tag
     combined_metadata = {"source": "alma_app"}
     if metadata:
         combined_metadata.update(metadata)
 
-    intent = stripe.PaymentIntent.create(
+    params = dict(
         amount=int(amount_euros * 100),
         currency="eur",
         customer=customer_id,
         description=description,
         metadata=combined_metadata,  # FIX: was always just {"source": "alma_app"}
     )
+    if transfer_destination:
+        params["transfer_data"] = {"destination": transfer_destination}
+    if idempotency_key:
+        params["idempotency_key"] = idempotency_key
+
+    with tracing.span("stripe.payment_intent_create"):
+        intent = stripe.PaymentIntent.create(**params)
+    risk_engine.record_payment(customer_id, amount_euros, payee)
 
     radar = None
     if intent.latest_charge:
         try:
-            radar = get_radar_risk(intent.latest_charge, description)
+            radar = get_radar_risk(intent.latest_charge, description, local_risk, intent.id)
         except Exception:
             pass
     elif is_suspicious:
-        radar = build_risk_response("elevated", None, matched_pattern)
+        radar = build_risk_response("elevated", None, matched_pattern, local_risk)
+    elif local_risk["risk_level"] != "normal":
+        radar = build_risk_response("normal", None, None, local_risk)
 
     return {
         "id": intent.id,
@@ -0,0 +1,271 @@
+"""
+services/tracing.py
+
+Lightweight span tracing for request latency breakdowns.
+
+Each HTTP request gets a trace ID (from the X-Trace-Id header or a new
+one) via the middleware in main.py. Code that talks to an upstream wraps
+the call in span("name") or decorates it with @traced("name"). Spans nest
+through contextvars, so they follow the request into awaited coroutines,
+asyncio tasks and asyncio.to_thread calls without passing anything around.
+
+Set TRACE_EXPORT_PATH to append finished spans to that file as JSON lines
+(off by default). Spans are handed to a background writer thread through a
+bounded queue, so the event loop never does the file I/O; when the queue
+is full, spans are dropped and counted. The file is rotated to
+TRACE_EXPORT_PATH + ".1" once it passes TRACE_EXPORT_MAX_BYTES. When a
+request sends the X-Debug-Timings header, its spans are also collected in
+memory so the chat route can return them as debug.timings.
+
+Work that runs outside the request (e.g. alert delivery on the queue
+workers) can continue a trace with span(name, trace_id=...). Spans
+opened with no trace at all are no-ops, except that upstream calls are
+always timed for services/metrics.py.
+"""
+
+from __future__ import annotations
+
+import functools
+import inspect
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator
+
+from services import metrics
+
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")   # empty disables export
+TRACE_EXPORT_MAX_BYTES = int(os.getenv("TRACE_EXPORT_MAX_BYTES", 50 * 1024 * 1024))
+TRACE_EXPORT_QUEUE_SIZE = int(os.getenv("TRACE_EXPORT_QUEUE_SIZE", 10000))
+TRACE_HEADER = "X-Trace-Id"
+TIMINGS_HEADER = "X-Debug-Timings"
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    name: str
+    attrs: dict[str, Any] = field(default_factory=dict)
+    started_at: float = field(default_factory=time.time)
+    _start: float = field(default_factory=time.perf_counter)
+    duration_ms: float | None = None
+    error: str | None = None
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+
+@dataclass
+class _Trace:
+    trace_id: str
+    started: float = field(default_factory=time.perf_counter)
+    collected: list[dict] | None = None
+
+
+_trace: ContextVar[_Trace | None] = ContextVar("trace", default=None)
+_span: ContextVar[Span | None] = ContextVar("span", default=None)
+
+_export_queue: queue.Queue | None = None
+_export_thread: threading.Thread | None = None
+_export_lock = threading.Lock()
+_export_stats = {"exported": 0, "dropped": 0, "rotations": 0}
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex
+
+
+def current_trace_id() -> str | None:
+    trace = _trace.get()
+    return trace.trace_id if trace else None
+
+
+def _write_forever(records: queue.Queue) -> None:
+    """Writer thread: appends queued spans, flushing whenever the queue runs dry."""
+    export_file, size = None, 0
+    while True:
+        record = records.get()
+        if record is None:
+            break
+        if export_file is None:
+            export_file = open(TRACE_EXPORT_PATH, "ab")
+            size = export_file.tell()
+        line = (json.dumps(record, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+        export_file.write(line)
+        size += len(line)
+        _export_stats["exported"] += 1
+        if size >= TRACE_EXPORT_MAX_BYTES:
+            export_file.close()
+            export_file = None
+            os.replace(TRACE_EXPORT_PATH, TRACE_EXPORT_PATH + ".1")
+            _export_stats["rotations"] += 1
+        elif records.empty():
+            export_file.flush()
+    if export_file is not None:
+        export_file.close()
+
+
+def _export(record: dict) -> None:
+    """Queues a finished span for the writer thread, starting it on first use."""
+    global _export_queue, _export_thread
+    if not TRACE_EXPORT_PATH:
+        return
+    if _export_thread is None:
+        with _export_lock:
+            if _export_thread is None:
+                _export_queue = queue.Queue(maxsize=TRACE_EXPORT_QUEUE_SIZE)
+                _export_thread = threading.Thread(
+                    target=_write_forever, args=(_export_queue,), name="trace-export", daemon=True,
+                )
+                _export_thread.start()
+    try:
+        _export_queue.put_nowait(record)
+    except queue.Full:
+        _export_stats["dropped"] += 1
+
+
+def close() -> None:
+    """Writes out queued spans and stops the writer thread (app shutdown)."""
+    global _export_queue, _export_thread
+    with _export_lock:
+        export_queue, export_thread = _export_queue, _export_thread
+        _export_queue = _export_thread = None
+    if export_thread is not None:
+        export_queue.put(None)
+        export_thread.join(timeout=5)
+
+
+def stats() -> dict:
+    return dict(_export_stats)
+
+
+def _reset_after_fork() -> None:
+    """A forked child starts its own writer thread rather than queueing to its parent's."""
+    global _export_queue, _export_thread, _export_lock
+    _export_queue = _export_thread = None
+    _export_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+@contextmanager
+def trace(trace_id: str | None = None, collect: bool = False) -> Iterator[str]:
+    """Starts a trace for the current context (one per HTTP request)."""
+    state = _Trace(trace_id or new_trace_id(), collected=[] if collect else None)
+    trace_token = _trace.set(state)
+    span_token = _span.set(None)
+    try:
+        yield state.trace_id
+    finally:
+        _span.reset(span_token)
+        _trace.reset(trace_token)
+
+
+@contextmanager
+def span(name: str, trace_id: str | None = None, **attrs: Any) -> Iterator[Span | None]:
+    """
+    Times the enclosed block as a child of the current span. Passing
+    trace_id continues that trace from outside its request context.
+    """
+    state = _trace.get()
+    if trace_id is not None and (state is None or state.trace_id != trace_id):
+        state = _Trace(trace_id)
+        parent = None
+    else:
+        parent = _span.get()
+    if state is None:
+        if name.split(".", 1)[0] not in metrics.UPSTREAMS:
+            yield None
+            return
+        started, failed = time.perf_counter(), False
+        try:
+            yield None
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            metrics.observe_span(name, time.perf_counter() - started, failed)
+        return
+
+    current = Span(
+        trace_id=state.trace_id,
+        span_id=uuid.uuid4().hex[:16],
+        parent_id=parent.span_id if parent else None,
+        name=name,
+        attrs=attrs,
+    )
+    trace_token = _trace.set(state)
+    span_token = _span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _span.reset(span_token)
+        _trace.reset(trace_token)
+        duration_s = time.perf_counter() - current._start
+        current.duration_ms = round(duration_s * 1000, 2)
+        metrics.observe_span(name, duration_s, current.error is not None)
+        record = {
+            "trace_id": current.trace_id,
+            "span_id": current.span_id,
+            "parent_id": current.parent_id,
+            "name": current.name,
+            "started_at": current.started_at,
+            "offset_ms": round((current._start - state.started) * 1000, 2),
+            "duration_ms": current.duration_ms,
+            "attrs": current.attrs,
+            "error": current.error,
+        }
+        if state.collected is not None:
+            state.collected.append(record)
+        _export(record)
+
+
+def traced(name: str) -> Callable:
+    """Decorator form of span() for sync and async functions."""
+    def decorator(fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timings() -> list[dict] | None:
+    """
+    Spans finished so far in the current trace, oldest first, or None when
+    the request didn't ask for timings.
+    """
+    state = _trace.get()
+    if state is None or state.collected is None:
+        return None
+    return [
+        {
+            "name": r["name"],
+            "offset_ms": r["offset_ms"],
+            "duration_ms": r["duration_ms"],
+            **({"attrs": r["attrs"]} if r["attrs"] else {}),
+            **({"error": r["error"]} if r["error"] else {}),
+        }
+        for r in sorted(state.collected, key=lambda r: r["offset_ms"])
+    ]
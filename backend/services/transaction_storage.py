@@ -1,10 +1,52 @@
+"""
+services/transaction_storage.py
+
+Platform transaction ledger persisted to CSV.
+
+The CSV is held in memory with four indexes: by transaction_id,
+by user_id, by provider_id (the Stripe PaymentIntent or TrueLayer
+payment ID a row was created for) and by idempotency_key (the key the
+payment was requested with). Webhooks and the reconciliation job
+(services/reconciliation.py) look a payment up by provider_id and change
+its status in O(1); chat confirms look up their key before paying again.
+
+Transaction IDs are k-sortable (services/ids.py), so each user's rows are
+kept ordered by ID and history pages and time ranges are bisected using
+the ID alone, with no need to parse created_at.
+
+Status changes are not written back into the CSV. They are appended to
+TRANSACTION_STATUS_LOG and folded over the rows; the first load in each
+process compacts the log into the CSV.
+
+Other uvicorn workers write the same files, so every call first checks
+them: a CSV whose (mtime, size, inode) changed is re-read, and status log
+lines past the last offset this process applied are folded in. Writes and
+compaction hold an fcntl lock on TRANSACTIONS_CSV + ".lock" and refresh
+before writing, so a worker never appends on top of a stale view or
+compacts away another worker's status changes.
+"""
+
+from __future__ import annotations
+
+import bisect
 import csv
 import os
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Optional, Dict, List
+from typing import Optional, Dict, Iterator, List
+
+try:
+    import fcntl
+except ImportError:   # Windows: single worker only
+    fcntl = None
+
+from services import ids, metrics
 
-# CSV file path
+# CSV file paths
 TRANSACTIONS_CSV = "transactions_data.csv"
+TRANSACTION_STATUS_LOG = "transaction_status_log.csv"
 CSV_HEADERS = [
     "transaction_id",
     "user_id",
@@ -15,8 +57,24 @@ CSV_HEADERS = [
     "to_account_id",
     "description",
     "status",
-    "created_at"
+    "created_at",
+    "provider_id",
+    "idempotency_key",
 ]
+STATUS_LOG_HEADERS = ["transaction_id", "status", "source", "updated_at"]
+
+PENDING_STATUSES = {"PENDING", "initiated"}
+FINAL_STATUSES = {"COMPLETED", "FAILED", "CANCELLED"}
+
+_rows: Optional[List[Dict]] = None
+_by_id: Dict[str, List[Dict]] = {}       # transaction_id -> rows (legacy transfers share one ID across both legs)
+_by_user: Dict[str, List[Dict]] = {}     # user_id -> rows in transaction ID order
+_by_provider: Dict[str, str] = {}        # provider_id -> transaction_id
+_by_idempotency_key: Dict[str, str] = {} # idempotency_key -> transaction_id
+_csv_stamp = None                        # (mtime_ns, size, inode) of the CSV _rows reflects
+_log_offset = 0                          # bytes of the status log folded into _rows
+_flock_depth = 0
+_lock = threading.RLock()
 
 
 def _ensure_csv_exists():
@@ -27,6 +85,162 @@ def _ensure_csv_exists():
             writer.writeheader()
 
 
+def _row_key(row: Dict) -> int:
+    return ids.sort_key(row["transaction_id"])
+
+
+def _index(row: Dict) -> None:
+    """Adds a row to the in-memory indexes. Caller holds _lock."""
+    _rows.append(row)
+    _by_id.setdefault(row["transaction_id"], []).append(row)
+    user_rows = _by_user.setdefault(row["user_id"], [])
+    if user_rows and _row_key(user_rows[-1]) > _row_key(row):
+        bisect.insort(user_rows, row, key=_row_key)
+    else:
+        user_rows.append(row)
+    if row.get("provider_id"):
+        _by_provider[row["provider_id"]] = row["transaction_id"]
+    if row.get("idempotency_key"):
+        _by_idempotency_key[row["idempotency_key"]] = row["transaction_id"]
+
+
+def _rewrite() -> None:
+    """Writes every row back to CSV. Caller holds _lock."""
+    tmp_path = TRANSACTIONS_CSV + ".tmp"
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_HEADERS, restval="")
+        writer.writeheader()
+        writer.writerows(_rows)
+    os.replace(tmp_path, TRANSACTIONS_CSV)
+
+
+def _stamp(path: str):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def _log_size() -> int:
+    try:
+        return os.path.getsize(TRANSACTION_STATUS_LOG)
+    except FileNotFoundError:
+        return 0
+
+
+@contextmanager
+def _file_lock() -> Iterator[None]:
+    """Cross-process lock for writes, reloads and compaction. Re-entrant; caller holds _lock."""
+    global _flock_depth
+    if fcntl is None or _flock_depth:
+        _flock_depth += 1
+        try:
+            yield
+        finally:
+            _flock_depth -= 1
+        return
+    fd = os.open(TRANSACTIONS_CSV + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    _flock_depth = 1
+    try:
+        yield
+    finally:
+        _flock_depth = 0
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _read_csv() -> bool:
+    """Re-reads every row and rebuilds the indexes. Returns True if the header needs migrating."""
+    global _rows, _log_offset
+    _rows = []
+    _by_id.clear()
+    _by_user.clear()
+    _by_provider.clear()
+    _by_idempotency_key.clear()
+    with open(TRANSACTIONS_CSV, 'r', newline='') as f:
+        reader = csv.DictReader(f)
+        needs_rewrite = reader.fieldnames != CSV_HEADERS
+        for row in reader:
+            _index({header: row.get(header) or "" for header in CSV_HEADERS})
+    _log_offset = 0   # the status log applies on top of the CSV, so fold it again
+    return needs_rewrite
+
+
+def _fold_status_log() -> bool:
+    """Applies status log lines past _log_offset. Returns True if any were applied."""
+    global _log_offset
+    size = _log_size()
+    if size < _log_offset:   # compacted by another worker; the CSV was rewritten too
+        _log_offset = 0
+    if size == _log_offset:
+        return False
+    with open(TRANSACTION_STATUS_LOG, 'rb') as f:
+        f.seek(_log_offset)
+        lines = f.read().splitlines(keepends=True)
+    complete = [line for line in lines if line.endswith(b"\n")]   # skip a line still being written
+    applied = False
+    for values in csv.reader(line.decode() for line in complete):
+        entry = dict(zip(STATUS_LOG_HEADERS, values))
+        if entry.get("transaction_id") == "transaction_id":
+            continue   # header
+        for row in _by_id.get(entry.get("transaction_id"), []):
+            row["status"] = entry["status"]
+            applied = True
+    _log_offset += sum(len(line) for line in complete)
+    return applied
+
+
+def _refresh(compact: bool = False) -> None:
+    """
+    Brings _rows up to date with the files, optionally compacting the status
+    log into the CSV. Caller holds _lock and the file lock.
+    """
+    global _csv_stamp, _log_offset
+    _ensure_csv_exists()
+    needs_rewrite = False
+    if _rows is None or _stamp(TRANSACTIONS_CSV) != _csv_stamp:
+        needs_rewrite = _read_csv()
+    _fold_status_log()
+    if compact and (needs_rewrite or os.path.exists(TRANSACTION_STATUS_LOG)):
+        _rewrite()
+        if os.path.exists(TRANSACTION_STATUS_LOG):
+            os.remove(TRANSACTION_STATUS_LOG)
+        _log_offset = 0
+    _csv_stamp = _stamp(TRANSACTIONS_CSV)
+
+
+def _load() -> List[Dict]:
+    """
+    Returns the rows, re-reading whatever other workers have written since
+    the last call (and compacting on the first call). Caller holds _lock.
+    """
+    if _rows is not None and _stamp(TRANSACTIONS_CSV) == _csv_stamp and _log_size() == _log_offset:
+        return _rows
+    with _file_lock():
+        _refresh(compact=_rows is None)
+    return _rows
+
+
+def _log_status(transaction_id: str, status: str, source: str) -> None:
+    """Appends one status change to the log. Caller holds _lock and the file lock, with _rows refreshed."""
+    global _log_offset
+    new_file = not os.path.exists(TRANSACTION_STATUS_LOG)
+    with open(TRANSACTION_STATUS_LOG, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=STATUS_LOG_HEADERS)
+        if new_file:
+            writer.writeheader()
+        writer.writerow({
+            "transaction_id": transaction_id,
+            "status": status,
+            "source": source,
+            "updated_at": datetime.now().isoformat(),
+        })
+    _log_offset = _log_size()
+
+
+@metrics.storage_timer("transactions")
 def record_transaction(
     user_id: str,
     transaction_type: str,
@@ -35,11 +249,13 @@ def record_transaction(
     from_account_id: str = "",
     to_account_id: str = "",
     description: str = "",
-    status: str = "PENDING"
+    status: str = "PENDING",
+    provider_id: str = "",
+    idempotency_key: str = ""
 ) -> Dict:
     """
     Record a transaction (transfer, payment, etc).
-    
+
     Args:
         user_id: User's unique identifier
         transaction_type: Type of transaction (TRANSFER, PAYMENT, etc)
@@ -49,15 +265,15 @@ def record_transaction(
         to_account_id: Destination account/beneficiary
         description: Transaction description
         status: Transaction status (PENDING, COMPLETED, FAILED)
-    
+        provider_id: Stripe PaymentIntent / TrueLayer payment ID, if any
+        idempotency_key: Key the payment was requested with, if any
+
     Returns:
         dict: Transaction data that was saved
     """
-    _ensure_csv_exists()
-    
     now = datetime.now().isoformat()
-    transaction_id = f"txn_{int(datetime.now().timestamp() * 1000)}"
-    
+    transaction_id = ids.new_id("txn")
+
     transaction_data = {
         "transaction_id": transaction_id,
         "user_id": user_id,
@@ -68,93 +284,172 @@ def record_transaction(
         "to_account_id": to_account_id,
         "description": description,
         "status": status,
-        "created_at": now
+        "created_at": now,
+        "provider_id": provider_id or "",
+        "idempotency_key": idempotency_key or ""
     }
-    
-    # Append to CSV
-    with open(TRANSACTIONS_CSV, 'a', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
-        writer.writerow(transaction_data)
-    
+
+    global _csv_stamp
+    with _lock, _file_lock():
+        _refresh(compact=_rows is None)
+        # Append to CSV
+        with open(TRANSACTIONS_CSV, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
+            writer.writerow(transaction_data)
+        _csv_stamp = _stamp(TRANSACTIONS_CSV)
+        _index(dict(transaction_data))
+
     return transaction_data
 
 
-def get_user_transactions(user_id: str, limit: int = 50) -> List[Dict]:
+@metrics.storage_timer("transactions")
+def get_user_transactions(
+    user_id: str,
+    limit: int = 50,
+    before: Optional[str] = None,
+    since: Optional[str] = None
+) -> List[Dict]:
     """
-    Get all transactions for a specific user.
-    
+    Get transactions for a specific user, latest first.
+
     Args:
         user_id: User's unique identifier
         limit: Maximum number of transactions to return
-    
+        before: Cursor; only transactions with an older ID than this one
+        since: Only transactions with this ID or a newer one
+            (ids.floor_id("txn", t) turns a time into a bound)
+
     Returns:
         list: List of transaction dictionaries
     """
-    _ensure_csv_exists()
-    
-    transactions = []
-    if os.path.exists(TRANSACTIONS_CSV):
-        with open(TRANSACTIONS_CSV, 'r', newline='') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row["user_id"] == user_id:
-                    transactions.append(row)
-    
-    # Return latest first
-    return sorted(transactions, key=lambda x: x.get("created_at"), reverse=True)[:limit]
+    with _lock:
+        _load()
+        user_rows = _by_user.get(user_id, [])
+        end = bisect.bisect_left(user_rows, ids.sort_key(before), key=_row_key) if before else len(user_rows)
+        start = bisect.bisect_left(user_rows, ids.sort_key(since), key=_row_key) if since else 0
+        start = max(start, end - limit)
+        return [dict(row) for row in reversed(user_rows[start:end])]
 
 
+@metrics.storage_timer("transactions")
 def get_all_transactions(limit: int = 100) -> List[Dict]:
     """
     Get all transactions.
-    
+
     Args:
         limit: Maximum number of transactions to return
-    
+
     Returns:
         list: List of all transaction dictionaries
     """
-    _ensure_csv_exists()
-    
-    transactions = []
-    if os.path.exists(TRANSACTIONS_CSV):
-        with open(TRANSACTIONS_CSV, 'r', newline='') as f:
-            reader = csv.DictReader(f)
-            transactions = list(reader)
-    
+    with _lock:
+        transactions = [dict(row) for row in _load()]
+
     # Return latest first
-    return sorted(transactions, key=lambda x: x.get("created_at"), reverse=True)[:limit]
+    return sorted(transactions, key=_row_key, reverse=True)[:limit]
 
 
-def update_transaction_status(transaction_id: str, status: str) -> bool:
+@metrics.storage_timer("transactions")
+def list_payments(since: Optional[str] = None) -> List[Dict]:
+    """
+    PAYMENT rows, oldest first (used to rebuild risk history on startup).
+
+    Args:
+        since: Only transactions with this ID or a newer one
+    """
+    bound = ids.sort_key(since) if since else None
+    with _lock:
+        payments = [
+            dict(row) for row in _load()
+            if row["type"] == "PAYMENT" and (bound is None or _row_key(row) >= bound)
+        ]
+    return sorted(payments, key=_row_key)
+
+
+@metrics.storage_timer("transactions")
+def get_transaction_by_provider_id(provider_id: str) -> Optional[Dict]:
+    """Looks up the transaction created for a Stripe/TrueLayer payment ID."""
+    with _lock:
+        _load()
+        transaction_id = _by_provider.get(provider_id)
+        rows = _by_id.get(transaction_id, []) if transaction_id else []
+        return dict(rows[0]) if rows else None
+
+
+@metrics.storage_timer("transactions")
+def get_transaction_by_idempotency_key(idempotency_key: str) -> Optional[Dict]:
+    """Looks up the transaction recorded for a payment requested with this key."""
+    with _lock:
+        _load()
+        transaction_id = _by_idempotency_key.get(idempotency_key)
+        rows = _by_id.get(transaction_id, []) if transaction_id else []
+        return dict(rows[0]) if rows else None
+
+
+@metrics.storage_timer("transactions")
+def update_transaction_status(transaction_id: str, status: str, source: str = "api") -> bool:
     """
     Update the status of a transaction.
-    
+
+    A final status (COMPLETED, FAILED, CANCELLED) is never moved back to a
+    pending one, so a late or replayed event can't undo a settled payment.
+
     Args:
         transaction_id: Transaction ID to update
         status: New status (COMPLETED, FAILED, CANCELLED, etc)
-    
+        source: What reported the change (webhook, reconcile, api), kept in the status log
+
     Returns:
         bool: True if updated, False if not found
     """
-    _ensure_csv_exists()
-    
-    transactions = []
-    found = False
-    
-    if os.path.exists(TRANSACTIONS_CSV):
-        with open(TRANSACTIONS_CSV, 'r', newline='') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row["transaction_id"] == transaction_id:
-                    row["status"] = status
-                    found = True
-                transactions.append(row)
-    
-    # Write back to CSV
-    with open(TRANSACTIONS_CSV, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
-        writer.writeheader()
-        writer.writerows(transactions)
-    
-    return found
+    with _lock, _file_lock():
+        _refresh(compact=_rows is None)
+        rows = _by_id.get(transaction_id)
+        if not rows:
+            return False
+        current = rows[0]["status"]
+        if current == status or (current in FINAL_STATUSES and status in PENDING_STATUSES):
+            return True
+        _log_status(transaction_id, status, source)
+        for row in rows:
+            row["status"] = status
+    return True
+
+
+@metrics.storage_timer("transactions")
+def update_status_by_provider_id(provider_id: str, status: str, source: str = "webhook") -> Optional[str]:
+    """
+    Updates the transaction created for a provider payment ID.
+
+    Returns:
+        str: The local transaction_id, or None if no transaction has that provider_id
+    """
+    with _lock:
+        _load()
+        transaction_id = _by_provider.get(provider_id)
+        if transaction_id is None:
+            return None
+        update_transaction_status(transaction_id, status, source)
+    return transaction_id
+
+
+@metrics.storage_timer("transactions")
+def list_unsettled(older_than_s: float = 0, provider_prefix: str = "") -> List[Dict]:
+    """
+    Transactions with a provider_id that are still pending, oldest first.
+
+    Args:
+        older_than_s: Only rows created at least this many seconds ago
+        provider_prefix: Only provider IDs with this prefix (e.g. "pi_" for Stripe)
+    """
+    cutoff = ids.sort_key(ids.floor_id("txn", time.time() - older_than_s))
+    with _lock:
+        _load()
+        unsettled = []
+        for provider_id, transaction_id in _by_provider.items():
+            if ids.sort_key(transaction_id) >= cutoff or not provider_id.startswith(provider_prefix):
+                continue
+            row = _by_id[transaction_id][0]
+            if row["status"] in PENDING_STATUSES:
+                unsettled.append(dict(row))
+    return sorted(unsettled, key=_row_key)
@@ -6,6 +6,7 @@ import hmac
 import hashlib
 import base64
 from dotenv import load_dotenv
+from services.tracing import traced
 
 load_dotenv()
 
@@ -38,6 +39,7 @@ def get_authorization_url() -> str:
     return auth_url
 
 
+@traced("truelayer.exchange_code")
 def exchange_code_for_token(auth_code: str) -> dict:
     """
     Exchanges authorization code for access token.
@@ -87,6 +89,7 @@ def exchange_code_for_token(auth_code: str) -> dict:
         }
 
 
+@traced("truelayer.payments_token")
 def get_payments_token() -> dict:
     """
     Gets a payments access token using client credentials flow.
@@ -210,6 +213,7 @@ def link_user_bank(user_id: str, auth_code: str) -> dict:
         }
 
 
+@traced("truelayer.get_accounts")
 def get_accounts(access_token: str = None) -> dict:
     """
     Fetches user's bank accounts via TrueLayer.
@@ -229,6 +233,7 @@ def get_accounts(access_token: str = None) -> dict:
     return response.json()
 
 
+@traced("truelayer.get_transactions")
 def get_transactions(account_id: str, access_token: str = None) -> dict:
     """
     Fetches transactions for a given account.
@@ -250,6 +255,7 @@ def get_transactions(account_id: str, access_token: str = None) -> dict:
     return response.json()
 
 
+@traced("truelayer.get_balance")
 def get_balance(account_id: str, access_token: str = None) -> dict:
     """
     Fetches balance for a given account.
@@ -271,6 +277,7 @@ def get_balance(account_id: str, access_token: str = None) -> dict:
     return response.json()
 
 
+@traced("truelayer.initiate_transfer")
 def initiate_transfer(
     amount: float,
     currency: str,
@@ -310,6 +317,7 @@ def initiate_transfer(
     return response.json()
 
 
+@traced("truelayer.initiate_payment")
 def initiate_payment(
     amount: float,
     currency: str,
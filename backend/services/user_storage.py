@@ -1,8 +1,12 @@
 import csv
 import os
+import re
+import threading
 from datetime import datetime
 from typing import Optional, Dict, List
 
+from services import metrics
+
 # CSV file path
 USERS_CSV = "users_data.csv"
 CSV_HEADERS = [
@@ -27,6 +31,15 @@ CSV_HEADERS = [
 ]
 
 
+# In-memory indexes over the CSV, rebuilt whenever the file changes on disk
+# (any worker process may have written it)
+_index_lock = threading.Lock()
+_index_stamp = None
+_users_by_id: Dict[str, Dict] = {}
+_users_by_overseer: Dict[str, List[Dict]] = {}
+_users_by_email: Dict[str, Dict] = {}
+
+
 def _ensure_csv_exists():
     """Create CSV file if it doesn't exist."""
     if not os.path.exists(USERS_CSV):
@@ -35,19 +48,54 @@ def _ensure_csv_exists():
             writer.writeheader()
 
 
-def get_user_by_email(email: str) -> Optional[Dict]:
-    """Retrieve user data from CSV by email address."""
+def normalise_phone(number: str) -> str:
+    """Strips spaces and punctuation so '+353 87-123 4567' matches '+353871234567'."""
+    return re.sub(r"[^\d+]", "", number or "")
+
+
+def _invalidate_indexes() -> None:
+    global _index_stamp
+    with _index_lock:
+        _index_stamp = None
+
+
+def _indexes() -> tuple:
+    """
+    Returns (users by user_id, users by normalised overseer number, users
+    by lower-cased email), re-reading the CSV only when its mtime or size has changed. Writers in
+    this process also invalidate, in case a rewrite lands within the
+    filesystem's timestamp granularity at the same size.
+    """
+    global _index_stamp, _users_by_id, _users_by_overseer, _users_by_email
     _ensure_csv_exists()
+    stat = os.stat(USERS_CSV)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    with _index_lock:
+        if stamp != _index_stamp:
+            by_id: Dict[str, Dict] = {}
+            by_overseer: Dict[str, List[Dict]] = {}
+            by_email: Dict[str, Dict] = {}
+            with open(USERS_CSV, 'r', newline='') as f:
+                for row in csv.DictReader(f):
+                    by_id.setdefault(row["user_id"], row)
+            for row in by_id.values():
+                number = normalise_phone(row.get("overseer_number"))
+                if number:
+                    by_overseer.setdefault(number, []).append(row)
+                if row.get("email"):
+                    by_email.setdefault(row["email"].lower(), row)
+            _users_by_id, _users_by_overseer, _users_by_email, _index_stamp = by_id, by_overseer, by_email, stamp
+        return _users_by_id, _users_by_overseer, _users_by_email
 
-    if os.path.exists(USERS_CSV):
-        with open(USERS_CSV, 'r', newline='') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row.get("email", "").lower() == email.lower():
-                    return row
-    return None
+
+@metrics.storage_timer("users")
+def get_user_by_email(email: str) -> Optional[Dict]:
+    """Retrieve user data from CSV by email address."""
+    user = _indexes()[2].get((email or "").lower())
+    return dict(user) if user else None
 
 
+@metrics.storage_timer("users")
 def save_user(
     user_id: str,
     name: str,
@@ -134,10 +182,60 @@ def save_user(
         writer = csv.DictWriter(f, fieldnames=CSV_HEADERS, restval="")
         writer.writeheader()
         writer.writerows(users)
+    _invalidate_indexes()
     
     return user_data
 
 
+@metrics.storage_timer("users")
+def append_users(users: List[Dict]) -> List[Dict]:
+    """
+    Append brand-new users to CSV in a single write.
+
+    Unlike save_user, this never rewrites existing rows, so callers must
+    only pass users whose user_id is not already stored (e.g. freshly
+    created Stripe customer IDs).
+
+    Args:
+        users: List of user dicts keyed by CSV_HEADERS
+
+    Returns:
+        list: The rows that were written, with timestamps filled in
+
+    Raises:
+        ValueError: if an email is already registered or repeated in the batch;
+            nothing is written
+    """
+    _ensure_csv_exists()
+
+    registered = _indexes()[2]
+    seen = set()
+    duplicates = []
+    for user in users:
+        email = (user.get("email") or "").lower()
+        if email and (email in registered or email in seen):
+            duplicates.append(user["email"])
+        seen.add(email)
+    if duplicates:
+        raise ValueError(f"Email already registered: {', '.join(duplicates)}")
+
+    now = datetime.now().isoformat()
+    rows = []
+    for user in users:
+        row = {header: user.get(header, "") for header in CSV_HEADERS}
+        row["created_at"] = row["created_at"] or now
+        row["updated_at"] = now
+        rows.append(row)
+
+    with open(USERS_CSV, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_HEADERS, restval="")
+        writer.writerows(rows)
+    _invalidate_indexes()
+
+    return rows
+
+
+@metrics.storage_timer("users")
 def get_user(user_id: str) -> Optional[Dict]:
     """
     Retrieve user data from CSV.
@@ -148,17 +246,23 @@ def get_user(user_id: str) -> Optional[Dict]:
     Returns:
         dict: User data or None if not found
     """
-    _ensure_csv_exists()
-    
-    if os.path.exists(USERS_CSV):
-        with open(USERS_CSV, 'r', newline='') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row["user_id"] == user_id:
-                    return row
-    return None
+    user = _indexes()[0].get(user_id)
+    return dict(user) if user else None
+
+
+@metrics.storage_timer("users")
+def get_users_by_overseer(overseer_number: str) -> List[Dict]:
+    """
+    Users supervised by an overseer, by phone number (formatting ignored).
+
+    Returns:
+        list: User dicts, in CSV order
+    """
+    users = _indexes()[1].get(normalise_phone(overseer_number), [])
+    return [dict(user) for user in users]
 
 
+@metrics.storage_timer("users")
 def get_all_users() -> List[Dict]:
     """
     Retrieve all users from CSV.
@@ -176,6 +280,7 @@ def get_all_users() -> List[Dict]:
     return users
 
 
+@metrics.storage_timer("users")
 def delete_user(user_id: str) -> bool:
     """
     Delete a user from CSV.
@@ -205,10 +310,12 @@ def delete_user(user_id: str) -> bool:
         writer = csv.DictWriter(f, fieldnames=CSV_HEADERS, restval="")
         writer.writeheader()
         writer.writerows(users)
+    _invalidate_indexes()
     
     return found
 
 
+@metrics.storage_timer("users")
 def user_exists(user_id: str) -> bool:
     """Check if user exists in CSV."""
     return get_user(user_id) is not None
@@ -0,0 +1,142 @@
+"""
+services/webhook_queue.py
+
+Background worker pool for Stripe webhook events.
+
+The webhook route verifies the signature, claims the event ID in
+services/webhook_store.py and calls submit(), so Stripe gets its 200 in
+milliseconds. WEBHOOK_WORKERS asyncio workers then run the handler
+registered for the event type on a thread (handlers call Stripe Radar and
+raise carer alerts, both blocking). A handler that raises is retried up to
+WEBHOOK_MAX_ATTEMPTS times with backoff before the event is marked failed.
+
+On start(), events left unprocessed by a previous run are queued again.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from typing import Callable
+
+from services import tracing, webhook_store
+
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 2))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", 3))
+WEBHOOK_RETRY_BASE_S = float(os.getenv("WEBHOOK_RETRY_BASE_S", 1.0))
+
+Handler = Callable[[dict], None]
+
+_handlers: dict[str, Handler] = {}
+_queue: asyncio.Queue | None = None
+_loop: asyncio.AbstractEventLoop | None = None
+_workers: list[asyncio.Task] = []
+_counters = {"queued": 0, "processed": 0, "retried": 0, "failed": 0, "overflow": 0}
+
+
+def register(event_type: str, handler: Handler) -> None:
+    """Registers the handler for one Stripe event type."""
+    _handlers[event_type] = handler
+
+
+def handles(event_type: str) -> bool:
+    return event_type in _handlers
+
+
+def _start_workers(loop: asyncio.AbstractEventLoop) -> None:
+    global _queue, _loop
+    _loop = loop
+    _queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    _workers.clear()
+    for i in range(WEBHOOK_WORKERS):
+        _workers.append(loop.create_task(_worker(), name=f"webhook-worker-{i}"))
+
+
+def start() -> None:
+    """Starts the workers on the running loop and requeues leftover events (app startup)."""
+    loop = asyncio.get_running_loop()
+    if _loop is loop:
+        return
+    _start_workers(loop)
+    for event_id, event in webhook_store.pending():
+        submit(event_id, event)
+
+
+def submit(event_id: str, event: dict) -> None:
+    """Queues a claimed event for processing. Must be called on the event loop."""
+    loop = asyncio.get_running_loop()
+    if _loop is not loop:
+        _start_workers(loop)
+    item = {
+        "id": event_id,
+        "event": event,
+        "queued_at": time.monotonic(),
+        "trace_id": tracing.current_trace_id(),
+    }
+    try:
+        _queue.put_nowait(item)
+    except asyncio.QueueFull:
+        # Still recorded as received; picked up again on the next start()
+        _counters["overflow"] += 1
+        print(f"❌ Webhook queue full — event {event_id} left pending")
+        return
+    _counters["queued"] += 1
+
+
+def _process(item: dict) -> None:
+    event = item["event"]
+    handler = _handlers.get(event.get("type"))
+    queue_wait_ms = round((time.monotonic() - item["queued_at"]) * 1000, 2)
+    with tracing.span("webhook.process", trace_id=item["trace_id"], event_type=event.get("type"),
+                      queue_wait_ms=queue_wait_ms):
+        if handler is not None:
+            handler(event)
+
+
+async def _worker() -> None:
+    while True:
+        item = await _queue.get()
+        try:
+            for attempt in range(1, WEBHOOK_MAX_ATTEMPTS + 1):
+                try:
+                    await asyncio.to_thread(_process, item)
+                except Exception as e:
+                    if attempt == WEBHOOK_MAX_ATTEMPTS:
+                        webhook_store.mark_failed(item["id"], str(e))
+                        _counters["failed"] += 1
+                        print(f"❌ Webhook {item['id']} failed after {attempt} attempts: {e}")
+                        break
+                    _counters["retried"] += 1
+                    await asyncio.sleep(WEBHOOK_RETRY_BASE_S * 2 ** (attempt - 1))
+                else:
+                    webhook_store.mark_processed(item["id"])
+                    _counters["processed"] += 1
+                    break
+        finally:
+            _queue.task_done()
+
+
+async def drain(timeout: float = 10.0) -> None:
+    """Waits for queued events to be processed, then stops the workers."""
+    global _loop
+    if _queue is None:
+        return
+    try:
+        await asyncio.wait_for(_queue.join(), timeout)
+    except asyncio.TimeoutError:
+        print(f"⚠️ Webhook queue drain timed out with {_queue.qsize()} events left")
+    for task in _workers:
+        task.cancel()
+    _workers.clear()
+    _loop = None
+
+
+def metrics() -> dict:
+    return {
+        **_counters,
+        "queue_depth": _queue.qsize() if _queue is not None else 0,
+        "workers": len(_workers),
+        "store": webhook_store.stats(),
+    }
@@ -0,0 +1,303 @@
+"""
+services/webhook_store.py
+
+Durable record of Stripe webhook events already received.
+
+Stripe delivers events at least once and retries anything that isn't
+acknowledged quickly, so the webhook route claims each event ID here before
+queueing it. claim() returns False for an ID seen before, which turns a
+redelivery into a no-op.
+
+Records are appended to WEBHOOK_EVENTS_PATH (JSON lines). A "received"
+record carries the event payload, so events acknowledged to Stripe but
+not yet processed when the app stopped are handed back by pending() on
+the next start. IDs older than WEBHOOK_EVENT_RETENTION_S (Stripe stops
+retrying after three days) are dropped when the log is compacted at import.
+
+Several uvicorn workers share one log. Every operation holds an fcntl lock
+on WEBHOOK_EVENTS_PATH + ".lock" and first applies whatever other workers
+appended, so claim() rejects an ID any worker has already recorded. A worker
+that finds the log replaced by another worker's compaction re-reads it
+rather than appending to the old file. Each received event records the
+process that owns it as "<pid>:<start time>", and pending() only hands
+back events whose owner has exited. The start time (from /proc) tells a
+restarted container's PID 1 apart from the one that wrote the event.
+Without fcntl (Windows) only a single worker may use the store.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+try:
+    import fcntl
+except ImportError:   # Windows: single worker only
+    fcntl = None
+
+WEBHOOK_EVENTS_PATH = os.getenv("WEBHOOK_EVENTS_PATH", "webhook_events.jsonl")
+WEBHOOK_EVENT_RETENTION_S = float(os.getenv("WEBHOOK_EVENT_RETENTION_S", 4 * 24 * 3600))
+
+RECEIVED = "received"
+RESUMED = "resumed"     # a received event taken over by another worker; status stays RECEIVED
+PROCESSED = "processed"
+FAILED = "failed"
+
+_events: dict[str, dict] = {}   # event_id -> {"status", "type", "received_at", "owner", "event" (until processed)}
+_lock = threading.Lock()
+_file = None
+_offset = 0       # bytes of the log applied to _events
+_inode = None     # inode of the log _offset refers to (compaction replaces the file)
+_owner: str | None = None   # this process's "<pid>:<start time>"
+_counters = {"claimed": 0, "duplicates": 0, "processed": 0, "failed": 0}
+
+
+def _append(record: dict) -> None:
+    """Appends one record to the log and applies it. Caller holds the log lock."""
+    global _file, _offset
+    if _file is None:
+        _file = open(WEBHOOK_EVENTS_PATH, "ab")
+    line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+    _file.write(line)
+    _file.flush()
+    _offset += len(line)
+    _apply(record)
+
+
+def _apply(record: dict) -> None:
+    """Folds one log record into memory. Caller holds _lock."""
+    event_id = record["id"]
+    if record["status"] == RECEIVED:
+        _events.setdefault(event_id, {
+            "status": RECEIVED,
+            "type": record.get("type"),
+            "received_at": record["at"],
+            "owner": _record_owner(record),
+            "event": record.get("event"),
+        })
+        return
+    entry = _events.get(event_id)
+    if entry is None:
+        return
+    if record["status"] == RESUMED:
+        entry["owner"] = _record_owner(record)
+        return
+    entry["status"] = record["status"]
+    entry["error"] = record.get("error")
+    entry.pop("event", None)
+
+
+def _record_owner(record: dict) -> str | None:
+    """Owner token of a record; logs written before tokens existed carry a bare pid."""
+    if record.get("owner"):
+        return record["owner"]
+    return f"{record['pid']}:" if record.get("pid") else None
+
+
+def _reset() -> None:
+    global _file, _offset, _inode
+    _events.clear()
+    if _file is not None:
+        _file.close()
+        _file = None
+    _offset = 0
+    _inode = None
+
+
+def _catch_up() -> None:
+    """
+    Applies records appended since _offset, by this or any other process.
+    If another worker compacted the log, starts over from the new file.
+    Caller holds the log lock, so no writer is part-way through a line.
+    """
+    global _offset, _inode
+    try:
+        st = os.stat(WEBHOOK_EVENTS_PATH)
+    except FileNotFoundError:
+        if _inode is not None:
+            _reset()
+        return
+    if _inode is not None and st.st_ino != _inode:
+        _reset()
+    _inode = st.st_ino
+    if st.st_size == _offset:
+        return
+    with open(WEBHOOK_EVENTS_PATH, "rb") as f:
+        f.seek(_offset)
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break   # torn final line after a crash
+            _offset += len(raw)
+            try:
+                _apply(json.loads(raw))
+            except (ValueError, KeyError):
+                continue
+    if _offset < st.st_size:
+        with open(WEBHOOK_EVENTS_PATH, "r+b") as f:
+            f.truncate(_offset)
+
+
+@contextmanager
+def _log_locked() -> Iterator[None]:
+    """Holds _lock and the cross-process log lock, with _events caught up to the end of the log."""
+    with _lock:
+        fd = None
+        if fcntl is not None:
+            fd = os.open(WEBHOOK_EVENTS_PATH + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            _catch_up()
+            yield
+        finally:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+
+def load() -> None:
+    """Rebuilds state from the log and compacts away expired IDs. Called once at import."""
+    global _file, _offset, _inode
+    with _lock:
+        _reset()
+    with _log_locked():
+        cutoff = time.time() - WEBHOOK_EVENT_RETENTION_S
+        for event_id in [i for i, e in _events.items() if e["received_at"] < cutoff]:
+            del _events[event_id]
+
+        lines = []
+        for event_id, entry in _events.items():
+            received = {"id": event_id, "status": RECEIVED, "type": entry["type"], "at": entry["received_at"],
+                        "owner": entry["owner"]}
+            if entry["status"] == RECEIVED:
+                received["event"] = entry["event"]
+            lines.append(json.dumps(received, separators=(",", ":")))
+            if entry["status"] != RECEIVED:
+                lines.append(json.dumps({
+                    "id": event_id, "status": entry["status"], "error": entry.get("error"),
+                }, separators=(",", ":")))
+        data = "".join(line + "\n" for line in lines).encode("utf-8")
+        tmp_path = f"{WEBHOOK_EVENTS_PATH}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, WEBHOOK_EVENTS_PATH)
+        if _file is not None:
+            _file.close()
+            _file = None
+        _offset = len(data)
+        _inode = os.stat(WEBHOOK_EVENTS_PATH).st_ino
+
+
+def _reset_after_fork() -> None:
+    """A forked child reopens the log rather than sharing its parent's handle."""
+    global _lock, _file, _owner
+    _lock = threading.Lock()
+    _file = None
+    _owner = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _start_time(pid: int) -> str:
+    """The process's start time in clock ticks since boot, or "" without /proc."""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return ""
+    # Fields after the parenthesised command name; starttime is field 22 overall
+    return stat.rsplit(b")", 1)[1].split()[19].decode()
+
+
+def _self() -> str:
+    global _owner
+    if _owner is None:
+        _owner = f"{os.getpid()}:{_start_time(os.getpid())}"
+    return _owner
+
+
+def _alive(owner: str | None) -> bool:
+    """Whether the process that wrote an owner token is still running."""
+    if not owner:
+        return False
+    pid_text, _, started = owner.partition(":")
+    pid = int(pid_text)
+    if not started and pid == os.getpid():
+        return False   # a bare pid that is ours now was written by an earlier process
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return not started or _start_time(pid) in ("", started)
+
+
+def claim(event_id: str, event: dict) -> bool:
+    """
+    Records an event as received. Returns False if the ID was already
+    recorded, in which case the caller should acknowledge and do nothing.
+    """
+    with _log_locked():
+        if event_id in _events:
+            _counters["duplicates"] += 1
+            return False
+        _append({
+            "id": event_id, "status": RECEIVED, "type": event.get("type"), "at": time.time(),
+            "owner": _self(), "event": event,
+        })
+        _counters["claimed"] += 1
+    return True
+
+
+def mark_processed(event_id: str) -> None:
+    with _log_locked():
+        _append({"id": event_id, "status": PROCESSED, "at": time.time()})
+        _counters["processed"] += 1
+
+
+def mark_failed(event_id: str, error: str) -> None:
+    """Records that processing gave up; the ID stays claimed so redeliveries are still no-ops."""
+    with _log_locked():
+        _append({"id": event_id, "status": FAILED, "error": error, "at": time.time()})
+        _counters["failed"] += 1
+
+
+def pending() -> list[tuple[str, dict]]:
+    """
+    Takes over events received but not yet processed by a worker that has
+    since exited (e.g. left over from a restart). Events still owned by a
+    live worker are left to it.
+    """
+    owner = _self()
+    with _log_locked():
+        orphaned = [
+            (i, e["event"]) for i, e in _events.items()
+            if e["status"] == RECEIVED and e.get("event") and e["owner"] != owner and not _alive(e["owner"])
+        ]
+        for event_id, _ in orphaned:
+            _append({"id": event_id, "status": RESUMED, "owner": owner, "at": time.time()})
+        return orphaned
+
+
+def status(event_id: str) -> str | None:
+    with _log_locked():
+        entry = _events.get(event_id)
+        return entry["status"] if entry else None
+
+
+def stats() -> dict:
+    with _lock:
+        return {
+            **_counters,
+            "tracked": len(_events),
+            "pending": sum(1 for e in _events.values() if e["status"] == RECEIVED),
+        }
+
+
+load()
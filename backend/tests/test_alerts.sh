@@ -196,6 +196,36 @@ curl -s -X POST "$BASE/api/webhooks/stripe" \
     }
   }" | jq .
 
+echo ""
+echo "============================================="
+echo " STEP 16 — Webhook: same event delivered twice"
+echo " EXPECTED: first → status queued, second → status duplicate"
+echo "           (only one 💸 alert for pi_test_dup)"
+echo "============================================="
+DUP_EVENT="{
+    \"id\": \"evt_test_dup_$(date +%s)\",
+    \"type\": \"payment_intent.succeeded\",
+    \"data\": {
+      \"object\": {
+        \"id\": \"pi_test_dup\",
+        \"amount\": 30000,
+        \"currency\": \"eur\",
+        \"customer\": \"cus_test\",
+        \"latest_charge\": null,
+        \"metadata\": {
+          \"carer_phone\": \"$CARER_PHONE\",
+          \"carer_name\": \"John Carer\",
+          \"user_name\": \"Mary Tester\"
+        }
+      }
+    }
+  }"
+for i in 1 2; do
+  curl -s -X POST "$BASE/api/webhooks/stripe" \
+    -H "Content-Type: application/json" \
+    -d "$DUP_EVENT" | jq .
+done
+
 echo ""
 echo "============================================="
 echo " ALL TESTS COMPLETE"
@@ -16,8 +16,7 @@ curl -s -X GET http://localhost:8000/api/user/me \
 
 # =============================================
 # STEP 3 — Create duplicate user (same email)
-# EXPECTED: Stripe allows it (no unique email enforcement)
-#           but good to know behaviour
+# EXPECTED: 409 "An account with this email already exists"
 # =============================================
 curl -s -X POST http://localhost:8000/api/user/create \
   -H "Content-Type: application/json" \
@@ -59,4 +58,21 @@ curl -s -X POST http://localhost:8000/api/user/create \
 curl -s -X POST http://localhost:8000/api/user/create \
   -H "Content-Type: application/json" \
   -c cookies.txt \
-  -d '{"name": "", "email": ""}' | jq .
\ No newline at end of file
+  -d '{"name": "", "email": ""}' | jq .
+# =============================================
+# STEP 9 — Bulk onboarding for a care organisation
+# Requires the server to run with ADMIN_API_KEY set
+# EXPECTED: created = 3, one result per entry, session untouched
+#           (403 without a matching X-Admin-Key header)
+# =============================================
+curl -s -X POST http://localhost:8000/api/user/bulk-onboard \
+  -H "Content-Type: application/json" \
+  -H "X-Admin-Key: $ADMIN_API_KEY" \
+  -d '{
+    "concurrency": 2,
+    "users": [
+      {"name": "Aoife Byrne", "email": "aoife@test.com", "password": "pw1"},
+      {"name": "Sean Kelly", "email": "sean@test.com", "password": "pw2"},
+      {"name": "Niamh Walsh", "email": "niamh@test.com", "password": "pw3"}
+    ]
+  }' | jq .
@@ -129,5 +129,13 @@ export const apiClient = {
       }),
     getUsers: () =>
       apiClient.request("/api/overseer/users"),
+    getDashboard: (page = 1, pageSize = 20, sections) =>
+      apiClient.request(
+        `/api/overseer/dashboard?page=${page}&page_size=${pageSize}` +
+          (sections ? `&sections=${sections.join(",")}` : "")
+      ),
+    // Live feed (Server-Sent Events); the browser reconnects with Last-Event-ID itself
+    subscribeEvents: () =>
+      new EventSource(`${API_BASE_URL}/api/overseer/events`, { withCredentials: true }),
   },
 };
@@ -32,6 +32,27 @@ const OverseerDashboard = () => {
     fetchUsers();
   }, []);
 
+  // Refresh when something happens to a supervised user instead of polling
+  useEffect(() => {
+    const source = apiClient.overseer.subscribeEvents();
+    const topics = [
+      "payment.created",
+      "payment.settled",
+      "transfer.sent",
+      "transfer.received",
+      "chat.confirmed",
+      "alert",
+      "lagged",
+    ];
+    const refreshUsers = () =>
+      apiClient.overseer
+        .getUsers()
+        .then((data) => setUsers(data.users || []))
+        .catch((err) => console.error("Failed to refresh users:", err));
+    topics.forEach((topic) => source.addEventListener(topic, refreshUsers));
+    return () => source.close();
+  }, []);
+
   const fetchUsers = async () => {
     try {
       setIsLoading(true);